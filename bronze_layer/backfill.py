@@ -0,0 +1,112 @@
+from functions import *
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+
+class RateLimiter:
+    """
+    Thread-safe limiter that spaces out requests to a single host.
+
+    Parameters:
+    - requests_per_second (float): Maximum request rate shared by all workers.
+    """
+
+    def __init__(self, requests_per_second):
+        self.interval = 1.0 / requests_per_second
+        self.lock = threading.Lock()
+        self.next_slot = time.monotonic()
+
+    def acquire(self):
+        """Block until the next request slot is available."""
+        with self.lock:
+            now = time.monotonic()
+            wait = self.next_slot - now
+            self.next_slot = max(now, self.next_slot) + self.interval
+        if wait > 0:
+            time.sleep(wait)
+
+
+def backfill_month(base_url, gcs_bucket_name, month, rate_limiter, max_retries=3, backoff_seconds=30,
+                   storage_client=None):
+    """
+    Fetch and upload a single month, retrying with exponential backoff.
+
+    The part of a month is named after its date range, so a retry overwrites the
+    part of a failed attempt instead of leaving it orphaned.
+
+    Returns:
+    - dict: Summary for the month (rows, seconds, attempts, error).
+    """
+    start_time = time.time()
+    for attempt in range(1, max_retries + 1):
+        try:
+            num_rows = upload_month_data(base_url, gcs_bucket_name, month, rate_limiter=rate_limiter,
+                                         storage_client=storage_client)
+            return {
+                "month": month,
+                "rows": num_rows,
+                "seconds": time.time() - start_time,
+                "attempts": attempt,
+                "error": None,
+            }
+        except Exception as e:
+            logger.log_text(f"Attempt {attempt}/{max_retries} failed for {month}: {e}", severity="WARNING")
+            if attempt == max_retries:
+                return {
+                    "month": month,
+                    "rows": 0,
+                    "seconds": time.time() - start_time,
+                    "attempts": attempt,
+                    "error": str(e),
+                }
+            time.sleep(backoff_seconds * 2 ** (attempt - 1))
+
+
+def backfill_months(base_url, gcs_bucket_name, months, max_workers=4, requests_per_second=2.0,
+                    max_retries=3, backoff_seconds=30, storage_client=None):
+    """
+    Fetch, encode and upload several months in parallel.
+
+    Each month is written to its own object, so workers never touch the same
+    file and the most recent file update path can run before the backfill.
+    The endpoint is taken from base_url and the bucket from storage_client, so a
+    local fake SODA server and an in-memory bucket can stand in for both
+    (see check_backfill.py).
+
+    Parameters:
+    - base_url (str): The base URL of the API.
+    - gcs_bucket_name (str): Name of the GCS bucket.
+    - months (list): Months to backfill in 'MM-YYYY' format.
+    - max_workers (int): Number of months processed concurrently.
+    - requests_per_second (float): Request rate limit shared by all workers.
+    - max_retries (int): Attempts per month before giving up.
+    - backoff_seconds (float): Initial delay between attempts, doubled each retry.
+    - storage_client: Client whose bucket() is written to; defaults to the shared GCS client.
+
+    Returns:
+    - list: Per-month summaries in the order of months.
+    """
+    rate_limiter = RateLimiter(requests_per_second)
+    summaries = {}
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(backfill_month, base_url, gcs_bucket_name, month, rate_limiter,
+                            max_retries, backoff_seconds, storage_client): month
+            for month in months
+        }
+        for future in as_completed(futures):
+            summary = future.result()
+            summaries[summary["month"]] = summary
+            if summary["error"]:
+                logger.log_text(f"Backfill failed for {summary['month']}: {summary['error']}", severity="ERROR")
+            else:
+                rows_per_second = summary["rows"] / summary["seconds"] if summary["seconds"] else 0.0
+                logger.log_text(
+                    f"Backfilled {summary['month']}: {summary['rows']} rows in {summary['seconds']:.1f}s "
+                    f"({rows_per_second:.0f} rows/s, {summary['attempts']} attempt(s))"
+                )
+
+    return [summaries[month] for month in months]
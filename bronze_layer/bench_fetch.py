@@ -0,0 +1,131 @@
+from functions import *
+
+import argparse
+import resource
+import subprocess
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+
+# Stand-in for the SODA endpoint: serves a synthetic month of ridership rows,
+# honouring $limit/$offset so both the paged and the single-request fetch work.
+# Each fetch mode runs in its own process so that ru_maxrss is its own peak.
+
+STATIONS = [f"{i}" for i in range(1, 429)]
+PAYMENT_METHODS = ["omny", "metrocard"]
+FARE_CLASSES = ["Metrocard - Fair Fare", "OMNY - Full Fare", "Metrocard - Full Fare", "OMNY - Other"]
+
+
+def synthetic_record(i):
+    """Return the i-th synthetic SODA record, with numbers and timestamps as strings like the API."""
+    station = STATIONS[i % len(STATIONS)]
+    hour = (i // len(STATIONS)) % (31 * 24)
+    return {
+        "transit_timestamp": f"2024-12-{hour // 24 + 1:02d}T{hour % 24:02d}:00:00.000",
+        "transit_mode": "subway",
+        "station_complex_id": station,
+        "station_complex": f"Station {station}",
+        "borough": "Manhattan",
+        "payment_method": PAYMENT_METHODS[i % 2],
+        "fare_class_category": FARE_CLASSES[(i // 2) % len(FARE_CLASSES)],
+        "ridership": str(i % 97),
+        "transfers": str(i % 7),
+        "latitude": "40.75",
+        "longitude": "-73.98",
+        "georeference": {"type": "Point", "coordinates": [-73.98, 40.75]},
+    }
+
+
+def make_handler(total_rows):
+    class SodaHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            params = parse_qs(urlparse(self.path).query)
+            offset = int(params.get("$offset", ["0"])[0])
+            limit = int(params.get("$limit", [str(total_rows)])[0])
+            end = min(offset + limit, total_rows)
+
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.end_headers()
+            # Written in chunks without a Content-Length; the connection close ends the body
+            self.wfile.write(b"[")
+            for start in range(offset, end, 10000):
+                chunk = ",".join(json.dumps(synthetic_record(i)) for i in range(start, min(start + 10000, end)))
+                self.wfile.write((chunk if start == offset else "," + chunk).encode())
+            self.wfile.write(b"]")
+
+        def log_message(self, format, *args):
+            pass
+
+    return SodaHandler
+
+
+def fetch_paged(base_url, path, page_size):
+    pages = fetch_transit_data_pages(base_url, "12/01/2024", "12/31/2024", page_size=page_size)
+    return write_pages_to_parquet(pages, path)
+
+
+def fetch_single(base_url, path, total_rows):
+    # The former fetch: the whole month in one response, materialized before conversion
+    response = requests.get(f"{base_url}?$limit={total_rows}", timeout=3600)
+    records = response.json()
+    pq.write_table(pa.Table.from_batches([records_to_record_batch(records)]), path)
+    return len(records)
+
+
+def run_mode(mode, base_url, total_rows, page_size):
+    fd, path = tempfile.mkstemp(suffix=".parquet")
+    os.close(fd)
+    try:
+        start_time = time.time()
+        if mode == "paged":
+            num_rows = fetch_paged(base_url, path, page_size)
+        else:
+            num_rows = fetch_single(base_url, path, total_rows)
+        seconds = time.time() - start_time
+    finally:
+        os.remove(path)
+
+    # ru_maxrss is in kilobytes on Linux
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(json.dumps({
+        "mode": mode,
+        "rows": num_rows,
+        "seconds": round(seconds, 1),
+        "rows_per_second": round(num_rows / seconds) if seconds else 0,
+        "peak_rss_mb": round(peak_rss_mb, 1),
+    }))
+
+
+def main(total_rows, page_size, modes):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(total_rows))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}/resource.json"
+
+    try:
+        for mode in modes:
+            subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "--mode", mode, "--base_url", base_url,
+                 "--rows", str(total_rows), "--page_size", str(page_size)],
+                check=True
+            )
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the SODA fetch against a local stand-in server")
+    parser.add_argument("--rows", type=int, default=3000000, help="Rows in the synthetic month")
+    parser.add_argument("--page_size", type=int, default=PAGE_SIZE, help="Rows per page in paged mode")
+    parser.add_argument("--mode", choices=["paged", "single"], action="append",
+                        help="Fetch mode(s) to benchmark; defaults to both")
+    parser.add_argument("--base_url", help="Internal: run a single mode against this server")
+    args = parser.parse_args()
+
+    if args.base_url:
+        run_mode(args.mode[0], args.base_url, args.rows, args.page_size)
+    else:
+        main(args.rows, args.page_size, args.mode or ["paged", "single"])
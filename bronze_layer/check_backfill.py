@@ -0,0 +1,186 @@
+from backfill import *
+
+import argparse
+import re
+import sys
+import functions
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs, unquote
+
+
+# Runs backfill_months against a local fake SODA endpoint and an in-memory bucket,
+# then checks that every month was written exactly once and that the requests
+# stayed within the rate limit.
+
+
+class FakeBlob:
+    """In-memory stand-in for the parts of storage.Blob used by the bronze functions."""
+
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+
+    @property
+    def generation(self):
+        return self.bucket.objects[self.name][1] if self.name in self.bucket.objects else None
+
+    def exists(self):
+        return self.name in self.bucket.objects
+
+    def download_as_bytes(self, if_generation_match=None):
+        with self.bucket.lock:
+            data, generation = self.bucket.objects[self.name]
+            if if_generation_match is not None and generation != if_generation_match:
+                raise PreconditionFailed(self.name)
+            return data
+
+    def upload_from_string(self, data, content_type=None, if_generation_match=None, timeout=None):
+        if isinstance(data, str):
+            data = data.encode()
+        with self.bucket.lock:
+            current = self.bucket.objects.get(self.name, (None, 0))[1]
+            if if_generation_match is not None and current != if_generation_match:
+                raise PreconditionFailed(self.name)
+            self.bucket.objects[self.name] = (data, current + 1)
+            self.bucket.uploads[self.name] += 1
+
+    def upload_from_filename(self, path, timeout=None):
+        with open(path, "rb") as f:
+            self.upload_from_string(f.read())
+
+
+class FakeBucket:
+    def __init__(self, name):
+        self.name = name
+        self.objects = {}
+        self.uploads = Counter()
+        self.lock = threading.Lock()
+
+    def blob(self, name):
+        return FakeBlob(self, name)
+
+    def get_blob(self, name):
+        return FakeBlob(self, name) if name in self.objects else None
+
+
+class FakeStorageClient:
+    def __init__(self):
+        self.buckets = {}
+
+    def bucket(self, name):
+        return self.buckets.setdefault(name, FakeBucket(name))
+
+
+def fake_month_records(year, month, rows):
+    """Synthetic SODA records spread over the hours of a month, numbers as strings like the API."""
+    return [
+        {
+            "transit_timestamp": f"{year}-{month:02d}-{i % 28 + 1:02d}T{i % 24:02d}:00:00.000",
+            "transit_mode": "subway",
+            "station_complex_id": str(i % 400),
+            "station_complex": f"Station {i % 400}",
+            "borough": "Brooklyn",
+            "payment_method": "omny" if i % 2 else "metrocard",
+            "fare_class_category": "OMNY - Full Fare",
+            "ridership": str(i % 50),
+            "transfers": "0",
+            "latitude": "40.68",
+            "longitude": "-73.97",
+            "georeference": {"type": "Point", "coordinates": [-73.97, 40.68]},
+        }
+        for i in range(rows)
+    ]
+
+
+def make_handler(rows_per_month, request_times):
+    class SodaHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            request_times.append(time.monotonic())
+            query = parse_qs(urlparse(self.path).query)
+            year, month = re.search(r"(\d{4})-(\d{2})-\d{2}T", unquote(query["$where"][0])).groups()
+            offset = int(query["$offset"][0])
+            limit = int(query["$limit"][0])
+
+            records = fake_month_records(int(year), int(month), rows_per_month)[offset:offset + limit]
+            body = json.dumps(records).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return SodaHandler
+
+
+def main(months, rows_per_month, page_size, max_workers, requests_per_second):
+    request_times = []
+    server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(rows_per_month, request_times))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}/resource.json"
+
+    client = FakeStorageClient()
+    bucket_name = "fake-bronze-bucket"
+    # Small pages so that each month takes several rate-limited requests
+    functions.PAGE_SIZE = page_size
+
+    try:
+        start_time = time.time()
+        summaries = backfill_months(base_url, bucket_name, months, max_workers=max_workers,
+                                    requests_per_second=requests_per_second, max_retries=1,
+                                    backoff_seconds=0, storage_client=client)
+        seconds = time.time() - start_time
+    finally:
+        server.shutdown()
+
+    bucket = client.bucket(bucket_name)
+    errors = []
+
+    for summary in summaries:
+        if summary["error"] or summary["rows"] != rows_per_month:
+            errors.append(f"{summary['month']}: {summary}")
+
+    for month in months:
+        manifest, _ = read_manifest(bucket, month)
+        parts = [part["name"] for part in manifest["parts"]]
+        if len(parts) != 1:
+            errors.append(f"{month}: expected one part in the manifest, found {parts}")
+        for name in parts:
+            if bucket.uploads[name] != 1:
+                errors.append(f"{month}: {name} was uploaded {bucket.uploads[name]} times")
+
+    # Request i may not start before i intervals after the first request
+    interval = 1.0 / requests_per_second
+    request_times.sort()
+    for i, request_time in enumerate(request_times):
+        if request_time - request_times[0] < i * interval - 0.05:
+            errors.append(f"request {i} arrived {request_time - request_times[0]:.2f}s after the first, "
+                          f"before the rate limit allows ({i * interval:.2f}s)")
+            break
+
+    watermark = json.loads(bucket.objects[WATERMARK_NAME][0]) if WATERMARK_NAME in bucket.objects else {}
+    print(json.dumps({
+        "months": len(months),
+        "requests": len(request_times),
+        "seconds": round(seconds, 2),
+        "watermark": watermark,
+        "errors": errors,
+    }, indent=2))
+    return not errors
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check backfill_months against a fake SODA endpoint and bucket")
+    parser.add_argument("--months", nargs="+", default=["07-2020", "08-2020", "09-2020", "10-2020", "11-2020"],
+                        help="Months to backfill in MM-YYYY format")
+    parser.add_argument("--rows_per_month", type=int, default=2000)
+    parser.add_argument("--page_size", type=int, default=500)
+    parser.add_argument("--max_workers", type=int, default=4)
+    parser.add_argument("--requests_per_second", type=float, default=10.0)
+    args = parser.parse_args()
+
+    ok = main(args.months, args.rows_per_month, args.page_size, args.max_workers, args.requests_per_second)
+    sys.exit(0 if ok else 1)
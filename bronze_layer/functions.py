@@ -1,48 +1,323 @@
 from logging_config import *
 
+import json
+import os
+import tempfile
+import threading
 import requests
+import requests.adapters
 from datetime import datetime, timedelta
 from google.cloud import storage
+from google.api_core.exceptions import PreconditionFailed
 from io import BytesIO
 import pyarrow as pa
+import pyarrow.compute as pc
 import pyarrow.parquet as pq
-import pandas as pd
 
 
-def get_most_recent_file(bucket_name, file_extension=".parquet"):
+# Number of rows requested per SODA page when streaming a month
+PAGE_SIZE = 250000
+
+# Object listing the part files of a month, stored under the month prefix
+MANIFEST_NAME = "_manifest.json"
+
+# Layout of new bronze objects: 'month' writes MM-YYYY/part-<ts>.parquet and
+# 'hive' writes year=YYYY/month=MM/part-<ts>.parquet, which Spark can prune.
+# Switch to 'hive' after running migrate_layout.py on the bucket.
+BRONZE_LAYOUT = os.environ.get("BRONZE_LAYOUT", "month")
+
+# Sidecar object at the bucket root holding the latest ingested transit_timestamp
+WATERMARK_NAME = "_watermark.json"
+
+# Read size used when only the Parquet footer of a GCS object is needed
+FOOTER_READ_CHUNK_SIZE = 256 * 1024
+
+# HTTP connections kept open by the shared storage client
+STORAGE_POOL_SIZE = 32
+
+_storage_client = None
+_storage_client_lock = threading.Lock()
+
+# Canonical schema of the ridership table, shared with the BigQuery table definition.
+# The file is copied next to this module when the image is built.
+_here = os.path.dirname(os.path.abspath(__file__))
+RIDERSHIP_SCHEMA_PATH = os.environ.get(
+    "RIDERSHIP_SCHEMA_PATH",
+    next(
+        (path for path in [
+            os.path.join(_here, "ridership_schema.json"),
+            os.path.join(_here, "..", "schemas", "ridership_schema.json"),
+        ] if os.path.exists(path)),
+        os.path.join(_here, "ridership_schema.json")
+    )
+)
+
+# Low-cardinality string columns stored dictionary-encoded
+CATEGORICAL_COLUMNS = ["transit_mode", "station_complex_id", "station_complex", "borough",
+                       "payment_method", "fare_class_category"]
+
+# Bronze keeps the raw event time as nanosecond timestamps
+BRONZE_TYPE_OVERRIDES = {"transit_timestamp": pa.timestamp("ns")}
+
+_BQ_TO_ARROW_TYPES = {
+    "STRING": pa.string(),
+    "FLOAT": pa.float64(),
+    "FLOAT64": pa.float64(),
+    "INTEGER": pa.int64(),
+    "INT64": pa.int64(),
+    "BOOLEAN": pa.bool_(),
+    "TIMESTAMP": pa.timestamp("ns"),
+    "DATE": pa.date32(),
+}
+
+
+def bq_field_to_arrow_type(field):
+    """Map a BigQuery JSON schema field to a PyArrow type."""
+    if field["type"] == "RECORD":
+        subfields = field.get("fields", [])
+        # Parquet LIST columns appear in BigQuery as RECORD<list REPEATED RECORD<element>>
+        if len(subfields) == 1 and subfields[0]["name"] == "list" and subfields[0]["mode"] == "REPEATED":
+            return pa.list_(bq_field_to_arrow_type(subfields[0]["fields"][0]))
+        return pa.struct([(sub["name"], bq_field_to_arrow_type(sub)) for sub in subfields])
+
+    arrow_type = _BQ_TO_ARROW_TYPES[field["type"]]
+    if field.get("mode") == "REPEATED":
+        return pa.list_(arrow_type)
+    return arrow_type
+
+
+def load_bronze_schema(schema_path=RIDERSHIP_SCHEMA_PATH):
+    """
+    Build the Arrow schema of the bronze Parquet files from the ridership JSON schema.
+
+    Numeric columns are typed, transit_timestamp is timestamp[ns] and the
+    categorical string columns are dictionary-encoded.
     """
-    Get the most recent file in the GCS bucket with the specified file extension.
-    If no files are found, return None.
+    with open(schema_path) as f:
+        bq_fields = json.load(f)
+
+    fields = []
+    for field in bq_fields:
+        name = field["name"]
+        if name in BRONZE_TYPE_OVERRIDES:
+            arrow_type = BRONZE_TYPE_OVERRIDES[name]
+        elif name in CATEGORICAL_COLUMNS:
+            arrow_type = pa.dictionary(pa.int32(), pa.string())
+        else:
+            arrow_type = bq_field_to_arrow_type(field)
+        fields.append(pa.field(name, arrow_type))
+    return pa.schema(fields)
+
+
+BRONZE_SCHEMA = load_bronze_schema()
+
+
+def get_storage_client(pool_size=STORAGE_POOL_SIZE):
+    """
+    Get the storage client shared by all bronze functions.
+
+    The client is created once per process and its HTTP connection pool is sized
+    for the backfill workers, so every call reuses the same connections.
+    """
+    global _storage_client
+    with _storage_client_lock:
+        if _storage_client is None:
+            client = storage.Client()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            client._http.mount("https://", adapter)
+            _storage_client = client
+    return _storage_client
+
+
+def month_sort_key(month):
+    """Sort key that orders 'MM-YYYY' months by date."""
+    month_num, year = month.split("-")
+    return int(year), int(month_num)
+
+
+class BucketInventory:
     """
-    client = storage.Client()
-    bucket = client.bucket(bucket_name)
+    Listing of the bronze data files in a bucket, grouped by month.
+
+    The bucket is listed once, scoped to a prefix and limited to the fields that
+    are needed; missing months and the most recent month are derived from the
+    cached listing. Call refresh() to list again.
 
-    # List all files in the bucket with the specified extension
-    blobs = bucket.list_blobs()
-    filtered_blobs = [blob for blob in blobs if blob.name.endswith(file_extension)]
+    Parameters:
+    - bucket_name (str): Name of the GCS bucket.
+    - prefix (str): Only objects under this prefix are listed.
+    - file_extension (str): Extension of the data files.
+    """
 
-    if not filtered_blobs:
-        return None  # No files found with the specified extension
+    def __init__(self, bucket_name, prefix="", file_extension=".parquet"):
+        self.bucket_name = bucket_name
+        self.prefix = prefix
+        self.file_extension = file_extension
+        self.files = {}
+        self.refresh()
+
+    def refresh(self):
+        """List the bucket and rebuild the month index."""
+        blobs = get_storage_client().list_blobs(
+            self.bucket_name,
+            prefix=self.prefix or None,
+            match_glob=f"**{self.file_extension}",
+            fields="items(name,generation,size),nextPageToken"
+        )
+        self.files = {}
+        for blob in blobs:
+            month = month_of_blob(blob.name[len(self.prefix):])
+            if month is not None:
+                self.files.setdefault(month, []).append(
+                    {"name": blob.name, "generation": blob.generation, "size": blob.size}
+                )
+        return self
+
+    def months(self):
+        """Months present in the bucket, oldest first."""
+        return sorted(self.files, key=month_sort_key)
+
+    def missing_months(self, all_months):
+        """Months of all_months that have no data file."""
+        return [month for month in all_months if month not in self.files]
+
+    def most_recent_month(self):
+        """The latest month present in the bucket, or None if it is empty."""
+        months = self.months()
+        return months[-1] if months else None
+
+
+_inventories = {}
+
+
+def get_bucket_inventory(bucket_name, prefix="", file_extension=".parquet", refresh=False):
+    """Get the cached inventory of a bucket, listing it on first use or when refresh is set."""
+    key = (bucket_name, prefix, file_extension)
+    if key not in _inventories:
+        _inventories[key] = BucketInventory(bucket_name, prefix, file_extension)
+    elif refresh:
+        _inventories[key].refresh()
+    return _inventories[key]
+
+
+def month_of_blob(blob_name):
+    """
+    Return the 'MM-YYYY' month of a bronze data file, or None for any other object.
 
-    # Sort files by their names (assuming filenames are in the format MM-YYYY.parquet)
-    filtered_blobs.sort(key=lambda blob: blob.name, reverse=True)
+    The single-file layout (MM-YYYY.parquet), the part layout
+    (MM-YYYY/part-<ts>.parquet) and the Hive layout
+    (year=YYYY/month=MM/part-<ts>.parquet) are recognised.
+    """
+    if not blob_name.endswith(".parquet"):
+        return None
+    parts = blob_name.split("/")
+    if len(parts) == 3 and parts[0].startswith("year=") and parts[1].startswith("month="):
+        year, month_num = parts[0][len("year="):], parts[1][len("month="):]
+        return month_of_blob(f"{month_num}-{year}.parquet")
+    month = parts[0]
+    if month.endswith(".parquet"):
+        month = month[:-len(".parquet")]
+    try:
+        datetime.strptime(month, "%m-%Y")
+    except ValueError:
+        return None
+    return month
 
-    # Return the most recent file based on the filename
-    return filtered_blobs[0].name
 
+def month_prefix(month, layout=None):
+    """
+    Prefix of the objects of a month.
 
-def get_existing_files_gcs(bucket_name, file_extension=".parquet"):
+    Parameters:
+    - month (str): Month in 'MM-YYYY' format.
+    - layout (str): 'month' for MM-YYYY/ or 'hive' for year=YYYY/month=MM/.
+      Defaults to BRONZE_LAYOUT.
     """
-    Get a list of existing files in the GCS bucket with the specified file extension.
+    layout = layout or BRONZE_LAYOUT
+    if layout == "hive":
+        month_num, year = month.split("-")
+        return f"year={year}/month={month_num}/"
+    if layout == "month":
+        return f"{month}/"
+    raise ValueError(f"Unknown bronze layout: {layout}")
+
+
+def new_part_blob_name(month, layout=None):
+    """Name of a new part file under the month prefix."""
+    return f"{month_prefix(month, layout)}part-{datetime.utcnow().strftime('%Y%m%dT%H%M%S%f')}.parquet"
+
+
+def range_part_blob_name(month, start_date, end_date, layout=None):
     """
-    client = storage.Client()
-    bucket = client.bucket(bucket_name)
+    Name of the part file holding the records fetched for a date range of the month.
 
-    # List all files in the bucket with the specified extension
-    blobs = bucket.list_blobs()
-    existing_files = [blob.name for blob in blobs if blob.name.endswith(file_extension)]
+    The name depends only on the month and the range, so uploading the same range
+    again overwrites the part instead of adding a second copy.
 
-    return existing_files
+    Parameters:
+    - month (str): Month in 'MM-YYYY' format.
+    - start_date (str): Start date in 'MM/DD/YYYY' format.
+    - end_date (str): End date in 'MM/DD/YYYY' format.
+    """
+    start = datetime.strptime(start_date, "%m/%d/%Y").strftime("%Y%m%d")
+    end = datetime.strptime(end_date, "%m/%d/%Y").strftime("%Y%m%d")
+    return f"{month_prefix(month, layout)}part-{start}-{end}.parquet"
+
+
+def format_timestamp(timestamp):
+    """Format a transit_timestamp the way the API does."""
+    return timestamp.strftime("%Y-%m-%dT%H:%M:%S.%f") if timestamp is not None else None
+
+
+def read_manifest(bucket, month, layout=None):
+    """
+    Read the manifest of a month.
+
+    Returns:
+    - tuple: (manifest dict, generation). The generation is 0 when no manifest exists.
+    """
+    blob = bucket.get_blob(f"{month_prefix(month, layout)}{MANIFEST_NAME}")
+    if blob is None:
+        return {"month": month, "parts": []}, 0
+    manifest = json.loads(blob.download_as_bytes(if_generation_match=blob.generation))
+    return manifest, blob.generation
+
+
+def read_part_stats(bucket, blob_name):
+    """Compute the manifest entry (rows and latest transit_timestamp) of an existing part file."""
+    blob = bucket.get_blob(blob_name)
+    with blob.open("rb", chunk_size=FOOTER_READ_CHUNK_SIZE) as f:
+        parquet_file = pq.ParquetFile(f)
+        return {
+            "name": blob_name,
+            "rows": parquet_file.metadata.num_rows,
+            "max_transit_timestamp": format_timestamp(latest_timestamp_from_parquet(parquet_file)),
+        }
+
+
+def write_manifest(bucket, month, manifest, generation, layout=None):
+    """Write the manifest of a month, failing if it changed since it was read."""
+    blob = bucket.blob(f"{month_prefix(month, layout)}{MANIFEST_NAME}")
+    blob.upload_from_string(
+        json.dumps(manifest, indent=2),
+        content_type="application/json",
+        if_generation_match=generation
+    )
+
+
+def add_parts_to_manifest(bucket, month, parts):
+    """Register new part files in the month manifest, replacing the entries of overwritten parts."""
+    manifest, generation = read_manifest(bucket, month)
+
+    # Register a file written before the part layout the first time its month is updated
+    legacy_name = f"{month}.parquet"
+    if not manifest["parts"] and bucket.blob(legacy_name).exists():
+        manifest["parts"].append(read_part_stats(bucket, legacy_name))
+
+    names = {part["name"] for part in parts}
+    manifest["parts"] = [part for part in manifest["parts"] if part["name"] not in names] + parts
+    write_manifest(bucket, month, manifest, generation)
+    return manifest
 
 
 def generate_date_range(start_date, end_date):
@@ -67,101 +342,237 @@ def generate_date_range(start_date, end_date):
 
     return months
 
-def fetch_transit_data(base_url, start_date, end_date, limit=5000000):
+def fetch_transit_data_pages(base_url, start_date, end_date, page_size=None, timeout=300, rate_limiter=None):
     """
-    Fetch transit data from the API for the given date range.
+    Fetch transit data from the API page by page for the given date range.
+
+    Pages are keyed on the system ':id' column so that $offset paging is stable,
+    and only one page of records is held in memory at a time.
 
     Parameters:
     - base_url (str): The base URL of the API.
     - start_date (str): The start date in 'MM/DD/YYYY' format.
     - end_date (str): The end date in 'MM/DD/YYYY' format.
-    - limit (int): The maximum number of rows to fetch.
+    - page_size (int): The number of rows to request per page, PAGE_SIZE by default.
+    - timeout (int): Timeout in seconds for each page request.
+    - rate_limiter (RateLimiter): Optional limiter shared with other fetches to the same host.
 
-    Returns:
-    - list: The JSON response as a Python list.
+    Yields:
+    - list: The JSON records of one page.
     """
-    # Convert dates to ISO 8601 format
     start_date_iso = f"{start_date[6:10]}-{start_date[0:2]}-{start_date[3:5]}T00:00:00"
     end_date_iso = f"{end_date[6:10]}-{end_date[0:2]}-{end_date[3:5]}T23:59:59"
 
-    # Define the API endpoint with date filtering
-    url = (
-        f"{base_url}"
-        f"?$where=transit_timestamp >= '{start_date_iso}' AND transit_timestamp <= '{end_date_iso}'"
-        f" &$limit={limit}"
-    )
+    page_size = page_size or PAGE_SIZE
+    offset = 0
+    with requests.Session() as session:
+        while True:
+            url = (
+                f"{base_url}"
+                f"?$where=transit_timestamp >= '{start_date_iso}' AND transit_timestamp <= '{end_date_iso}'"
+                f"&$order=:id&$limit={page_size}&$offset={offset}"
+            )
+
+            if rate_limiter is not None:
+                rate_limiter.acquire()
+
+            try:
+                response = session.get(url, timeout=timeout)
+            except requests.exceptions.RequestException as e:
+                raise Exception(f"An error occurred during the request: {e}")
+
+            if response.status_code != 200:
+                logger.log_text(f"Failed to fetch data. Status code: {response.status_code}, Response: {response.text}")
+                raise Exception(f"Failed to fetch data: {response.status_code}, {response.text}")
+
+            page = response.json()
+            if not page:
+                return
+
+            yield page
+
+            if len(page) < page_size:
+                return
+            offset += page_size
+
+
+def conform_array(array, arrow_type):
+    """Convert an Arrow array to the given type, dictionary-encoding categorical strings."""
+    if array.type == arrow_type:
+        return array
+    if pa.types.is_dictionary(arrow_type):
+        if pa.types.is_dictionary(array.type):
+            array = array.dictionary_decode()
+        return pc.cast(array, arrow_type.value_type).dictionary_encode()
+    if pa.types.is_dictionary(array.type):
+        array = array.dictionary_decode()
+    # SODA sends numbers and ISO 8601 timestamps as strings, which Arrow casts directly
+    return pc.cast(array, arrow_type)
+
+
+def conform_table(table, schema=BRONZE_SCHEMA):
+    """Reorder and convert the columns of a table to the given schema; missing columns become null."""
+    columns = []
+    for field in schema:
+        if field.name in table.column_names:
+            column = table.column(field.name)
+            columns.append(pa.chunked_array(
+                [conform_array(chunk, field.type) for chunk in column.chunks],
+                type=field.type
+            ))
+        else:
+            columns.append(pa.nulls(table.num_rows, type=field.type))
+    return pa.Table.from_arrays(columns, schema=schema)
 
-    try:
-        response = requests.get(url)
 
-        # Handle the response
-        if response.status_code == 200:
-            return response.json()  # Return JSON response
+def records_to_record_batch(records, schema=BRONZE_SCHEMA):
+    """Convert one page of JSON records to a PyArrow RecordBatch with the given schema."""
+    arrays = []
+    for field in schema:
+        values = [record.get(field.name) for record in records]
+        if pa.types.is_nested(field.type):
+            arrays.append(pa.array(values, type=field.type))
         else:
-            logger.log_text(f"Failed to fetch data. Status code: {response.status_code}, Response: {response.text}")
-            raise Exception(f"Failed to fetch data: {response.status_code}, {response.text}")
-    
-    except requests.exceptions.RequestException as e:
-        # logger.log_text(f"An error occurred during the request: {e}", severity=500)
-        raise Exception(f"An error occurred during the request: {e}")
-    
-
-def json_to_parquet(data):
-    """Convert JSON data to Parquet format."""
-    df = pd.DataFrame(data)  # Convert JSON to DataFrame
-
-    # Explicitly convert datetime columns
-    if "transit_timestamp" in df.columns:
-        df["transit_timestamp"] = pd.to_datetime(df["transit_timestamp"])
-
-    table = pa.Table.from_pandas(df)  # Convert DataFrame to PyArrow Table
-    buffer = BytesIO()
-    pq.write_table(table, buffer)  # Write Parquet to in-memory buffer
-    buffer.seek(0)
-    return buffer
+            arrays.append(conform_array(pa.array(values, type=pa.string()), field.type))
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
 
-def upload_parquet_to_gcs(bucket_name, data, destination_blob_name, timeout=1000):
-    """Upload Parquet data to GCS."""
-    client = storage.Client()
-    bucket = client.bucket(bucket_name)
-    blob = bucket.blob(destination_blob_name)
 
-    parquet_buffer = json_to_parquet(data)  # Convert JSON to Parquet
-    blob.upload_from_file(parquet_buffer, timeout=timeout)  # Upload Parquet file
+def write_pages_to_parquet(pages, path, schema=BRONZE_SCHEMA):
+    """
+    Write pages of JSON records to a local Parquet file one row group at a time.
 
+    Parameters:
+    - pages (iterable): Iterable of lists of JSON records.
+    - path (str): Local path of the Parquet file to write.
+    - schema (pa.Schema): Schema of the Parquet file.
 
-def fetch_and_upload_month_data(base_url, gcs_bucket_name, month):
-    """Fetch data for a specific month, convert to Parquet, and upload to GCS."""
+    Returns:
+    - int: The number of rows written. No file is created when there are no rows.
+    """
+    writer = None
+    num_rows = 0
     try:
-        month_num, year = month.split("-")
-        start_date_str = f"{month_num}/01/{year}"
-        end_date_str = datetime.strptime(start_date_str, "%m/%d/%Y").replace(day=28) + timedelta(days=4)
-        end_date_str = end_date_str.replace(day=1) - timedelta(days=1)  # Get the last day of the month
-        end_date_str = end_date_str.strftime("%m/%d/%Y")
-
-        logger.log_text(f"Fetching data for {month}...")
-        limit = 3000000  # Set the desired limit
-        data = fetch_transit_data(base_url, start_date_str, end_date_str, limit)
-        logger.log_text(f"Fetched {len(data)} records for {month}.")
-
-        # Check if data is empty
-        if not data:
-            # logger.warning(f"No data found for {month}. Skipping file creation...")
-            logger.log_text(f"No data found for {month}. Skipping file creation...", severity="WARNING")
-            return
-        
-        # Upload the data directly to GCS as a Parquet file
-        destination_blob_name = f"{month}.parquet"
-        logger.log_text(f"Uploading data for {month} to Google Cloud Storage...")
-        upload_parquet_to_gcs(gcs_bucket_name, data, destination_blob_name, timeout=600)  # 10 minutes timeout
+        for page in pages:
+            batch = records_to_record_batch(page, schema)
+            if writer is None:
+                writer = pq.ParquetWriter(path, schema)
+            writer.write_batch(batch)
+            num_rows += batch.num_rows
+    finally:
+        if writer is not None:
+            writer.close()
+    return num_rows
+
+
+def upload_part_to_gcs(bucket_name, pages, month, start_date, end_date, timeout=1000, storage_client=None):
+    """
+    Stream pages of JSON records fetched for a date range into a part file of the month in GCS.
+
+    The Parquet file is written incrementally to a temporary file, so peak memory
+    is bounded by the page size rather than by the size of the month. The part is
+    named after the date range, so a retry after a failed manifest or watermark
+    update overwrites it, and is then registered in the month manifest.
+
+    storage_client defaults to the shared client; a stand-in can be passed for local runs.
+
+    Returns:
+    - int: The number of rows uploaded. Nothing is uploaded when there are no rows.
+    """
+    fd, path = tempfile.mkstemp(suffix=".parquet")
+    os.close(fd)
+    try:
+        num_rows = write_pages_to_parquet(pages, path)
+        if not num_rows:
+            return 0
+
+        latest_timestamp = latest_timestamp_from_parquet(pq.ParquetFile(path))
+
+        bucket = (storage_client or get_storage_client()).bucket(bucket_name)
+        part_name = range_part_blob_name(month, start_date, end_date)
+        bucket.blob(part_name).upload_from_filename(path, timeout=timeout)
+
+        add_parts_to_manifest(bucket, month, [{
+            "name": part_name,
+            "rows": num_rows,
+            "max_transit_timestamp": format_timestamp(latest_timestamp),
+        }])
+        advance_watermark(bucket_name, month, latest_timestamp, storage_client=storage_client)
+        return num_rows
+    finally:
+        os.remove(path)
+
+
+def upload_month_data(base_url, gcs_bucket_name, month, rate_limiter=None, storage_client=None):
+    """
+    Fetch data for a specific month, convert to Parquet, and upload to GCS.
+
+    Errors are raised to the caller so that it can decide whether to retry.
+
+    Returns:
+    - int: The number of rows uploaded for the month.
+    """
+    month_num, year = month.split("-")
+    start_date_str = f"{month_num}/01/{year}"
+    end_date_str = datetime.strptime(start_date_str, "%m/%d/%Y").replace(day=28) + timedelta(days=4)
+    end_date_str = end_date_str.replace(day=1) - timedelta(days=1)  # Get the last day of the month
+    end_date_str = end_date_str.strftime("%m/%d/%Y")
+
+    logger.log_text(f"Fetching data for {month}...")
+    pages = fetch_transit_data_pages(base_url, start_date_str, end_date_str, rate_limiter=rate_limiter)
+
+    # Stream the pages directly to GCS as a Parquet part file of the month
+    num_rows = upload_part_to_gcs(gcs_bucket_name, pages, month, start_date_str, end_date_str,
+                                  timeout=600, storage_client=storage_client)  # 10 minutes timeout
+
+    # Check if data is empty
+    if not num_rows:
+        # logger.warning(f"No data found for {month}. Skipping file creation...")
+        logger.log_text(f"No data found for {month}. Skipping file creation...", severity="WARNING")
+        return 0
+
+    logger.log_text(f"Uploaded {num_rows} records for {month} to Google Cloud Storage.")
+    return num_rows
+
+
+def latest_timestamp_from_parquet(parquet_file, column="transit_timestamp"):
+    """
+    Get the latest value of a timestamp column of a Parquet file.
+
+    The row-group column statistics in the footer are used when every row group
+    has them; otherwise only that one column is read.
+
+    Parameters:
+    - parquet_file (pq.ParquetFile): The opened Parquet file.
+    - column (str): Name of the timestamp column.
+
+    Returns:
+    - datetime: The latest timestamp, or None if the file is empty or lacks the column.
+    """
+    metadata = parquet_file.metadata
+    column_paths = [metadata.schema.column(i).path for i in range(metadata.num_columns)]
+    if metadata.num_rows == 0 or column not in column_paths:
+        return None
+    column_index = column_paths.index(column)
+
+    maxima = []
+    for i in range(metadata.num_row_groups):
+        statistics = metadata.row_group(i).column(column_index).statistics
+        if statistics is None or not statistics.has_min_max:
+            # Fall back to reading just the one column
+            table = parquet_file.read(columns=[column])
+            return pc.max(table[column]).as_py()
+        maxima.append(statistics.max)
+
+    return max(maxima) if maxima else None
 
-    except Exception as e:
-        logger.log_text(f"An error occurred for {month}: {e}", severity="ERROR")
 
 def get_latest_entry_from_gcs(bucket_name, blob_name):
     """
     Get the latest entry (transit_timestamp) from an existing Parquet file in GCS.
 
+    Only the Parquet footer is fetched, through ranged reads, unless the file
+    has no column statistics.
+
     Parameters:
     - bucket_name (str): Name of the GCS bucket.
     - blob_name (str): Name of the Parquet file in GCS.
@@ -169,25 +580,14 @@ def get_latest_entry_from_gcs(bucket_name, blob_name):
     Returns:
     - datetime: The latest transit_timestamp in the Parquet file, or None if the file is empty.
     """
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(bucket_name)
-    blob = bucket.blob(blob_name)
-
-    if not blob.exists():
-        return None
-
-    # Download the Parquet file content
-    content = blob.download_as_bytes()
-    df = pd.read_parquet(BytesIO(content))
+    bucket = get_storage_client().bucket(bucket_name)
+    blob = bucket.get_blob(blob_name)
 
-    if df.empty or "transit_timestamp" not in df.columns:
+    if blob is None:
         return None
 
-    # Get the latest transit_timestamp
-    latest_timestamp = df["transit_timestamp"].max()
-    
-    if pd.isnull(latest_timestamp):
-        return None
+    with blob.open("rb", chunk_size=FOOTER_READ_CHUNK_SIZE) as f:
+        latest_timestamp = latest_timestamp_from_parquet(pq.ParquetFile(f))
 
     # Convert to datetime if needed
     if isinstance(latest_timestamp, str):
@@ -195,6 +595,78 @@ def get_latest_entry_from_gcs(bucket_name, blob_name):
 
     return latest_timestamp
 
+
+def get_watermark(bucket_name):
+    """
+    Read the watermark sidecar of the bucket.
+
+    Returns:
+    - dict: The watermark ('month', 'max_transit_timestamp', 'backfill_complete'),
+      empty if no watermark has been written yet.
+    """
+    bucket = get_storage_client().bucket(bucket_name)
+    watermark, _ = _read_watermark(bucket)
+    return watermark
+
+
+def _read_watermark(bucket):
+    blob = bucket.get_blob(WATERMARK_NAME)
+    if blob is None:
+        return {}, 0
+    return json.loads(blob.download_as_bytes(if_generation_match=blob.generation)), blob.generation
+
+
+def _update_watermark(bucket_name, update, max_attempts=10, storage_client=None):
+    """
+    Read-modify-write the watermark sidecar with a generation precondition.
+
+    update is called with the current watermark and returns the new one, or
+    None when nothing needs to be written. Concurrent writers retry.
+    """
+    bucket = (storage_client or get_storage_client()).bucket(bucket_name)
+    for attempt in range(max_attempts):
+        watermark, generation = _read_watermark(bucket)
+        new_watermark = update(dict(watermark))
+        if new_watermark is None:
+            return watermark
+        try:
+            bucket.blob(WATERMARK_NAME).upload_from_string(
+                json.dumps(new_watermark),
+                content_type="application/json",
+                if_generation_match=generation
+            )
+            return new_watermark
+        except PreconditionFailed:
+            if attempt == max_attempts - 1:
+                raise
+
+
+def advance_watermark(bucket_name, month, latest_timestamp, storage_client=None):
+    """Record latest_timestamp in the watermark sidecar if it is newer than the current one."""
+    latest = format_timestamp(latest_timestamp)
+
+    def update(watermark):
+        current = watermark.get("max_transit_timestamp")
+        # The fixed-width ISO format sorts chronologically
+        if latest is None or (current is not None and current >= latest):
+            return None
+        watermark.update({"month": month, "max_transit_timestamp": latest})
+        return watermark
+
+    return _update_watermark(bucket_name, update, storage_client=storage_client)
+
+
+def mark_backfill_complete(bucket_name, complete):
+    """Record in the watermark sidecar whether every month up to the watermark is present."""
+    def update(watermark):
+        if watermark.get("backfill_complete") == complete:
+            return None
+        watermark["backfill_complete"] = complete
+        return watermark
+
+    return _update_watermark(bucket_name, update)
+
+
 def get_latest_entry_from_api(base_url):
     """
     Fetch the latest transit_timestamp from the API.
@@ -230,44 +702,141 @@ def get_latest_entry_from_api(base_url):
     latest_date = datetime.strptime(latest_date_str, "%Y-%m-%dT%H:%M:%S.%f")
     return latest_date
 
-def append_to_parquet_in_gcs(bucket_name, data, destination_blob_name, timeout=600):
+def append_to_parquet_in_gcs(bucket_name, pages, month, start_date, end_date, timeout=600):
     """
-    Append new data to an existing Parquet file in GCS.
+    Append new data to a month in GCS.
+
+    The new records land as a new part file under the month prefix and are
+    registered in the month manifest; existing files are not downloaded or rewritten.
+
+    Parameters:
+    - bucket_name (str): Name of the GCS bucket.
+    - pages (iterable): Iterable of lists of JSON records.
+    - month (str): Month in 'MM-YYYY' format.
+    - start_date (str): Start date of the fetched records in 'MM/DD/YYYY' format.
+    - end_date (str): End date of the fetched records in 'MM/DD/YYYY' format.
+    - timeout (int): Upload timeout in seconds.
+
+    Returns:
+    - int: The number of rows appended.
     """
     try:
-        logger.log_text(f"Appending data to {destination_blob_name}...")
-        # Download the existing Parquet file
-        client = storage.Client()
-        bucket = client.bucket(bucket_name)
-        blob = bucket.blob(destination_blob_name)
-
-        if not blob.exists():
-            logger.log_text(f"File {destination_blob_name} does not exist. Uploading as a new file.")
-            upload_parquet_to_gcs(bucket_name, data, destination_blob_name, timeout)
-            return
-
-        # Download the existing Parquet file to an in-memory buffer
-        existing_buffer = BytesIO()
-        blob.download_to_file(existing_buffer)
-        existing_buffer.seek(0)
-
-        # Read the existing Parquet file into a Pandas DataFrame
-        existing_table = pq.read_table(existing_buffer)
-        existing_df = existing_table.to_pandas()
-
-        # Convert new data to a DataFrame
-        new_df = pd.DataFrame(data)
-
-        # Append new data to the existing DataFrame
-        combined_df = pd.concat([existing_df, new_df], ignore_index=True)
-
-        # Convert the combined DataFrame to Parquet
-        combined_buffer = json_to_parquet(combined_df.to_dict("records"))
-
-        # Upload the updated Parquet file to GCS
-        blob.upload_from_file(combined_buffer, timeout=timeout)
-        logger.log_text(f"Successfully updated {destination_blob_name}.")
+        logger.log_text(f"Appending data to {month}...")
+        num_rows = upload_part_to_gcs(bucket_name, pages, month, start_date, end_date, timeout=timeout)
+        logger.log_text(f"Successfully appended {num_rows} records to {month}.")
+        return num_rows
     except Exception as e:
-        # logger.error(f"Error appending data to {destination_blob_name}: {e}")
-        logger.log_text(f"Error appending data to {destination_blob_name}: {e}", severity="ERROR")
+        # logger.error(f"Error appending data to {month}: {e}")
+        logger.log_text(f"Error appending data to {month}: {e}", severity="ERROR")
         raise
+
+
+def get_latest_entry_for_month(bucket_name, month):
+    """
+    Get the latest transit_timestamp of a month from its manifest.
+
+    Months that have no manifest yet are stored as a single MM-YYYY.parquet file,
+    which is read instead.
+
+    Returns:
+    - datetime: The latest transit_timestamp of the month, or None if it has no data.
+    """
+    bucket = get_storage_client().bucket(bucket_name)
+    manifest, _ = read_manifest(bucket, month)
+
+    if not manifest["parts"]:
+        return get_latest_entry_from_gcs(bucket_name, f"{month}.parquet")
+
+    timestamps = [part["max_transit_timestamp"] for part in manifest["parts"] if part["max_transit_timestamp"]]
+    if not timestamps:
+        return None
+    # The fixed-width ISO format sorts chronologically
+    return datetime.strptime(max(timestamps), "%Y-%m-%dT%H:%M:%S.%f")
+
+
+def compact_month_parts(bucket_name, month, min_parts=2, timeout=600):
+    """
+    Merge the part files of a month into a single part file.
+
+    Row groups are copied from each part into the new file as Arrow tables,
+    without materializing Python objects. The new part replaces the old ones
+    in the manifest before they are deleted. Silver only reads the parts a
+    manifest names, so an interruption before the manifest is written leaves
+    the new part unread and one after it leaves the old parts unread. The new
+    entry lists the parts it was compacted from, so silver does not read the
+    month again when it already merged all of them.
+
+    Parameters:
+    - bucket_name (str): Name of the GCS bucket.
+    - month (str): Month in 'MM-YYYY' format.
+    - min_parts (int): Only compact months with at least this many parts.
+    - timeout (int): Upload timeout in seconds.
+
+    Returns:
+    - bool: True if the month was compacted.
+    """
+    bucket = get_storage_client().bucket(bucket_name)
+    manifest, generation = read_manifest(bucket, month)
+    parts = manifest["parts"]
+
+    if len(parts) < min_parts:
+        return False
+
+    logger.log_text(f"Compacting {len(parts)} parts of {month}...")
+    fd, path = tempfile.mkstemp(suffix=".parquet")
+    os.close(fd)
+    try:
+        with pq.ParquetWriter(path, BRONZE_SCHEMA) as writer:
+            for part in parts:
+                part_fd, part_path = tempfile.mkstemp(suffix=".parquet")
+                os.close(part_fd)
+                try:
+                    bucket.blob(part["name"]).download_to_filename(part_path)
+                    parquet_file = pq.ParquetFile(part_path)
+                    for i in range(parquet_file.num_row_groups):
+                        writer.write_table(conform_table(parquet_file.read_row_group(i)))
+                finally:
+                    os.remove(part_path)
+
+        compacted_name = new_part_blob_name(month)
+        bucket.blob(compacted_name).upload_from_filename(path, timeout=timeout)
+    finally:
+        os.remove(path)
+
+    timestamps = [part["max_transit_timestamp"] for part in parts if part["max_transit_timestamp"]]
+    manifest["parts"] = [{
+        "name": compacted_name,
+        "rows": sum(part["rows"] for part in parts),
+        "max_transit_timestamp": max(timestamps) if timestamps else None,
+        "compacted_from": [part["name"] for part in parts],
+    }]
+    write_manifest(bucket, month, manifest, generation)
+
+    for part in parts:
+        bucket.blob(part["name"]).delete()
+
+    logger.log_text(f"Compacted {len(parts)} parts of {month} into {compacted_name}.")
+    return True
+
+
+def convert_blob_to_bronze_schema(bucket_name, blob_name, timeout=600):
+    """
+    Rewrite an existing Parquet file in GCS with the typed bronze schema.
+
+    Files written before the typed schema store every column except
+    transit_timestamp as strings; this converts them in place.
+    """
+    bucket = get_storage_client().bucket(bucket_name)
+    blob = bucket.blob(blob_name)
+
+    buffer = BytesIO()
+    blob.download_to_file(buffer)
+    buffer.seek(0)
+
+    table = conform_table(pq.read_table(buffer))
+    converted_buffer = BytesIO()
+    pq.write_table(table, converted_buffer)
+    converted_buffer.seek(0)
+
+    blob.upload_from_file(converted_buffer, timeout=timeout)
+    logger.log_text(f"Converted {blob_name} to the typed bronze schema.")
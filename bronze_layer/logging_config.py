@@ -1,5 +1,25 @@
+import logging
+
+from google.auth.exceptions import DefaultCredentialsError
 from google.cloud import logging as gcp_logging
 
+
+class LocalLogger:
+    """Stand-in for the GCP logger when running without GCP credentials (local benchmarks)."""
+
+    def __init__(self, name):
+        logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(levelname)s %(message)s")
+        self.logger = logging.getLogger(name)
+
+    def log_text(self, text, severity="INFO"):
+        # GCP severities without a Python level of the same name (NOTICE, ALERT...) log at INFO
+        level = logging.getLevelName(severity)
+        self.logger.log(level if isinstance(level, int) else logging.INFO, text)
+
+
 # Initialize GCP Logging client and logger
-gcp_client = gcp_logging.Client()
-logger = gcp_client.logger("ingestion_logger")
+try:
+    gcp_client = gcp_logging.Client()
+    logger = gcp_client.logger("ingestion_logger")
+except DefaultCredentialsError:
+    logger = LocalLogger("ingestion_logger")
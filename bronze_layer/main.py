@@ -1,4 +1,5 @@
 from functions import *
+from backfill import backfill_months
 
 import os
 import time
@@ -21,34 +22,66 @@ def main():
     # Define your GCS bucket name (configurable)
     gcs_bucket_name = "nyc_subway_data_1"
 
-    # Get existing files from the GCS bucket
-    existing_files = get_existing_files_gcs(gcs_bucket_name, file_extension=".parquet")
-    existing_files_no_ext = [os.path.splitext(blob)[0] for blob in existing_files]
-    logger.log_text(f"Existing files in GCS: {existing_files_no_ext}")
+    # Backfill concurrency and per-host request rate (configurable)
+    backfill_workers = int(os.environ.get("BACKFILL_WORKERS", "4"))
+    requests_per_second = float(os.environ.get("SODA_REQUESTS_PER_SECOND", "2"))
+
+    # Compact a month once it has this many part files (0 disables compaction)
+    compact_min_parts = int(os.environ.get("COMPACT_MIN_PARTS", "0"))
+
+    # Get the latest entry in the API
+    latest_entry_in_api = get_latest_entry_from_api(base_url)
+
+    # The watermark sidecar tells with a single small read whether there is anything to do
+    watermark = get_watermark(gcs_bucket_name)
+    logger.log_text(f"Watermark in GCS: {watermark}")
+    if (
+        watermark.get("backfill_complete")
+        and watermark.get("max_transit_timestamp")
+        and latest_entry_in_api
+        and datetime.strptime(watermark["max_transit_timestamp"], "%Y-%m-%dT%H:%M:%S.%f") >= latest_entry_in_api
+    ):
+        logger.log_text("No new data in the API since the last run. Nothing to do.")
+        logger.log_text(f"Time Taken: {(time.time() - start_time)/60:.2f} minutes")
+        return
+
+    # List the GCS bucket once and derive all bookkeeping from that listing
+    inventory = get_bucket_inventory(gcs_bucket_name, file_extension=".parquet")
+    logger.log_text(f"Existing months in GCS: {inventory.months()}")
 
     # Generate the full list of months to process
     all_months = generate_date_range(start_date, end_date)
     logger.log_text(f"All months to process: {all_months}")
 
     # Identify missing months
-    missing_months = [month for month in all_months if f"{month}.parquet" not in existing_files]
+    missing_months = inventory.missing_months(all_months)
     logger.log_text(f"Missing months to process: {missing_months}")
 
-    if existing_files:
-        most_recent_file = get_most_recent_file(gcs_bucket_name, file_extension=".parquet")
+    if inventory.files:
+        month = inventory.most_recent_month()
 
-        # Process the most recent Parquet file (update with new entries)
-        if most_recent_file:
-            logger.log_text(f"The most recent Parquet file is: {most_recent_file}")
-            month = most_recent_file.split(".")[0]  # Extract MM-YYYY from the filename
+        # Process the most recent month (update with new entries)
+        if month:
+            logger.log_text(f"The most recent month is: {month}")
 
-            # Get the latest entry in the existing Parquet file
-            latest_entry_in_gcs = get_latest_entry_from_gcs(gcs_bucket_name, most_recent_file)
+            # Get the latest entry across the part files of the month
+            latest_entry_in_gcs = get_latest_entry_for_month(gcs_bucket_name, month)
 
-            # Get the latest entry in the API
-            latest_entry_in_api = get_latest_entry_from_api(base_url)
+            # Seed the watermark sidecar for buckets written before it existed
+            if latest_entry_in_gcs is not None and not watermark.get("max_transit_timestamp"):
+                advance_watermark(gcs_bucket_name, month, latest_entry_in_gcs)
 
-            if not latest_entry_in_api:
+            # Parts without timestamps in the manifest, or a hive month without a root
+            # {month}.parquet, give no entry; fall back to the sidecar if it is for this month
+            if latest_entry_in_gcs is None and watermark.get("month") == month and watermark.get("max_transit_timestamp"):
+                latest_entry_in_gcs = datetime.strptime(watermark["max_transit_timestamp"], "%Y-%m-%dT%H:%M:%S.%f")
+                logger.log_text(f"No latest entry in the files of {month}; using the watermark {latest_entry_in_gcs}.",
+                                severity="WARNING")
+
+            if latest_entry_in_gcs is None:
+                logger.log_text(f"Could not determine the latest entry of {month} in GCS. Skipping update.",
+                                severity="ERROR")
+            elif not latest_entry_in_api:
                 # logger.error("Failed to get the latest entry from the API. Skipping update.")
                 logger.log_text("Failed to get the latest entry from the API. Skipping update.", severity="ERROR")
             else:
@@ -72,31 +105,46 @@ def main():
                             end_date_str = end_date_str.strftime("%m/%d/%Y")
                             logger.log_text(f"Fetching data from {start_date_str} to {end_date_str}...")
 
-                            data = fetch_transit_data(base_url, start_date_str, end_date_str, limit=5000000)
-                            logger.log_text(f"Fetched {len(data)} new records for {month}.")
+                            pages = fetch_transit_data_pages(base_url, start_date_str, end_date_str)
+
+                            # Append new data as a part file of the month in GCS, named after the fetched range
+                            num_rows = append_to_parquet_in_gcs(gcs_bucket_name, pages, month,
+                                                                start_date_str, end_date_str, timeout=600)
+                            logger.log_text(f"Updated {month} with {num_rows} new records.")
 
-                            # Append new data to the existing Parquet file in GCS
-                            append_to_parquet_in_gcs(gcs_bucket_name, data, most_recent_file, timeout=600)
-                            logger.log_text(f"Updated {most_recent_file} with new data.")
+                            # Optionally merge the accumulated part files of the month
+                            if compact_min_parts:
+                                compact_month_parts(gcs_bucket_name, month, min_parts=compact_min_parts)
 
                         else:
                             # If the latest timestamp is the last day of the month, no new data to fetch
                             logger.log_text(f"No new data for {month}. Latest timestamp is already the last day of the month.")
 
                     except Exception as e:
-                        logger.log_text(f"An error occurred while updating {most_recent_file}: {e}", severity="ERROR")
+                        logger.log_text(f"An error occurred while updating {month}: {e}", severity="ERROR")
                         raise
     else:
         logger.log_text("No Parquet files found in the GCS bucket. Fetching data for all months.")
 
     if missing_months:
-        for month in missing_months:
-            try:
-                fetch_and_upload_month_data(base_url, gcs_bucket_name, month)
-            except Exception as e:
-                logger.log_text(f"An error occurred while processing month {month}: {e}", severity="ERROR")
+        # Missing months are separate objects from the most recent file, so they
+        # can be backfilled concurrently once the update above has finished
+        summaries = backfill_months(
+            base_url,
+            gcs_bucket_name,
+            missing_months,
+            max_workers=backfill_workers,
+            requests_per_second=requests_per_second
+        )
+        total_rows = sum(summary["rows"] for summary in summaries)
+        failed_months = [summary["month"] for summary in summaries if summary["error"]]
+        logger.log_text(f"Backfilled {total_rows} rows across {len(summaries) - len(failed_months)} months.")
+        if failed_months:
+            logger.log_text(f"Months that failed to backfill: {failed_months}", severity="ERROR")
+        mark_backfill_complete(gcs_bucket_name, not failed_months)
     else:
         logger.log_text("No missing months to process.")
+        mark_backfill_complete(gcs_bucket_name, True)
 
     # Record the end time
     end_time = time.time()
@@ -0,0 +1,91 @@
+from functions import *
+
+import argparse
+
+
+def migrate_month(bucket, month, files, target_layout, convert_schema=False, dry_run=False):
+    """
+    Move the data files of a month under the target layout and rebuild its manifest.
+
+    Objects are copied server-side, registered in the manifest under the new
+    prefix, and only then deleted from their old location.
+
+    Parameters:
+    - bucket (storage.Bucket): The bronze bucket.
+    - month (str): Month in 'MM-YYYY' format.
+    - files (list): Inventory entries (name, generation, size) of the month.
+    - target_layout (str): 'month' or 'hive'.
+    - convert_schema (bool): Also rewrite the files with the typed bronze schema.
+    - dry_run (bool): Only log what would be moved.
+    """
+    prefix = month_prefix(month, target_layout)
+    moved = [file for file in files if not file["name"].startswith(prefix)]
+    if not moved:
+        return
+
+    parts = []
+    for file in files:
+        if file["name"].startswith(prefix):
+            parts.append(read_part_stats(bucket, file["name"]))
+            continue
+
+        new_name = new_part_blob_name(month, target_layout)
+        logger.log_text(f"Moving {file['name']} to {new_name}...")
+        if dry_run:
+            continue
+
+        bucket.copy_blob(
+            bucket.blob(file["name"]),
+            bucket,
+            new_name,
+            if_generation_match=0,
+            if_source_generation_match=file["generation"]
+        )
+        if convert_schema:
+            convert_blob_to_bronze_schema(bucket.name, new_name)
+        parts.append(read_part_stats(bucket, new_name))
+
+    if dry_run:
+        return
+
+    manifest, generation = read_manifest(bucket, month, target_layout)
+    manifest["parts"] = parts
+    write_manifest(bucket, month, manifest, generation, target_layout)
+
+    for file in moved:
+        bucket.blob(file["name"]).delete(if_generation_match=file["generation"])
+
+    # Remove manifests left under the other layouts
+    for layout in ["month", "hive"]:
+        if layout != target_layout:
+            old_manifest = bucket.get_blob(f"{month_prefix(month, layout)}{MANIFEST_NAME}")
+            if old_manifest is not None:
+                old_manifest.delete()
+
+    logger.log_text(f"Migrated {len(moved)} file(s) of {month} to {prefix}.")
+
+
+def main(bucket_name, target_layout="hive", convert_schema=False, dry_run=False):
+    """Migrate every month of the bronze bucket to the target layout."""
+    bucket = get_storage_client().bucket(bucket_name)
+    inventory = get_bucket_inventory(bucket_name, file_extension=".parquet")
+
+    for month in inventory.months():
+        migrate_month(bucket, month, inventory.files[month], target_layout, convert_schema, dry_run)
+
+    inventory.refresh()
+    logger.log_text(f"Layout migration to '{target_layout}' finished for {len(inventory.months())} months.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Migrate bronze objects to another layout")
+    parser.add_argument("bucket_name", help="The bronze GCS bucket name (e.g., nyc_subway_data_1)")
+    parser.add_argument("--target_layout", choices=["month", "hive"], default="hive",
+                        help="'month' for MM-YYYY/ prefixes or 'hive' for year=YYYY/month=MM/ prefixes")
+    parser.add_argument("--convert_schema", action="store_true",
+                        help="Also rewrite the files with the typed bronze schema")
+    parser.add_argument("--dry_run", action="store_true", help="Only log the objects that would be moved")
+
+    args = parser.parse_args()
+
+    main(args.bucket_name, args.target_layout, args.convert_schema, args.dry_run)
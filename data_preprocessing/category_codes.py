@@ -0,0 +1,110 @@
+# Persistent ordinal codes of the categorical columns, one append-only table per column.
+#
+# A value keeps its code once assigned, so adding a station does not shift the codes the
+# trained models, modeling/station_complex.csv and the forecast notebooks rely on. New
+# values get the next codes in sort order, which on empty tables is the same numbering
+# DENSE_RANK() over the full history used to give.
+import argparse
+import csv
+
+from sql_runner import BigQueryRunner
+
+category_columns = ["transit_mode", "station_complex", "borough", "payment_method"]
+
+# Table the codes were taken from before they were persisted, used to seed empty code tables
+legacy_encoded_table = "original_encoded_cols_data"
+
+
+def code_table(column):
+    return f"{column}_codes"
+
+
+def _join_key(expression):
+    # NULL is a category value of its own; '' does not occur in the data
+    return f"COALESCE({expression}, '')"
+
+
+def update_codes_sql(runner, source, since=None, time_column="transit_timestamp"):
+    """
+    Statements creating the code tables if needed and appending the values of the source
+    rows (after `since`, if given) that have no code yet.
+    """
+    after = f" WHERE {time_column} > TIMESTAMP '{since.strftime('%Y-%m-%d %H:%M:%S.%f')}'" if since else ""
+    statements = []
+    for column in category_columns:
+        codes = runner.table(code_table(column))
+        statements.append(f"CREATE TABLE IF NOT EXISTS {codes} ({column} STRING, {column}_index INT64);")
+        if runner.exists(legacy_encoded_table):
+            statements.append(f"""
+            INSERT INTO {codes} ({column}, {column}_index)
+            SELECT DISTINCT {column}, {column}_index
+            FROM {runner.table(legacy_encoded_table)}
+            WHERE NOT EXISTS (SELECT 1 FROM {codes});
+            """)
+        statements.append(f"""
+            INSERT INTO {codes} ({column}, {column}_index)
+            SELECT
+                value,
+                (SELECT COALESCE(MAX({column}_index), 0) FROM {codes}) + ROW_NUMBER() OVER (ORDER BY value)
+            FROM (SELECT DISTINCT {column} AS value FROM {source}{after}) AS new_values
+            WHERE NOT EXISTS (
+                SELECT 1 FROM {codes} AS existing
+                WHERE {_join_key(f'existing.{column}')} = {_join_key('new_values.value')}
+            );
+            """)
+    return statements
+
+
+def update_codes(runner, source_name, since=None):
+    """Assign codes to the category values of a source table that have none yet."""
+    for statement in update_codes_sql(runner, runner.table(source_name), since):
+        runner.run(statement, "category_codes")
+
+
+def encode_sql(runner, source):
+    """
+    SELECT adding the `<column>_index` code next to each categorical column of the source.
+
+    The code tables hold a few hundred rows, so the joins are broadcast and no sort over
+    the source is needed.
+    """
+    selects = ",\n        ".join(f"s.{column},\n        {column}_codes.{column}_index" for column in category_columns)
+    joins = "\n    ".join(
+        f"LEFT JOIN {runner.table(code_table(column))} AS {column}_codes\n"
+        f"        ON {_join_key(f's.{column}')} = {_join_key(f'{column}_codes.{column}')}"
+        for column in category_columns
+    )
+    return f"""
+    SELECT
+        s.transit_timestamp,
+        s.ridership,
+        s.transfer,
+        {selects}
+    FROM {source} AS s
+    {joins}
+    """
+
+
+def export_codes(runner, column, path):
+    """Write the codes of a column to a CSV file, e.g. modeling/station_complex.csv."""
+    rows = runner.fetch(f"SELECT {column}, {column}_index FROM {runner.table(code_table(column))} "
+                        f"ORDER BY {column}_index")
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow([column, f"{column}_index"])
+        writer.writerows(rows)
+    print(f"{len(rows)} codes of {column} have been written to {path}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Update or export the persisted category codes")
+    parser.add_argument("--update_from", default="nyc", help="Table whose new category values get codes")
+    parser.add_argument("--export", nargs=2, metavar=("COLUMN", "CSV_PATH"), help="Export the codes of a column")
+
+    args = parser.parse_args()
+
+    runner = BigQueryRunner()
+    if args.export:
+        export_codes(runner, *args.export)
+    else:
+        update_codes(runner, args.update_from)
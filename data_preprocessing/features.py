@@ -0,0 +1,184 @@
+# Feature definitions shared by the hourly and daily preprocessing and by the prediction
+# and forecast inputs built from their tables.
+#
+# Run directly to benchmark the generated SQL locally on DuckDB:
+#     python features.py --series 2000 --rows 500
+import argparse
+import time
+
+from sql_runner import DuckDBRunner
+
+series_columns = ["transit_mode_index", "station_complex_index", "borough_index", "payment_method_index"]
+
+# Horizons, in rows, of the moving average features named `<feature>_<horizon>d_mv`
+moving_average_horizons = [7, 30]
+
+# Calendar columns that are also averaged, because the saved hourly and daily models were
+# trained with their averages. They follow from the timestamp and add nothing the calendar
+# features do not already give, so they can be dropped once the models are retrained.
+hourly_calendar_mv_columns = ["hour_of_day", "day_of_week", "week_of_month", "hour_of_day_sin", "hour_of_day_cos",
+                              "day_of_week_sin", "day_of_week_cos", "week_of_month_sin", "week_of_month_cos"]
+daily_calendar_mv_columns = ["day_of_week", "week_of_month", "day_of_week_sin", "day_of_week_cos",
+                             "week_of_month_sin", "week_of_month_cos"]
+
+
+def moving_average_names(feature="ridership", columns=(), horizons=moving_average_horizons):
+    return [name for horizon in horizons for name in [f"{feature}_{horizon}d_mv"] + [
+        f"{column}_{horizon}d_mv" for column in columns
+    ]]
+
+
+def lag_features_sql(source, lag_count, time_column, value_column="ridership", series_columns=series_columns,
+                     method="lag"):
+    """
+    SELECT adding `<value_column>_lag_1` .. `_lag_<lag_count>` to the rows of a source that
+    have `lag_count` previous rows with a value in their series, dropping the other rows.
+
+    All lags share one named window, so the rows are sorted once per series, and the rows
+    to drop come from a single COUNT over the previous `lag_count` rows. With
+    method="array" the lags are read from one ARRAY_AGG over that frame instead of one
+    LAG() per lag.
+    """
+    window = f"PARTITION BY {', '.join(series_columns)} ORDER BY {time_column}"
+    frame = f"lag_window ROWS BETWEEN {lag_count} PRECEDING AND 1 PRECEDING"
+    if method == "array":
+        windowed = [f"ARRAY_AGG({value_column} IGNORE NULLS) OVER ({frame}) AS _history"]
+        selected = ["* EXCEPT (_history, _complete)"] + [
+            f"_history[OFFSET({lag_count - lag})] AS {value_column}_lag_{lag}" for lag in range(1, lag_count + 1)
+        ]
+    else:
+        windowed = [
+            f"LAG({value_column}, {lag}) OVER lag_window AS {value_column}_lag_{lag}" for lag in range(1, lag_count + 1)
+        ]
+        selected = ["* EXCEPT (_complete)"]
+    windowed.append(f"COUNT({value_column}) OVER ({frame}) AS _complete")
+    selected_sql = ",\n        ".join(selected)
+    windowed_sql = ",\n            ".join(windowed)
+    return f"""
+    SELECT
+        {selected_sql}
+    FROM (
+        SELECT
+            *,
+            {windowed_sql}
+        FROM {source}
+        WINDOW lag_window AS ({window})
+    ) AS lagged_data
+    WHERE _complete = {lag_count}
+    """
+
+
+def moving_averages_sql(source, time_column, value_column="ridership", feature="ridership", columns=(),
+                        horizons=moving_average_horizons, series_columns=series_columns, next_row=False):
+    """
+    SELECT adding `<feature>_<horizon>d_mv`, the average of `value_column` over the previous
+    `horizon` rows of the series, and `<column>_<horizon>d_mv` for each of `columns`, to the
+    rows of a source, dropping the rows where any of them is NULL.
+
+    Each horizon has one named window, the only place its partition, order and frame are
+    stated; all the averages of a horizon share it. With next_row=True the frames end at
+    the current row instead and no row is dropped: every row gets the averages of the row
+    that follows it, which is how the prediction and forecast inputs are built from the
+    latest rows.
+    """
+    window = f"PARTITION BY {', '.join(series_columns)} ORDER BY {time_column}"
+    frames = {
+        horizon: f"{horizon - 1} PRECEDING AND CURRENT ROW" if next_row else f"{horizon} PRECEDING AND 1 PRECEDING"
+        for horizon in horizons
+    }
+    names = moving_average_names(feature, columns, horizons)
+    averages = ",\n            ".join(
+        f"AVG({column}) OVER mv_{horizon} AS {name}"
+        for horizon in horizons
+        for column, name in zip([value_column, *columns], moving_average_names(feature, columns, [horizon]))
+    )
+    windows = ",\n            ".join(f"mv_{horizon} AS ({window} ROWS BETWEEN {frames[horizon]})" for horizon in horizons)
+    where = "" if next_row else "WHERE " + "\n      AND ".join(f"{name} IS NOT NULL" for name in names)
+    return f"""
+    SELECT *
+    FROM (
+        SELECT
+            *,
+            {averages}
+        FROM {source}
+        WINDOW
+            {windows}
+    ) AS moving_avg_data
+    {where}
+    """
+
+
+def _separate_lags_sql(source, lag_count, time_column, value_column="ridership", series_columns=series_columns):
+    """One LAG() window per lag and a NULL check per lag column, as the preprocessing used to do."""
+    window = f"PARTITION BY {', '.join(series_columns)} ORDER BY {time_column}"
+    lags = ",\n            ".join(
+        f"LAG({value_column}, {lag}) OVER ({window}) AS {value_column}_lag_{lag}" for lag in range(1, lag_count + 1)
+    )
+    not_null = "\n        AND ".join(f"{value_column}_lag_{lag} IS NOT NULL" for lag in range(1, lag_count + 1))
+    return f"""
+    SELECT *
+    FROM (
+        SELECT
+            *,
+            {lags}
+        FROM {source}
+    ) AS lagged_data
+    WHERE {not_null}
+    """
+
+
+def benchmark_lags(series, rows, lag_count, repeats=3):
+    """
+    Time the lag SQL on a synthetic series table and check every variant gives the same
+    rows as one LAG() window per lag with a NULL check per lag column.
+    """
+    runner = DuckDBRunner()
+    runner.connection.execute(f"""
+        CREATE TABLE {runner.dataset}.series AS
+        SELECT
+            TIMESTAMP '2024-01-01' + INTERVAL (hour) HOUR AS transit_timestamp,
+            1 AS transit_mode_index,
+            id AS station_complex_index,
+            id % 5 + 1 AS borough_index,
+            id % 2 + 1 AS payment_method_index,
+            -- a few missing values, which drop the rows lagging them
+            CASE WHEN random() < 0.001 THEN NULL ELSE CAST(random() * 1000 AS BIGINT) END AS ridership
+        FROM range({series}) AS s(id), range({rows}) AS h(hour)
+    """)
+    source = runner.table("series")
+    variants = {
+        "separate_lags": _separate_lags_sql(source, lag_count, "transit_timestamp"),
+        "named_window": lag_features_sql(source, lag_count, "transit_timestamp"),
+        "array_window": lag_features_sql(source, lag_count, "transit_timestamp", method="array"),
+    }
+    equivalent = True
+    for name, sql in variants.items():
+        runs = []
+        for _ in range(repeats):
+            start = time.time()
+            runner.run(f"CREATE OR REPLACE TABLE {runner.table(name)} AS {sql}")
+            runs.append(time.time() - start)
+        differences = 0
+        if name != "separate_lags":
+            columns = ", ".join(runner.columns("separate_lags"))
+            expected = f"SELECT {columns} FROM {runner.table('separate_lags')}"
+            actual = f"SELECT {columns} FROM {runner.table(name)}"
+            differences = runner.scalar(f"""
+                SELECT (SELECT COUNT(*) FROM ({expected} EXCEPT DISTINCT {actual}))
+                     + (SELECT COUNT(*) FROM ({actual} EXCEPT DISTINCT {expected}))
+            """)
+            equivalent = equivalent and differences == 0
+        print(f"{name}: {min(runs):.3f}s (best of {repeats}), {differences} rows differing from separate_lags")
+    print(f"{series * rows} rows, {lag_count} lags")
+    return equivalent
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the lag feature SQL locally on DuckDB")
+    parser.add_argument("--series", type=int, default=2000)
+    parser.add_argument("--rows", type=int, default=500, help="Rows per series")
+    parser.add_argument("--lags", type=int, default=24)
+
+    args = parser.parse_args()
+
+    raise SystemExit(0 if benchmark_lags(args.series, args.rows, args.lags) else 1)
@@ -1,33 +1,49 @@
-from google.cloud import bigquery
-
-def run_bigquery_sql():
-    # Initialize the BigQuery client
-    client = bigquery.Client()
-
-    # Step 1: Define the SQL query to clean the data and save it to a new table
-    sql_query_clean_data = """
-    CREATE OR REPLACE TABLE `lively-encoder-448916-d5.nyc_subway.relevant_data` AS
-    SELECT 
-        PARSE_TIMESTAMP('%Y-%m-%d %H:%M:%S', transit_timestamp) AS transit_timestamp,
+import argparse
+import time
+from functools import partial
+
+from category_codes import category_columns, code_table, encode_sql, update_codes
+from features import hourly_calendar_mv_columns, lag_features_sql, moving_average_horizons, moving_averages_sql
+from pipeline import Step, compare_tables, report, run_pipeline, segments
+from sql_runner import BigQueryRunner, DuckDBRunner
+
+# Columns identifying one ridership series after ordinal encoding
+series_columns = ["transit_mode_index", "station_complex_index", "borough_index", "payment_method_index"]
+
+# Feature tables are partitioned by day and clustered by series, so incremental runs
+# only read the partitions of the new hours and of the lookback
+cluster_columns = {
+    "relevant_data": ["station_complex", "payment_method"],
+    "pm_grouped": ["station_complex", "payment_method"],
+    "original_encoded_cols_data": ["station_complex_index", "payment_method_index"],
+    "encoded_hour": ["station_complex_index", "payment_method_index"],
+    "hour_time_cols": ["station_complex_index", "payment_method_index"],
+    "hour_lags": ["station_complex_index", "payment_method_index"],
+    "hour_model": ["station_complex_index", "payment_method_index"],
+}
+
+lag_count = 24
+
+
+def relevant_data_sql(source):
+    # nyc is typed (TIMESTAMP, FLOAT64), so no parsing or casting is needed
+    return f"""
+    SELECT
+        transit_timestamp,
         transit_mode,
         station_complex,
         borough,
         payment_method,
         fare_class_category,
-        CAST(ridership AS FLOAT64) AS ridership,
-        CAST(transfers AS FLOAT64) AS transfers
-    FROM `lively-encoder-448916-d5.nyc_subway.nyc`;
+        ridership,
+        transfers
+    FROM {source}
     """
 
-    # Execute the query for clean_data
-    query_job_clean_data = client.query(sql_query_clean_data)
-    query_job_clean_data.result()
-    print("Data has been written to the table: lively-encoder-448916-d5.nyc_subway.relevant_data")
 
-    # Step 2: Group the data by relevant columns and save to a new table
-    sql_query_grouped_data = """
-    CREATE OR REPLACE TABLE `lively-encoder-448916-d5.nyc_subway.pm_grouped` AS
-    SELECT 
+def grouped_sql(source):
+    return f"""
+    SELECT
         transit_timestamp,
         transit_mode,
         station_complex,
@@ -35,48 +51,19 @@ def run_bigquery_sql():
         payment_method,
         SUM(CAST(ridership AS INT64)) AS ridership,
         SUM(CAST(transfers AS INT64)) AS transfer
-    FROM `lively-encoder-448916-d5.nyc_subway.relevant_data`
-    GROUP BY 
-        transit_timestamp, 
-        transit_mode, 
-        station_complex, 
-        borough, 
-        payment_method;
-    """
-
-     # Execute the query for grouped_data
-    query_job_grouped_data = client.query(sql_query_grouped_data)
-    query_job_grouped_data.result()
-    print("Data has been written to the table: lively-encoder-448916-d5.nyc_subway.pm_grouped")
-
-    # Step 3: Ordinal encode categorical columns and save to a new table
-    sql_query_ordinal_encoded = """
-    CREATE OR REPLACE TABLE `lively-encoder-448916-d5.nyc_subway.original_encoded_cols_data` AS
-    SELECT 
+    FROM {source}
+    GROUP BY
         transit_timestamp,
-        ridership,
-        transfer,
-        -- Use DENSE_RANK() for ordinal encoding
         transit_mode,
-        DENSE_RANK() OVER (ORDER BY transit_mode) AS transit_mode_index,
         station_complex,
-        DENSE_RANK() OVER (ORDER BY station_complex) AS station_complex_index,
         borough,
-        DENSE_RANK() OVER (ORDER BY borough) AS borough_index,
-        payment_method,
-        DENSE_RANK() OVER (ORDER BY payment_method) AS payment_method_index
-    FROM `lively-encoder-448916-d5.nyc_subway.pm_grouped`;
+        payment_method
     """
-    # Execute the query for ordinal_encoded
-    query_job_ordinal_encoded = client.query(sql_query_ordinal_encoded)
-    query_job_ordinal_encoded.result()
-    print("Data has been written to the table: lively-encoder-448916-d5.nyc_subway.original_encoded_cols_data")
-
-#Step 4:
-   # SQL Query to create the `encoded_hour` table with encoded columns
-    sql_query_encoded_hour = """
-    CREATE OR REPLACE TABLE `lively-encoder-448916-d5.nyc_subway.encoded_hour` AS
-    SELECT 
+
+
+def encoded_hour_sql(source):
+    return f"""
+    SELECT
         transit_timestamp,
         ridership,
         transfer,
@@ -84,18 +71,13 @@ def run_bigquery_sql():
         station_complex_index,
         borough_index,
         payment_method_index
-    FROM `lively-encoder-448916-d5.nyc_subway.original_encoded_cols_data`;
+    FROM {source}
     """
 
-    # Execute the query for encoded_hour
-    query_job_encoded_hour = client.query(sql_query_encoded_hour)
-    query_job_encoded_hour.result()
-    print("Encoded columns have been written to the table: lively-encoder-448916-d5.nyc_subway.encoded_hour")
 
-    # Step 4: Drop original columns and keep only encoded columns in a new table
-    #Extract time-based features and compute sine/cosine transformations simultaneously
-    sql_query_hour_time_cols = """
-    CREATE OR REPLACE TABLE `lively-encoder-448916-d5.nyc_subway.hour_time_cols` AS
+def hour_time_cols_sql(source):
+    # Extract time-based features and compute sine/cosine transformations simultaneously
+    return f"""
     SELECT *,
     EXTRACT(HOUR FROM transit_timestamp) AS hour_of_day,
     SIN(2 * ACOS(-1) * EXTRACT(HOUR FROM transit_timestamp) / 24) AS hour_of_day_sin,
@@ -106,271 +88,145 @@ def run_bigquery_sql():
     CEIL(EXTRACT(DAY FROM transit_timestamp) / 7) AS week_of_month,
     SIN(2 * ACOS(-1) * CEIL(EXTRACT(DAY FROM transit_timestamp) / 7) / 5) AS week_of_month_sin,
     COS(2 * ACOS(-1) * CEIL(EXTRACT(DAY FROM transit_timestamp) / 7) / 5) AS week_of_month_cos
-    FROM `lively-encoder-448916-d5.nyc_subway.encoded_hour`;
+    FROM {source}
     """
 
-    # Execute the query for hour_time_cols
-    query_job_hour_time_cols = client.query(sql_query_hour_time_cols)
-    query_job_hour_time_cols.result()
-    print("Time-based features have been written to the table: lively-encoder-448916-d5.nyc_subway.hour_time_cols")
-
-
-    # Step 5: Compute lags and filter rows with NULL lags
-    sql_query_lags = """
-    CREATE OR REPLACE TABLE `lively-encoder-448916-d5.nyc_subway.hour_lags` AS
-    WITH lagged_data AS (
-        SELECT
-            *,
-            LAG(ridership, 1) OVER (
-                PARTITION BY transit_mode_index, station_complex_index, borough_index, payment_method_index 
-                ORDER BY transit_timestamp
-            ) AS ridership_lag_1,
-            LAG(ridership, 2) OVER (
-                PARTITION BY transit_mode_index, station_complex_index, borough_index, payment_method_index 
-                ORDER BY transit_timestamp
-            ) AS ridership_lag_2,
-            LAG(ridership, 3) OVER (
-                PARTITION BY transit_mode_index, station_complex_index, borough_index, payment_method_index 
-                ORDER BY transit_timestamp
-            ) AS ridership_lag_3,
-            LAG(ridership, 4) OVER (
-                PARTITION BY transit_mode_index, station_complex_index, borough_index, payment_method_index 
-                ORDER BY transit_timestamp
-            ) AS ridership_lag_4,
-            LAG(ridership, 5) OVER (
-                PARTITION BY transit_mode_index, station_complex_index, borough_index, payment_method_index 
-                ORDER BY transit_timestamp
-            ) AS ridership_lag_5,
-            LAG(ridership, 6) OVER (
-                PARTITION BY transit_mode_index, station_complex_index, borough_index, payment_method_index 
-                ORDER BY transit_timestamp
-            ) AS ridership_lag_6,
-            LAG(ridership, 7) OVER (
-                PARTITION BY transit_mode_index, station_complex_index, borough_index, payment_method_index 
-                ORDER BY transit_timestamp
-            ) AS ridership_lag_7,
-            LAG(ridership, 8) OVER (
-                PARTITION BY transit_mode_index, station_complex_index, borough_index, payment_method_index 
-                ORDER BY transit_timestamp
-            ) AS ridership_lag_8,
-            LAG(ridership, 9) OVER (
-                PARTITION BY transit_mode_index, station_complex_index, borough_index, payment_method_index 
-                ORDER BY transit_timestamp
-            ) AS ridership_lag_9,
-            LAG(ridership, 10) OVER (
-                PARTITION BY transit_mode_index, station_complex_index, borough_index, payment_method_index 
-                ORDER BY transit_timestamp
-            ) AS ridership_lag_10,
-            LAG(ridership, 11) OVER (
-                PARTITION BY transit_mode_index, station_complex_index, borough_index, payment_method_index 
-                ORDER BY transit_timestamp
-            ) AS ridership_lag_11,
-            LAG(ridership, 12) OVER (
-                PARTITION BY transit_mode_index, station_complex_index, borough_index, payment_method_index 
-                ORDER BY transit_timestamp
-            ) AS ridership_lag_12,
-            LAG(ridership, 13) OVER (
-                PARTITION BY transit_mode_index, station_complex_index, borough_index, payment_method_index 
-                ORDER BY transit_timestamp
-            ) AS ridership_lag_13,
-            LAG(ridership, 14) OVER (
-                PARTITION BY transit_mode_index, station_complex_index, borough_index, payment_method_index 
-                ORDER BY transit_timestamp
-            ) AS ridership_lag_14,
-            LAG(ridership, 15) OVER (
-                PARTITION BY transit_mode_index, station_complex_index, borough_index, payment_method_index 
-                ORDER BY transit_timestamp
-            ) AS ridership_lag_15,
-            LAG(ridership, 16) OVER (
-                PARTITION BY transit_mode_index, station_complex_index, borough_index, payment_method_index 
-                ORDER BY transit_timestamp
-            ) AS ridership_lag_16,
-            LAG(ridership, 17) OVER (
-                PARTITION BY transit_mode_index, station_complex_index, borough_index, payment_method_index 
-                ORDER BY transit_timestamp
-            ) AS ridership_lag_17,
-            LAG(ridership, 18) OVER (
-                PARTITION BY transit_mode_index, station_complex_index, borough_index, payment_method_index 
-                ORDER BY transit_timestamp
-            ) AS ridership_lag_18,
-            LAG(ridership, 19) OVER (
-                PARTITION BY transit_mode_index, station_complex_index, borough_index, payment_method_index 
-                ORDER BY transit_timestamp
-            ) AS ridership_lag_19,
-            LAG(ridership, 20) OVER (
-                PARTITION BY transit_mode_index, station_complex_index, borough_index, payment_method_index 
-                ORDER BY transit_timestamp
-            ) AS ridership_lag_20,
-            LAG(ridership, 21) OVER (
-                PARTITION BY transit_mode_index, station_complex_index, borough_index, payment_method_index 
-                ORDER BY transit_timestamp
-            ) AS ridership_lag_21,
-            LAG(ridership, 22) OVER (
-                PARTITION BY transit_mode_index, station_complex_index, borough_index, payment_method_index 
-                ORDER BY transit_timestamp
-            ) AS ridership_lag_22,
-            LAG(ridership, 23) OVER (
-                PARTITION BY transit_mode_index, station_complex_index, borough_index, payment_method_index 
-                ORDER BY transit_timestamp
-            ) AS ridership_lag_23,
-            LAG(ridership, 24) OVER (
-                PARTITION BY transit_mode_index, station_complex_index, borough_index, payment_method_index 
-                ORDER BY transit_timestamp
-            ) AS ridership_lag_24
-        FROM `lively-encoder-448916-d5.nyc_subway.hour_time_cols`
-    )
-    SELECT *
-    FROM lagged_data
-    WHERE 
-        -- Drop rows where any of the lag columns is NULL
-        ARRAY_LENGTH(REGEXP_EXTRACT_ALL(TO_JSON_STRING(lagged_data), r'"ridership_lag_\d+":null')) = 0
+
+def hour_lags_sql(source):
+    # Compute lags and drop rows with fewer than lag_count previous ridership values
+    return lag_features_sql(source, lag_count, "transit_timestamp", series_columns=series_columns)
+
+
+def hour_model_sql(source):
+    # Compute moving averages over the previous rows and drop rows where any of them is NULL
+    return moving_averages_sql(source, "transit_timestamp", columns=hourly_calendar_mv_columns, series_columns=series_columns)
+
+
+def build_steps(runner):
+    """Tables of the hourly chain in order; the encoding joins the runner's code tables."""
+    return [
+        Step("relevant_data", relevant_data_sql),
+        Step("pm_grouped", grouped_sql, ["transit_timestamp"] + category_columns),
+        Step("original_encoded_cols_data", partial(encode_sql, runner), ["transit_timestamp"] + category_columns),
+        Step("encoded_hour", encoded_hour_sql, ["transit_timestamp"] + series_columns),
+        Step("hour_time_cols", hour_time_cols_sql, ["transit_timestamp"] + series_columns),
+        Step("hour_lags", hour_lags_sql, ["transit_timestamp"] + series_columns, lookback_rows=lag_count),
+        Step("hour_model", hour_model_sql, ["transit_timestamp"] + series_columns,
+             lookback_rows=max(moving_average_horizons)),
+    ]
+
+
+# Tables read outside this chain: the daily preprocessing and the prediction/forecast
+# inputs. The other steps only exist as CTEs when fused.
+checkpoints = ["encoded_hour", "hour_model"]
+
+
+def run_bigquery_sql(runner=None, mode="full", lookback_days=14, checkpoints=checkpoints):
     """
+    Build the hourly feature tables, from nyc down to hour_model.
 
-    # Execute the query for lags
-    query_job_lags = client.query(sql_query_lags)
-    query_job_lags.result()
-    print("Data has been written to the table: lively-encoder-448916-d5.nyc_subway.hour_lags")
-
-    # Step 6: Compute moving averages and write to a new table
-    sql_query_moving_avg = """
-    CREATE OR REPLACE TABLE `lively-encoder-448916-d5.nyc_subway.hour_model` AS
-    WITH moving_avg_data AS (
-        SELECT 
-            *,
-            -- 7-day moving average
-            AVG(ridership) OVER (
-                PARTITION BY station_complex_index, transit_mode_index, borough_index, payment_method_index
-                ORDER BY UNIX_SECONDS(transit_timestamp)
-                ROWS BETWEEN 7 PRECEDING AND 1 PRECEDING
-            ) AS ridership_7d_mv,
-            AVG(hour_of_day) OVER (
-                PARTITION BY station_complex_index, transit_mode_index, borough_index, payment_method_index
-                ORDER BY UNIX_SECONDS(transit_timestamp)
-                ROWS BETWEEN 7 PRECEDING AND 1 PRECEDING
-            ) AS hour_of_day_7d_mv,
-            AVG(day_of_week) OVER (
-                PARTITION BY station_complex_index, transit_mode_index, borough_index, payment_method_index
-                ORDER BY UNIX_SECONDS(transit_timestamp)
-                ROWS BETWEEN 7 PRECEDING AND 1 PRECEDING
-            ) AS day_of_week_7d_mv,
-            AVG(week_of_month) OVER (
-                PARTITION BY station_complex_index, transit_mode_index, borough_index, payment_method_index
-                ORDER BY UNIX_SECONDS(transit_timestamp)
-                ROWS BETWEEN 7 PRECEDING AND 1 PRECEDING
-            ) AS week_of_month_7d_mv,
-            AVG(hour_of_day_sin) OVER (
-                PARTITION BY station_complex_index, transit_mode_index, borough_index, payment_method_index
-                ORDER BY UNIX_SECONDS(transit_timestamp)
-                ROWS BETWEEN 7 PRECEDING AND 1 PRECEDING
-            ) AS hour_of_day_sin_7d_mv,
-            AVG(hour_of_day_cos) OVER (
-                PARTITION BY station_complex_index, transit_mode_index, borough_index, payment_method_index
-                ORDER BY UNIX_SECONDS(transit_timestamp)
-                ROWS BETWEEN 7 PRECEDING AND 1 PRECEDING
-            ) AS hour_of_day_cos_7d_mv,
-            AVG(day_of_week_sin) OVER (
-                PARTITION BY station_complex_index, transit_mode_index, borough_index, payment_method_index
-                ORDER BY UNIX_SECONDS(transit_timestamp)
-                ROWS BETWEEN 7 PRECEDING AND 1 PRECEDING
-            ) AS day_of_week_sin_7d_mv,
-            AVG(day_of_week_cos) OVER (
-                PARTITION BY station_complex_index, transit_mode_index, borough_index, payment_method_index
-                ORDER BY UNIX_SECONDS(transit_timestamp)
-                ROWS BETWEEN 7 PRECEDING AND 1 PRECEDING
-            ) AS day_of_week_cos_7d_mv,
-            AVG(week_of_month_sin) OVER (
-                PARTITION BY station_complex_index, transit_mode_index, borough_index, payment_method_index
-                ORDER BY UNIX_SECONDS(transit_timestamp)
-                ROWS BETWEEN 7 PRECEDING AND 1 PRECEDING
-            ) AS week_of_month_sin_7d_mv,
-            AVG(week_of_month_cos) OVER (
-                PARTITION BY station_complex_index, transit_mode_index, borough_index, payment_method_index
-                ORDER BY UNIX_SECONDS(transit_timestamp)
-                ROWS BETWEEN 7 PRECEDING AND 1 PRECEDING
-            ) AS week_of_month_cos_7d_mv,
-            -- 30-day moving average
-            AVG(ridership) OVER (
-                PARTITION BY station_complex_index, transit_mode_index, borough_index, payment_method_index
-                ORDER BY UNIX_SECONDS(transit_timestamp)
-                ROWS BETWEEN 30 PRECEDING AND 1 PRECEDING
-            ) AS ridership_30d_mv,
-            AVG(hour_of_day) OVER (
-                PARTITION BY station_complex_index, transit_mode_index, borough_index, payment_method_index
-                ORDER BY UNIX_SECONDS(transit_timestamp)
-                ROWS BETWEEN 30 PRECEDING AND 1 PRECEDING
-            ) AS hour_of_day_30d_mv,
-            AVG(day_of_week) OVER (
-                PARTITION BY station_complex_index, transit_mode_index, borough_index, payment_method_index
-                ORDER BY UNIX_SECONDS(transit_timestamp)
-                ROWS BETWEEN 30 PRECEDING AND 1 PRECEDING
-            ) AS day_of_week_30d_mv,
-            AVG(week_of_month) OVER (
-                PARTITION BY station_complex_index, transit_mode_index, borough_index, payment_method_index
-                ORDER BY UNIX_SECONDS(transit_timestamp)
-                ROWS BETWEEN 30 PRECEDING AND 1 PRECEDING
-            ) AS week_of_month_30d_mv,
-            AVG(hour_of_day_sin) OVER (
-                PARTITION BY station_complex_index, transit_mode_index, borough_index, payment_method_index
-                ORDER BY UNIX_SECONDS(transit_timestamp)
-                ROWS BETWEEN 30 PRECEDING AND 1 PRECEDING
-            ) AS hour_of_day_sin_30d_mv,
-            AVG(hour_of_day_cos) OVER (
-                PARTITION BY station_complex_index, transit_mode_index, borough_index, payment_method_index
-                ORDER BY UNIX_SECONDS(transit_timestamp)
-                ROWS BETWEEN 30 PRECEDING AND 1 PRECEDING
-            ) AS hour_of_day_cos_30d_mv,
-            AVG(day_of_week_sin) OVER (
-                PARTITION BY station_complex_index, transit_mode_index, borough_index, payment_method_index
-                ORDER BY UNIX_SECONDS(transit_timestamp)
-                ROWS BETWEEN 30 PRECEDING AND 1 PRECEDING
-            ) AS day_of_week_sin_30d_mv,
-            AVG(day_of_week_cos) OVER (
-                PARTITION BY station_complex_index, transit_mode_index, borough_index, payment_method_index
-                ORDER BY UNIX_SECONDS(transit_timestamp)
-                ROWS BETWEEN 30 PRECEDING AND 1 PRECEDING
-            ) AS day_of_week_cos_30d_mv,
-            AVG(week_of_month_sin) OVER (
-                PARTITION BY station_complex_index, transit_mode_index, borough_index, payment_method_index
-                ORDER BY UNIX_SECONDS(transit_timestamp)
-                ROWS BETWEEN 30 PRECEDING AND 1 PRECEDING
-            ) AS week_of_month_sin_30d_mv,
-            AVG(week_of_month_cos) OVER (
-                PARTITION BY station_complex_index, transit_mode_index, borough_index, payment_method_index
-                ORDER BY UNIX_SECONDS(transit_timestamp)
-                ROWS BETWEEN 30 PRECEDING AND 1 PRECEDING
-            ) AS week_of_month_cos_30d_mv
-        FROM `lively-encoder-448916-d5.nyc_subway.hour_lags`
-    )
-    -- Drop rows where any moving average column is NULL
-    SELECT *
-    FROM moving_avg_data
-    WHERE ridership_7d_mv IS NOT NULL
-      AND hour_of_day_7d_mv IS NOT NULL
-      AND day_of_week_7d_mv IS NOT NULL
-      AND week_of_month_7d_mv IS NOT NULL
-      AND hour_of_day_sin_7d_mv IS NOT NULL
-      AND hour_of_day_cos_7d_mv IS NOT NULL
-      AND day_of_week_sin_7d_mv IS NOT NULL
-      AND day_of_week_cos_7d_mv IS NOT NULL
-      AND week_of_month_sin_7d_mv IS NOT NULL
-      AND week_of_month_cos_7d_mv IS NOT NULL
-      AND ridership_30d_mv IS NOT NULL
-      AND hour_of_day_30d_mv IS NOT NULL
-      AND day_of_week_30d_mv IS NOT NULL
-      AND week_of_month_30d_mv IS NOT NULL
-      AND hour_of_day_sin_30d_mv IS NOT NULL
-      AND hour_of_day_cos_30d_mv IS NOT NULL
-      AND day_of_week_sin_30d_mv IS NOT NULL
-      AND day_of_week_cos_30d_mv IS NOT NULL
-      AND week_of_month_sin_30d_mv IS NOT NULL
-      AND week_of_month_cos_30d_mv IS NOT NULL
+    The steps between checkpoints run fused into one statement; with `checkpoints=None`
+    every step is materialized as its own table. See pipeline.run_pipeline for the modes.
+
+    Category values without a code get one first. In incremental mode only the nyc rows
+    after the first materialized table's latest hour are looked at: the rows before were
+    coded by the run that processed them.
+    """
+    runner = runner or BigQueryRunner()
+    steps = build_steps(runner)
+    since = None
+    first_table = segments(steps, checkpoints)[0][-1].name
+    if mode == "incremental" and runner.exists(first_table):
+        since = runner.scalar(f"SELECT MAX(transit_timestamp) FROM {runner.table(first_table)}", "category_codes:since")
+    update_codes(runner, "nyc", since)
+    run_pipeline(runner, "nyc", steps, checkpoints, mode, lookback_days, series_columns,
+                 partition_by="DATE(transit_timestamp)", cluster_by=cluster_columns)
+
+
+def check_equivalence(source_parquet, split_timestamp, lookback_days=14, checkpoints=checkpoints):
     """
+    Check locally on DuckDB that an incremental run gives the same tables as a full run.
 
-    # Execute the query for moving averages
-    query_job_moving_avg = client.query(sql_query_moving_avg)
-    query_job_moving_avg.result()
-    print("Data has been written to the table: lively-encoder-448916-d5.nyc_subway.hour_model")
+    The incremental run builds every table from the rows of the Parquet export of nyc up
+    to `split_timestamp` and then processes the rest incrementally; the full run then
+    rebuilds them from all rows, with the category codes the incremental run assigned.
+    """
+    incremental = DuckDBRunner(dataset="incremental_run")
+    full = DuckDBRunner(dataset="full_run", connection=incremental.connection)
+
+    incremental.load_parquet("nyc", source_parquet, where=f"transit_timestamp <= TIMESTAMP '{split_timestamp}'")
+    run_bigquery_sql(incremental, "full", checkpoints=checkpoints)
+    incremental.load_parquet("nyc", source_parquet)
+    incremental.stats = []
+    start = time.time()
+    run_bigquery_sql(incremental, "incremental", lookback_days, checkpoints)
+    report(incremental, "Incremental run", start)
+
+    full.load_parquet("nyc", source_parquet)
+    for column in category_columns:
+        full.run(f"CREATE TABLE {full.table(code_table(column))} AS SELECT * FROM {incremental.table(code_table(column))}")
+    full.stats = []
+    start = time.time()
+    run_bigquery_sql(full, "full", checkpoints=checkpoints)
+    report(full, "Full run", start)
+
+    tables = [segment[-1].name for segment in segments(build_steps(full), checkpoints)]
+    differences = compare_tables(full, "full_run", "incremental_run", tables + [code_table(column) for column in category_columns])
+    for name, count in differences.items():
+        print(f"{name}: {count} differing rows")
+    return all(count == 0 for count in differences.values())
+
+
+def compare_plans(source_parquet, checkpoints=checkpoints):
+    """Run the chain stepwise and fused locally on DuckDB and compare the checkpoint tables."""
+    stepwise = DuckDBRunner(dataset="stepwise_run")
+    fused = DuckDBRunner(dataset="fused_run", connection=stepwise.connection)
+    stepwise.load_parquet("nyc", source_parquet)
+    fused.load_parquet("nyc", source_parquet)
+    stepwise.stats, fused.stats = [], []
+
+    start = time.time()
+    run_bigquery_sql(stepwise, "full", checkpoints=None)
+    report(stepwise, "Stepwise", start)
+    start = time.time()
+    run_bigquery_sql(fused, "full", checkpoints=checkpoints)
+    report(fused, "Fused", start)
+
+    differences = compare_tables(stepwise, "stepwise_run", "fused_run", checkpoints)
+    for name, count in differences.items():
+        print(f"{name}: {count} differing rows")
+    return all(count == 0 for count in differences.values())
 
 
 if __name__ == "__main__":
-    run_bigquery_sql()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Build the hourly feature tables")
+    parser.add_argument("--mode", choices=["full", "incremental"], default="full",
+                        help="Rebuild every table, or only process the hours after each table's latest one")
+    parser.add_argument("--lookback_days", type=int, default=14,
+                        help="Days of partitions read for the lag/moving average lookback (0 reads all history)")
+    parser.add_argument("--stepwise", action="store_true",
+                        help="Materialize every step as its own table instead of fusing the steps between checkpoints")
+    parser.add_argument("--checkpoints", nargs="+", default=checkpoints,
+                        help="Tables materialized when fused (hour_model always is)")
+    parser.add_argument("--check_equivalence", metavar="NYC_PARQUET",
+                        help="Compare full and incremental runs locally on DuckDB, on a Parquet export of nyc")
+    parser.add_argument("--split_timestamp", help="Last transit_timestamp of the initial run of the equivalence check")
+    parser.add_argument("--compare_plans", metavar="NYC_PARQUET",
+                        help="Compare stepwise and fused runs locally on DuckDB, on a Parquet export of nyc")
+
+    args = parser.parse_args()
+    plan_checkpoints = None if args.stepwise else args.checkpoints
+
+    if args.compare_plans:
+        raise SystemExit(0 if compare_plans(args.compare_plans, args.checkpoints) else 1)
+    if args.check_equivalence:
+        if not args.split_timestamp:
+            parser.error("--check_equivalence needs --split_timestamp")
+        equivalent = check_equivalence(args.check_equivalence, args.split_timestamp, args.lookback_days,
+                                       plan_checkpoints)
+        raise SystemExit(0 if equivalent else 1)
+
+    runner = BigQueryRunner()
+    start = time.time()
+    run_bigquery_sql(runner, args.mode, args.lookback_days, plan_checkpoints)
+    report(runner, "Stepwise" if args.stepwise else "Fused", start)
@@ -0,0 +1,179 @@
+# Compile a chain of preprocessing steps into SQL statements and run them.
+#
+# Each step is a SELECT over the output of the previous one. Steps run either one table
+# per step (stepwise) or fused: consecutive steps are composed as CTEs into a single
+# statement and only the checkpoint tables are materialized.
+import time
+from collections import namedtuple
+
+# name: table (or CTE) the step produces
+# build_sql: function(source) -> SELECT over the source table or CTE
+# key_columns: columns identifying a row, used to MERGE new rows (None appends with INSERT)
+# lookback_rows: rows of history per series the step's windows need before the first new row
+Step = namedtuple("Step", ["name", "build_sql", "key_columns", "lookback_rows"], defaults=[None, 0])
+
+
+def timestamp_literal(value):
+    return f"TIMESTAMP '{value.strftime('%Y-%m-%d %H:%M:%S.%f')}'"
+
+
+def fused_sql(steps, source):
+    """Compose steps as CTEs into one SELECT over the source, returning the last step's rows."""
+    ctes = []
+    for step in steps:
+        ctes.append(f"{step.name} AS ({step.build_sql(source)})")
+        source = step.name
+    return "WITH " + ",\n".join(ctes) + f"\nSELECT * FROM {source}"
+
+
+def segments(steps, checkpoints=None):
+    """
+    Split steps into the runs of steps ending at a materialized table.
+
+    Without checkpoints every step is materialized (stepwise); the last step always is.
+    """
+    segments, current = [], []
+    for position, step in enumerate(steps):
+        current.append(step)
+        if checkpoints is None or step.name in checkpoints or position == len(steps) - 1:
+            segments.append(current)
+            current = []
+    return segments
+
+
+def create_table_sql(target, select_sql, partition_by=None, cluster_by=None):
+    """CREATE OR REPLACE a table from a SELECT, partitioned and clustered if given."""
+    options = ""
+    if partition_by:
+        options += f"\n    PARTITION BY {partition_by}"
+    if cluster_by:
+        options += f"\n    CLUSTER BY {', '.join(cluster_by)}"
+    return f"""
+    CREATE OR REPLACE TABLE {target}{options} AS
+    {select_sql};
+    """
+
+
+def new_rows_sql(source, watermark, series_columns, history_rows=0, lookback_days=None,
+                 time_column="transit_timestamp"):
+    """
+    Rows of a source table after a watermark, preceded for windowed steps by the last
+    `history_rows` rows of each series up to the watermark.
+
+    `lookback_days` bounds the history read to the partitions of the last days before the
+    watermark; a series with a longer gap than that loses the rows it would have needed.
+    """
+    after = f"{time_column} > {timestamp_literal(watermark)}"
+    if not history_rows:
+        return f"(SELECT * FROM {source} WHERE {after})"
+    bound = ""
+    if lookback_days:
+        bound = f"\n          AND {time_column} > TIMESTAMP_SUB({timestamp_literal(watermark)}, INTERVAL {lookback_days} DAY)"
+    return f"""(
+        SELECT * FROM (
+            SELECT * FROM {source}
+            WHERE {time_column} <= {timestamp_literal(watermark)}{bound}
+            QUALIFY ROW_NUMBER() OVER (PARTITION BY {', '.join(series_columns)} ORDER BY {time_column} DESC) <= {history_rows}
+        )
+        UNION ALL
+        SELECT * FROM {source} WHERE {after}
+    )"""
+
+
+def merge_sql(target, select_sql, columns, key_columns, watermark, time_column="transit_timestamp"):
+    """MERGE the rows of a SELECT after the watermark into a table, skipping rows already there."""
+    after = f"{time_column} > {timestamp_literal(watermark)}"
+    if key_columns is None:
+        return f"""
+    INSERT INTO {target} ({', '.join(columns)})
+    SELECT {', '.join(columns)} FROM ({select_sql}) WHERE {after};
+    """
+    condition = " AND ".join(f"T.{column} = S.{column}" for column in key_columns)
+    return f"""
+    MERGE INTO {target} AS T
+    USING (
+        SELECT * FROM ({select_sql}) WHERE {after}
+    ) AS S
+    ON {condition}
+    WHEN NOT MATCHED THEN
+        INSERT ({', '.join(columns)}) VALUES ({', '.join('S.' + column for column in columns)});
+    """
+
+
+def _incremental_select(segment, source, watermark, series_columns, lookback_days, time_column):
+    """SELECT computing the new rows of a segment's table from the new rows of its source."""
+    history_rows = sum(step.lookback_rows for step in segment)
+    new_rows = new_rows_sql(source, watermark, series_columns, history_rows, lookback_days, time_column)
+    return fused_sql(segment, new_rows)
+
+
+def run_pipeline(runner, source_name, steps, checkpoints=None, mode="full", lookback_days=None,
+                 series_columns=(), time_column="transit_timestamp", partition_by=None, cluster_by=None):
+    """
+    Run steps from a source table, materializing the checkpoint tables (every step if None).
+
+    In full mode every materialized table is rebuilt from the entire history. In
+    incremental mode each one only gets the rows after its own latest `time_column`
+    (so an interrupted run resumes where it stopped), computed from the new rows of its
+    source plus the last rows of each series its windowed steps need as lookback. A table
+    that does not exist yet is created in full.
+
+    `cluster_by` maps table names to their cluster columns.
+    """
+    source = runner.table(source_name)
+    for segment in segments(steps, checkpoints):
+        last = segment[-1]
+        if mode == "incremental" and source == runner.table(source_name) \
+                and any(step.lookback_rows for step in segment):
+            raise ValueError(f"Windowed steps need a checkpoint before them to run incrementally: {last.name}")
+
+        target = runner.table(last.name)
+        cluster = (cluster_by or {}).get(last.name)
+        watermark = None
+        if mode == "incremental" and runner.exists(last.name):
+            watermark = runner.scalar(f"SELECT MAX({time_column}) FROM {target}", f"{last.name}:watermark")
+
+        if watermark is None:
+            runner.run(create_table_sql(target, fused_sql(segment, source), partition_by, cluster), last.name)
+            print(f"Data has been written to the table: {target}")
+        else:
+            select_sql = _incremental_select(segment, source, watermark, series_columns, lookback_days, time_column)
+            runner.run(merge_sql(target, select_sql, runner.columns(last.name), last.key_columns, watermark,
+                                 time_column), last.name)
+            print(f"Rows after {watermark} have been merged into the table: {target}")
+        source = target
+
+
+def compare_tables(runner, expected_dataset, actual_dataset, tables, digits=9):
+    """
+    Count the rows that differ between two copies of each table, in either direction.
+
+    Floating point columns are compared rounded to `digits` decimals, since window
+    averages over the same rows may be summed in a different order.
+    """
+    differences = {}
+    for name in tables:
+        columns = ", ".join(
+            f"ROUND({column}, {digits}) AS {column}" if column_type in ("FLOAT", "FLOAT64", "DOUBLE") else column
+            for column, column_type in runner.column_types(name).items()
+        )
+        expected = f"SELECT {columns} FROM `{expected_dataset}.{name}`"
+        actual = f"SELECT {columns} FROM `{actual_dataset}.{name}`"
+        differences[name] = runner.scalar(f"""
+        SELECT (SELECT COUNT(*) FROM ({expected} EXCEPT DISTINCT {actual}))
+             + (SELECT COUNT(*) FROM ({actual} EXCEPT DISTINCT {expected}))
+        """)
+    return differences
+
+
+def report(runner, title, start):
+    """Print the statements, wall clock and, on BigQuery, bytes processed and slot time of a run."""
+    stats = runner.stats
+    totals = f"{title}: {len(stats)} statements, {time.time() - start:.2f}s wall clock"
+    if any("bytes_processed" in stat for stat in stats):
+        totals += (f", {sum(stat.get('bytes_processed', 0) for stat in stats)} bytes processed"
+                   f", {sum(stat.get('slot_millis', 0) for stat in stats)} slot ms")
+    print(totals)
+    for stat in stats:
+        print(f"  {stat['statement']}: {stat['seconds']}s"
+              + (f", {stat['bytes_processed']} bytes, {stat['slot_millis']} slot ms" if "bytes_processed" in stat else ""))
@@ -0,0 +1,104 @@
+# Execute the preprocessing SQL on BigQuery, or on a local DuckDB stand-in.
+#
+# The SQL is written in BigQuery's dialect; the local runner transpiles it to DuckDB
+# with sqlglot, so the same statements can be run and compared offline:
+#     pip install duckdb sqlglot
+import time
+
+
+class BigQueryRunner:
+    """Run SQL on BigQuery and keep track of the bytes processed and slot time per statement."""
+
+    def __init__(self, dataset="lively-encoder-448916-d5.nyc_subway", client=None):
+        from google.cloud import bigquery
+
+        self.dataset = dataset
+        self.client = client or bigquery.Client()
+        self.stats = []
+
+    def table(self, name):
+        return f"`{self.dataset}.{name}`"
+
+    def run(self, sql, label=None):
+        start = time.time()
+        job = self.client.query(sql)
+        job.result()
+        self.stats.append({"statement": label, "bytes_processed": job.total_bytes_processed or 0,
+                           "slot_millis": job.slot_millis or 0, "seconds": round(time.time() - start, 3)})
+        return job
+
+    def scalar(self, sql, label=None):
+        rows = list(self.run(sql, label).result())
+        return rows[0][0] if rows else None
+
+    def fetch(self, sql):
+        return [tuple(row.values()) for row in self.run(sql).result()]
+
+    def exists(self, name):
+        try:
+            self.client.get_table(f"{self.dataset}.{name}")
+            return True
+        except Exception:
+            return False
+
+    def columns(self, name):
+        return [field.name for field in self.client.get_table(f"{self.dataset}.{name}").schema]
+
+    def column_types(self, name):
+        return {field.name: field.field_type for field in self.client.get_table(f"{self.dataset}.{name}").schema}
+
+
+class DuckDBRunner:
+    """Run the BigQuery SQL on a local DuckDB database, transpiled with sqlglot."""
+
+    def __init__(self, database=":memory:", dataset="nyc_subway", connection=None):
+        import duckdb
+        import sqlglot
+
+        self.sqlglot = sqlglot
+        self.dataset = dataset
+        # Runners sharing a connection see each other's tables, e.g. to compare two runs
+        self.connection = connection or duckdb.connect(database)
+        self.connection.execute("SET TimeZone = 'UTC'")
+        self.connection.execute(f"CREATE SCHEMA IF NOT EXISTS {dataset}")
+        self.stats = []
+
+    def table(self, name):
+        return f"`{self.dataset}.{name}`"
+
+    def run(self, sql, label=None):
+        start = time.time()
+        result = None
+        # PARTITION BY / CLUSTER BY have no DuckDB equivalent and are dropped
+        statements = self.sqlglot.transpile(sql, read="bigquery", write="duckdb",
+                                            unsupported_level=self.sqlglot.ErrorLevel.IGNORE)
+        for statement in statements:
+            result = self.connection.execute(statement)
+        self.stats.append({"statement": label, "seconds": round(time.time() - start, 3)})
+        return result
+
+    def scalar(self, sql, label=None):
+        row = self.run(sql, label).fetchone()
+        return row[0] if row else None
+
+    def exists(self, name):
+        return self.connection.execute(
+            "SELECT COUNT(*) FROM information_schema.tables WHERE table_schema = ? AND table_name = ?",
+            [self.dataset, name]
+        ).fetchone()[0] > 0
+
+    def columns(self, name):
+        return [row[0] for row in self.connection.execute(f"DESCRIBE {self.dataset}.{name}").fetchall()]
+
+    def column_types(self, name):
+        return {row[0]: row[1] for row in self.connection.execute(f"DESCRIBE {self.dataset}.{name}").fetchall()}
+
+    def load_parquet(self, name, path, where=None):
+        """Create a table from local Parquet files, e.g. an export of the gold table."""
+        self.connection.execute(
+            f"CREATE OR REPLACE TABLE {self.dataset}.{name} AS SELECT * FROM read_parquet('{path}')"
+            + (f" WHERE {where}" if where else "")
+        )
+
+    def fetch(self, sql):
+        return self.run(sql).fetchall()
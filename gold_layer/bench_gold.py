@@ -0,0 +1,94 @@
+# Local Spark benchmark of the gold sync with the anti-join: the new records evaluated
+# for the count and each of the two table writes (former) against staged once and
+# loaded into both tables from the staged files (current). Parquet sinks stand in
+# for the BigQuery tables. Prints the wall clock and Spark jobs of both as JSON, e.g.
+#   PYTHONPATH=../silver_layer python bench_gold.py --rows 5000000 --new_fraction 0.05
+# (the silver modules are shipped with --py-files on the cluster).
+import argparse
+import json
+import shutil
+import tempfile
+import time
+
+from pyspark.sql import SparkSession
+from pyspark.sql import functions as F
+
+from spark_bq import ParquetSink, anti_join_new_records, remove_staged_records, stage_records
+
+
+def generate_rows(spark, rows, path):
+    """Write rows with a unique key (one per station and hour) to Parquet and read them back."""
+    n = F.col("id")
+    spark.range(rows).select(
+        F.timestamp_seconds(F.lit(1577836800) + (n / 428).cast("long") * 3600).alias("transit_timestamp"),
+        (n % 428 + 1).cast("string").alias("station_complex_id"),
+        F.when(n % 2 == 0, "omny").otherwise("metrocard").alias("payment_method"),
+        F.lit("OMNY - Full Fare").alias("fare_class_category"),
+        (n % 97 + 1).cast("double").alias("ridership"),
+    ).write.parquet(path)
+    return spark.read.parquet(path)
+
+
+def run(spark, name, step):
+    """Run step under its own job group and return its wall clock and Spark job count."""
+    sc = spark.sparkContext
+    sc.setJobGroup(f"bench:{name}", name)
+    start = time.time()
+    try:
+        result = step()
+    finally:
+        seconds = time.time() - start
+        sc.setLocalProperty("spark.jobGroup.id", None)
+    jobs = len(sc.statusTracker().getJobIdsForGroup(f"bench:{name}"))
+    return {"variant": name, "seconds": round(seconds, 3), "jobs": jobs, "new_records": result}
+
+
+def main(rows, new_fraction):
+    spark = SparkSession.builder \
+        .master("local[*]") \
+        .appName("BenchGold") \
+        .config("spark.sql.parquet.outputTimestampType", "TIMESTAMP_MICROS") \
+        .getOrCreate()
+    workdir = tempfile.mkdtemp(prefix="bench_gold_")
+    try:
+        delta_df = generate_rows(spark, rows, f"{workdir}/delta")
+        # The sinks already hold the earliest hours, so the latest new_fraction of the rows is new
+        synced_hours = int(rows * (1 - new_fraction)) // 428
+        synced = delta_df.where(F.col("transit_timestamp") < F.timestamp_seconds(F.lit(1577836800 + synced_hours * 3600)))
+
+        sinks = {}
+        for name in ["former", "current"]:
+            sinks[name] = (ParquetSink(spark, f"{workdir}/{name}/main"), ParquetSink(spark, f"{workdir}/{name}/incr"))
+            synced.write.parquet(sinks[name][0].table)
+
+        def former():
+            main_sink, incr_sink = sinks["former"]
+            new_records_df = anti_join_new_records(delta_df, main_sink.read())
+            new_records_count = new_records_df.count()
+            main_sink.write(new_records_df, "append")
+            incr_sink.write(new_records_df, "overwrite")
+            return new_records_count
+
+        def current():
+            main_sink, incr_sink = sinks["current"]
+            staging_path = f"{workdir}/current/_staging"
+            new_records_count = stage_records(spark, anti_join_new_records(delta_df, main_sink.read()), staging_path)
+            main_sink.load_staged(staging_path, "append")
+            incr_sink.load_staged(staging_path, "overwrite")
+            remove_staged_records(spark, staging_path)
+            return new_records_count
+
+        results = [run(spark, "former", former), run(spark, "current", current)]
+        print(json.dumps({"rows": rows, "new_fraction": new_fraction, "variants": results}, indent=2))
+    finally:
+        spark.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the gold anti-join sync on generated rows in local Spark")
+    parser.add_argument("--rows", type=int, default=5000000, help="Number of rows in the generated Delta table")
+    parser.add_argument("--new_fraction", type=float, default=0.05, help="Fraction of the rows not yet in the sink")
+    args = parser.parse_args()
+
+    main(args.rows, args.new_fraction)
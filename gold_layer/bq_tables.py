@@ -0,0 +1,171 @@
+# DDL and write options of the gold BigQuery tables, derived from schemas/ridership_schema.json.
+# Pure Python, so it also runs as a local harness: python bq_tables.py --project p --dataset d
+import argparse
+import json
+import os
+import sys
+
+_here = os.path.dirname(os.path.abspath(__file__))
+
+ridership_schema_path = os.environ.get(
+    "RIDERSHIP_SCHEMA_PATH",
+    next(
+        (path for path in [
+            os.path.join(_here, "ridership_schema.json"),
+            os.path.join(_here, "..", "schemas", "ridership_schema.json"),
+            "ridership_schema.json",
+        ] if os.path.exists(path)),
+        os.path.join(_here, "ridership_schema.json")
+    )
+)
+
+partition_column = "transit_timestamp"
+cluster_columns = ["station_complex_id", "payment_method"]
+
+# Natural key of a ridership row, the same as the key of the silver Delta merge
+key_columns = ["transit_timestamp", "station_complex_id", "payment_method", "fare_class_category"]
+
+# Tables next to the main table that hold the staged changes while they are merged
+upserts_table_suffix = "_upserts"
+deletes_table_suffix = "_deletes"
+
+_standard_sql_types = {
+    "STRING": "STRING",
+    "FLOAT": "FLOAT64",
+    "FLOAT64": "FLOAT64",
+    "INTEGER": "INT64",
+    "INT64": "INT64",
+    "BOOLEAN": "BOOL",
+    "BOOL": "BOOL",
+    "TIMESTAMP": "TIMESTAMP",
+    "DATE": "DATE",
+}
+
+
+def load_gold_fields(schema_path=ridership_schema_path):
+    """Read the fields of the gold tables from the ridership JSON schema."""
+    with open(schema_path) as f:
+        return json.load(f)
+
+
+def column_type(field):
+    """Standard SQL type of a JSON schema field."""
+    if field["type"] == "RECORD":
+        subfields = field.get("fields", [])
+        # Parquet LIST columns appear as RECORD<list REPEATED RECORD<element>>; store them as ARRAY
+        if len(subfields) == 1 and subfields[0]["name"] == "list" and subfields[0]["mode"] == "REPEATED":
+            return f"ARRAY<{column_type(subfields[0]['fields'][0])}>"
+        sql_type = "STRUCT<" + ", ".join(f"{sub['name']} {column_type(sub)}" for sub in subfields) + ">"
+    else:
+        sql_type = _standard_sql_types[field["type"]]
+    if field.get("mode") == "REPEATED":
+        return f"ARRAY<{sql_type}>"
+    return sql_type
+
+
+def create_table_ddl(table, fields, partitioned=True, clustered=True):
+    """CREATE TABLE IF NOT EXISTS statement of a gold table."""
+    columns = ",\n".join(f"  {field['name']} {column_type(field)}" for field in fields)
+    ddl = f"CREATE TABLE IF NOT EXISTS `{table}` (\n{columns}\n)"
+    if partitioned:
+        ddl += f"\nPARTITION BY DATE({partition_column})"
+    if clustered:
+        ddl += f"\nCLUSTER BY {', '.join(cluster_columns)}"
+    return ddl + ";"
+
+
+def key_condition(target="target", source="source"):
+    """Join condition of two tables on the natural key."""
+    return " AND ".join(f"{target}.{column} = {source}.{column}" for column in key_columns)
+
+
+def merge_upserts_sql(table, source, fields):
+    """MERGE statement that updates the rows of a gold table matching a source on the key and inserts the others."""
+    updates = ",\n    ".join(f"{field['name']} = source.{field['name']}"
+                              for field in fields if field["name"] not in key_columns)
+    return (
+        f"MERGE `{table}` AS target\n"
+        f"USING `{source}` AS source\n"
+        f"ON {key_condition()}\n"
+        f"WHEN MATCHED THEN UPDATE SET\n    {updates}\n"
+        f"WHEN NOT MATCHED THEN INSERT ROW;"
+    )
+
+
+def delete_keys_sql(table, source):
+    """DELETE statement that removes the rows of a gold table whose key is in a source table."""
+    return (
+        f"DELETE FROM `{table}` AS target\n"
+        f"WHERE EXISTS (SELECT 1 FROM `{source}` AS source WHERE {key_condition()});"
+    )
+
+
+def write_options(table, write_method="direct", temporary_gcs_bucket=None, partitioned=True, clustered=True):
+    """Options of the Spark BigQuery connector for writing a gold table."""
+    options = {"table": table, "writeMethod": write_method}
+    if write_method == "indirect":
+        if not temporary_gcs_bucket:
+            raise ValueError("The indirect write method needs a temporary GCS bucket")
+        options.update({
+            "temporaryGcsBucket": temporary_gcs_bucket,
+            "intermediateFormat": "parquet",
+            "enableListInference": "true",
+        })
+        # Only used when the connector creates the table
+        if partitioned:
+            options.update({"partitionField": partition_column, "partitionType": "DAY"})
+        if clustered:
+            options["clusteredFields"] = ",".join(cluster_columns)
+    return options
+
+
+def check_tables(fields):
+    """
+    Check that the partition and cluster columns exist with usable types.
+
+    Returns:
+    - list: problems found, empty if the table definition is valid.
+    """
+    types = {field["name"]: column_type(field) for field in fields}
+    problems = []
+    if types.get(partition_column) not in ("TIMESTAMP", "DATE"):
+        problems.append(f"Partition column {partition_column} has type {types.get(partition_column)}, not TIMESTAMP/DATE")
+    for column in key_columns:
+        if column not in types:
+            problems.append(f"Key column {column} is not in the schema")
+    for column in cluster_columns:
+        if column not in types:
+            problems.append(f"Cluster column {column} is not in the schema")
+        elif types[column].startswith(("ARRAY", "STRUCT")) or types[column] == "FLOAT64":
+            problems.append(f"Cluster column {column} has type {types[column]}, which cannot be clustered")
+    return problems
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Print and check the DDL and write options of the gold tables")
+    parser.add_argument("--project", default="PROJECT")
+    parser.add_argument("--dataset", default="DATASET")
+    parser.add_argument("--table", default="nyc")
+    parser.add_argument("--incremental_table", default="inc_nyc")
+    parser.add_argument("--write_method", choices=["direct", "indirect"], default="direct")
+    parser.add_argument("--temporary_gcs_bucket", default="TEMP_BUCKET")
+    parser.add_argument("--ddl_only", action="store_true", help="Only print the DDL (e.g. to pipe into bq query)")
+
+    args = parser.parse_args()
+
+    fields = load_gold_fields()
+    problems = check_tables(fields)
+    for problem in problems:
+        print(f"ERROR: {problem}", file=sys.stderr)
+    if problems:
+        sys.exit(1)
+
+    main_table = f"{args.project}.{args.dataset}.{args.table}"
+    incremental_table = f"{args.project}.{args.dataset}.{args.incremental_table}"
+    print(create_table_ddl(main_table, fields))
+    # The incremental table is replaced on every run and stays unpartitioned
+    print(create_table_ddl(incremental_table, fields, partitioned=False, clustered=False))
+    if not args.ddl_only:
+        print(json.dumps(write_options(main_table, args.write_method, args.temporary_gcs_bucket), indent=2))
+        print(merge_upserts_sql(main_table, f"{main_table}{upserts_table_suffix}", fields))
+        print(delete_keys_sql(main_table, f"{main_table}{deletes_table_suffix}"))
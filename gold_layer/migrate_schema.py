@@ -0,0 +1,124 @@
+# Migrate existing gold BigQuery tables to the typed schema of schemas/ridership_schema.json.
+#
+# Each table is copied into a new table created from the gold DDL (partitioned and
+# clustered for the main table), converting string timestamps and numbers and the
+# Parquet list layout of georeference, then swapped in; the old table is kept as
+# <table>_legacy until it is dropped by hand.
+import argparse
+
+from google.cloud import bigquery
+
+from bq_tables import column_type, create_table_ddl, load_gold_fields
+
+
+def _is_parquet_list(field):
+    """True for a RECORD<list REPEATED RECORD<element>> field, as created from Parquet without list inference."""
+    subfields = list(field.fields)
+    return field.field_type == "RECORD" and len(subfields) == 1 and subfields[0].name == "list" \
+        and subfields[0].mode == "REPEATED"
+
+
+def conversion_expression(target, existing, path=None):
+    """SQL expression converting an existing column to the type of a target JSON schema field."""
+    path = path or target["name"]
+    target_type = column_type(target)
+
+    if target["type"] == "RECORD" and not target_type.startswith("ARRAY"):
+        existing_subfields = {sub.name: sub for sub in existing.fields}
+        members = []
+        for sub in target["fields"]:
+            name = sub["name"]
+            if name in existing_subfields:
+                members.append(f"{conversion_expression(sub, existing_subfields[name], path + '.' + name)} AS {name}")
+            else:
+                members.append(f"CAST(NULL AS {column_type(sub)}) AS {name}")
+        return f"IF({path} IS NULL, NULL, STRUCT({', '.join(members)}))"
+
+    if target_type.startswith("ARRAY") and _is_parquet_list(existing):
+        return f"ARRAY(SELECT item.element FROM UNNEST({path}.list) AS item)"
+    if target_type == "TIMESTAMP" and existing.field_type == "STRING":
+        return f"SAFE.PARSE_TIMESTAMP('%Y-%m-%d %H:%M:%S', {path})"
+    if column_type_of_existing(existing) == target_type:
+        return path
+    return f"SAFE_CAST({path} AS {target_type})"
+
+
+def migration_statements(client, table_id, fields, partitioned):
+    """
+    SQL statements migrating one table.
+
+    Returns:
+    - tuple: the statements (empty if the table already has the target types) and
+      the converting SELECT on its own, for dry runs.
+    """
+    table = client.get_table(table_id)
+    existing = {field.name: field for field in table.schema}
+    current_types = {field.name: column_type_of_existing(field) for field in table.schema}
+    target_types = {field["name"]: column_type(field) for field in fields}
+    if current_types == target_types and (table.time_partitioning is not None or not partitioned):
+        return [], None
+
+    project, dataset, name = table_id.split(".")
+    typed_table = f"{project}.{dataset}.{name}_typed"
+    select = ",\n  ".join(
+        f"{conversion_expression(field, existing[field['name']])} AS {field['name']}" if field["name"] in existing
+        else f"CAST(NULL AS {column_type(field)}) AS {field['name']}"
+        for field in fields
+    )
+    select_sql = f"SELECT\n  {select}\nFROM `{table_id}`"
+    return [
+        f"DROP TABLE IF EXISTS `{typed_table}`;",
+        create_table_ddl(typed_table, fields, partitioned=partitioned, clustered=partitioned),
+        f"INSERT INTO `{typed_table}`\n{select_sql};",
+        f"ALTER TABLE `{table_id}` RENAME TO `{name}_legacy`;",
+        f"ALTER TABLE `{typed_table}` RENAME TO `{name}`;",
+    ], select_sql
+
+
+def column_type_of_existing(field):
+    """Standard SQL type of an existing BigQuery column, with Parquet lists read as ARRAY."""
+    if field.field_type == "RECORD":
+        if _is_parquet_list(field):
+            return f"ARRAY<{column_type_of_existing(list(field.fields)[0].fields[0])}>"
+        sql_type = "STRUCT<" + ", ".join(f"{sub.name} {column_type_of_existing(sub)}" for sub in field.fields) + ">"
+    else:
+        sql_type = column_type({"type": field.field_type})
+    if field.mode == "REPEATED":
+        return f"ARRAY<{sql_type}>"
+    return sql_type
+
+
+def main(project_id, dataset_id, tables, partitioned_tables, dry_run=False):
+    client = bigquery.Client(project=project_id)
+    fields = load_gold_fields()
+
+    for name in tables:
+        table_id = f"{project_id}.{dataset_id}.{name}"
+        statements, select_sql = migration_statements(client, table_id, fields, partitioned=name in partitioned_tables)
+        if not statements:
+            print(f"{table_id} already has the typed schema")
+            continue
+
+        script = "\n".join(statements)
+        if dry_run:
+            print(script)
+            job = client.query(select_sql, job_config=bigquery.QueryJobConfig(dry_run=True))
+            print(f"-- {table_id}: the copy would process {job.total_bytes_processed} bytes")
+            continue
+
+        client.query(script).result()
+        print(f"Migrated {table_id} to the typed schema; the old table is {table_id}_legacy")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Migrate gold BigQuery tables to the typed ridership schema")
+    parser.add_argument("--project_id", required=True, help="GCP project ID")
+    parser.add_argument("--dataset_id", required=True, help="BigQuery dataset ID")
+    parser.add_argument("--tables", nargs="+", default=["nyc", "inc_nyc"], help="Tables to migrate")
+    parser.add_argument("--partitioned_tables", nargs="*", default=["nyc"],
+                        help="Tables created partitioned and clustered")
+    parser.add_argument("--dry_run", action="store_true", help="Print the SQL and the bytes the copy would process")
+
+    args = parser.parse_args()
+
+    main(args.project_id, args.dataset_id, args.tables, args.partitioned_tables, args.dry_run)
@@ -1,38 +1,274 @@
 import argparse
-from pyspark.sql import SparkSession
-from pyspark.sql.functions import col
+import json
+from delta.tables import DeltaTable
+from pyspark.sql import SparkSession, Window
+from pyspark.sql.functions import col, row_number
+from google.cloud import bigquery
 from google.cloud import logging as gcp_logging
+# Shipped from silver_layer/ with --py-files, together with schemas/ridership_schema.json via --files
+from schema_conformance import conform_to_schema, fields_to_spark_schema
+from logging_config_spark import LocalLogger
+from bq_tables import (cluster_columns, create_table_ddl, delete_keys_sql, deletes_table_suffix, key_columns,
+                       load_gold_fields, merge_upserts_sql, upserts_table_suffix, write_options)
 
-def main(delta_table_path, temp_gcs_bucket_main, temp_gcs_bucket_incr, project_id, dataset_id, bq_table_id, inc_bq_table_id):
+checkpoint_name = "_gold_sync_checkpoint.json"
+
+# Delta operations that rewrite every row, e.g. delta_maintenance.py --partitioning/--retype.
+# The change feed shows them as a delete and an insert of every row.
+rewrite_operations = {"CREATE OR REPLACE TABLE AS SELECT", "REPLACE TABLE AS SELECT", "RESTORE"}
+
+
+class BigQuerySink:
+    """A BigQuery table written through the Spark BigQuery connector."""
+
+    def __init__(self, spark, table, temporary_gcs_bucket, write_method="direct", partitioned=True):
+        self.spark = spark
+        self.table = table
+        self.temporary_gcs_bucket = temporary_gcs_bucket
+        self.write_method = write_method
+        self.partitioned = partitioned
+
+    def read(self):
+        return self.spark.read.format("bigquery").option("table", self.table).load()
+
+    def has_data(self):
+        # The connector answers count() from the table metadata
+        return self.read().count() > 0
+
+    def write(self, df, mode):
+        options = write_options(self.table, self.write_method, self.temporary_gcs_bucket,
+                                partitioned=self.partitioned, clustered=self.partitioned)
+        df.write.format("bigquery") \
+            .options(**options) \
+            .mode(mode) \
+            .save()
+
+    def ensure_table(self, fields, gcp_logger):
+        """Create the table partitioned and clustered if missing, and keep its clustering up to date."""
+        client = bigquery.Client(project=self.table.split(".")[0])
+        client.query(create_table_ddl(self.table, fields, partitioned=self.partitioned,
+                                      clustered=self.partitioned)).result()
+        if not self.partitioned:
+            return
+        table = client.get_table(self.table)
+        if table.time_partitioning is None:
+            gcp_logger.log_text(f"Table {self.table} is not partitioned; recreate it to enable partition pruning.", severity=400)
+        if table.clustering_fields != cluster_columns:
+            table.clustering_fields = cluster_columns
+            client.update_table(table, ["clustering_fields"])
+            gcp_logger.log_text(f"Clustered table {self.table} by {', '.join(cluster_columns)}.", severity=200)
+
+    def load_staged(self, staging_path, mode, table=None):
+        """Load staged Parquet files with a BigQuery load job, without re-running Spark."""
+        client = bigquery.Client(project=self.table.split(".")[0])
+        parquet_options = bigquery.format_options.ParquetOptions()
+        parquet_options.enable_list_inference = True
+        job_config = bigquery.LoadJobConfig(
+            source_format=bigquery.SourceFormat.PARQUET,
+            parquet_options=parquet_options,
+            write_disposition=bigquery.WriteDisposition.WRITE_APPEND if mode == "append"
+            else bigquery.WriteDisposition.WRITE_TRUNCATE,
+        )
+        client.load_table_from_uri(f"{staging_path.rstrip('/')}/*.parquet", table or self.table,
+                                   job_config=job_config).result()
+
+    def merge_staged(self, upserts_path, deletes_path, fields):
+        """
+        Apply staged changes on the key: update or insert the staged upserts and
+        delete the rows whose key is staged as deleted.
+
+        The staged files are loaded into tables next to the main table, which are
+        dropped once the changes are applied.
+        """
+        client = bigquery.Client(project=self.table.split(".")[0])
+        if upserts_path is not None:
+            upserts_table = f"{self.table}{upserts_table_suffix}"
+            self.load_staged(upserts_path, "overwrite", table=upserts_table)
+            client.query(merge_upserts_sql(self.table, upserts_table, fields)).result()
+            client.delete_table(upserts_table, not_found_ok=True)
+        if deletes_path is not None:
+            deletes_table = f"{self.table}{deletes_table_suffix}"
+            self.load_staged(deletes_path, "overwrite", table=deletes_table)
+            client.query(delete_keys_sql(self.table, deletes_table)).result()
+            client.delete_table(deletes_table, not_found_ok=True)
+
+
+class ParquetSink:
+    """Local stand-in for a BigQuery table, for running the sync without GCP."""
+
+    def __init__(self, spark, path):
+        self.spark = spark
+        self.table = path
+
+    def read(self):
+        return self.spark.read.parquet(self.table)
+
+    def has_data(self):
+        try:
+            return self.read().limit(1).count() > 0
+        except Exception:
+            return False
+
+    def write(self, df, mode):
+        df.write.mode(mode).parquet(self.table)
+
+    def load_staged(self, staging_path, mode):
+        self.spark.read.parquet(staging_path).write.mode(mode).parquet(self.table)
+
+    def merge_staged(self, upserts_path, deletes_path, fields):
+        changed_keys = [self.spark.read.parquet(path).select(*key_columns)
+                        for path in (upserts_path, deletes_path) if path is not None]
+        keys = changed_keys[0]
+        for other in changed_keys[1:]:
+            keys = keys.unionByName(other)
+        merged = self.read().join(keys, on=key_columns, how="left_anti")
+        if upserts_path is not None:
+            merged = merged.unionByName(self.spark.read.parquet(upserts_path))
+        # Materialized first, as the table is overwritten with rows read from it
+        merged.localCheckpoint().write.mode("overwrite").parquet(self.table)
+
+
+def hadoop_fs(spark, path):
+    """Return the Hadoop FileSystem and Path objects for a path."""
+    hadoop_path = spark.sparkContext._jvm.org.apache.hadoop.fs.Path(path)
+    return hadoop_path.getFileSystem(spark.sparkContext._jsc.hadoopConfiguration()), hadoop_path
+
+
+def read_sync_checkpoint(spark, checkpoint_path):
+    """Read the last Delta version synced to the gold tables, or None before the first sync."""
+    fs, path = hadoop_fs(spark, checkpoint_path)
+    if not fs.exists(path):
+        return None
+    stream = fs.open(path)
+    try:
+        return json.loads(spark.sparkContext._jvm.org.apache.commons.io.IOUtils.toString(stream, "UTF-8"))
+    finally:
+        stream.close()
+
+
+def write_sync_checkpoint(spark, checkpoint_path, version, rows):
+    """Store the Delta version the gold tables are synced to."""
+    fs, path = hadoop_fs(spark, checkpoint_path)
+    stream = fs.create(path, True)
+    try:
+        stream.write(bytearray(json.dumps({"delta_version": version, "rows": rows}).encode("utf-8")))
+    finally:
+        stream.close()
+
+
+def ensure_change_data_feed(spark, delta_table_path):
+    """
+    Enable the Delta Change Data Feed on the table if needed.
+
+    Returns:
+    - bool: True if it was already enabled, False if it was enabled now (changes
+      committed before this version are not in the feed).
+    """
+    properties = DeltaTable.forPath(spark, delta_table_path).detail().collect()[0]["properties"]
+    if properties.get("delta.enableChangeDataFeed") == "true":
+        return True
+    spark.sql(f"ALTER TABLE delta.`{delta_table_path}` SET TBLPROPERTIES (delta.enableChangeDataFeed = true)")
+    return False
+
+
+def rewrite_versions(spark, delta_table_path, from_version, to_version):
+    """Versions between two versions (inclusive) whose commit rewrote every row of the Delta table."""
+    history = DeltaTable.forPath(spark, delta_table_path).history() \
+        .where((col("version") >= from_version) & (col("version") <= to_version)) \
+        .select("version", "operation", "operationParameters") \
+        .collect()
+    return sorted(
+        row["version"] for row in history
+        if row["operation"] in rewrite_operations
+        or (row["operation"] == "WRITE" and (row["operationParameters"] or {}).get("mode") == "Overwrite")
+    )
+
+
+def read_changes(spark, delta_table_path, from_version, to_version, skip_versions=()):
+    """
+    Read the net change of each key between two versions (inclusive) from the change feed.
+
+    Inserts and update postimages of a key become its latest row; a key whose last
+    change is a delete is returned with _change_type 'delete'. Commits in
+    skip_versions are left out.
+    """
+    changes = spark.read.format("delta") \
+        .option("readChangeFeed", "true") \
+        .option("startingVersion", from_version) \
+        .option("endingVersion", to_version) \
+        .load(delta_table_path) \
+        .where(col("_change_type") != "update_preimage")
+    if skip_versions:
+        changes = changes.where(~col("_commit_version").isin(list(skip_versions)))
+
+    # Within one commit a key that is deleted and inserted again keeps the inserted row
+    latest = Window.partitionBy(*key_columns) \
+        .orderBy(col("_commit_version").desc(), (col("_change_type") == "delete").asc())
+    return changes.withColumn("_change_rank", row_number().over(latest)) \
+        .where(col("_change_rank") == 1) \
+        .drop("_change_rank")
+
+
+def stage_records(spark, df, staging_path):
+    """
+    Materialize the records to sync once as Parquet.
+
+    Returns:
+    - int: number of staged rows, from the Parquet footers.
+    """
+    df.write.mode("overwrite").parquet(staging_path)
+    return spark.read.parquet(staging_path).count()
+
+
+def remove_staged_records(spark, staging_path):
+    fs, path = hadoop_fs(spark, staging_path)
+    fs.delete(path, True)
+
+
+def anti_join_new_records(delta_df, sink_df):
+    """Rows of the Delta table whose key is not in the sink yet (full scan of both tables)."""
+    bq_unique_df = sink_df.select(*key_columns).distinct()
+
+    # Select only records whose key doesn't exist in BigQuery
+    return delta_df.join(bq_unique_df, on=key_columns, how="left_anti")
+
+
+def main(delta_table_path, temp_gcs_bucket_main, temp_gcs_bucket_incr, project_id, dataset_id, bq_table_id, inc_bq_table_id,
+         sync_mode="cdf", checkpoint_path=None, local_sink_path=None, write_method="direct"):
     # Initialize GCP Logger
-    logging_client = gcp_logging.Client()
-    gcp_logger = logging_client.logger("delta_to_bigquery") 
-    
+    if local_sink_path:
+        gcp_logger = LocalLogger("delta_to_bigquery")
+    else:
+        logging_client = gcp_logging.Client()
+        gcp_logger = logging_client.logger("delta_to_bigquery")
+
     gcp_logger.log_text("Starting Delta to BigQuery data transfer process.", severity=200)
-    
+
     # Initialize Spark session with BigQuery connector
     spark = SparkSession.builder \
             .appName("DeltaToBigQuery") \
+            .config("spark.sql.parquet.outputTimestampType", "TIMESTAMP_MICROS") \
             .getOrCreate()
-    
+
     gcp_logger.log_text("Spark session initialized successfully.", severity=200)
-    
-    bq_table_full_name = f"{project_id}.{dataset_id}.{bq_table_id}"
-    incr_bq_table_full_name = f"{project_id}.{dataset_id}.{inc_bq_table_id}"
-    
-    required_columns = ["transit_timestamp", 
-        "transit_mode", 
-        "station_complex_id",
-        "station_complex", 
-        "borough", 
-        "payment_method", 
-        "fare_class_category", 
-        "ridership", 
-        "transfers", 
-        "latitude", 
-        "longitude",
-        "georeference"]
-    
+
+    if local_sink_path:
+        main_sink = ParquetSink(spark, f"{local_sink_path.rstrip('/')}/{bq_table_id}")
+        incr_sink = ParquetSink(spark, f"{local_sink_path.rstrip('/')}/{inc_bq_table_id}")
+    else:
+        main_sink = BigQuerySink(spark, f"{project_id}.{dataset_id}.{bq_table_id}", temp_gcs_bucket_main, write_method)
+        # The incremental table is replaced on every run and stays unpartitioned
+        incr_sink = BigQuerySink(spark, f"{project_id}.{dataset_id}.{inc_bq_table_id}", temp_gcs_bucket_incr, write_method,
+                                 partitioned=False)
+    checkpoint_path = checkpoint_path or f"{delta_table_path.rstrip('/')}/{checkpoint_name}"
+    staging_root = f"{local_sink_path.rstrip('/')}/_staging" if local_sink_path else f"gs://{temp_gcs_bucket_incr}/gold_staging"
+
+    gold_fields = load_gold_fields()
+    bq_schema = fields_to_spark_schema(gold_fields)
+    if not local_sink_path:
+        main_sink.ensure_table(gold_fields, gcp_logger)
+        incr_sink.ensure_table(gold_fields, gcp_logger)
+
     # Read Delta table
     try:
         delta_df = spark.read.format("delta").load(delta_table_path)
@@ -40,93 +276,147 @@ def main(delta_table_path, temp_gcs_bucket_main, temp_gcs_bucket_incr, project_i
     except Exception as e:
         gcp_logger.log_text(f"Failed to load Delta table: {str(e)}", severity=500)
         raise e
-    
-    # Filter Delta table to include only the required columns
-    delta_df = delta_df.select(*required_columns)
-    gcp_logger.log_text("Filtered Delta table to include required columns.", severity=200)
-    
-    # Check if BigQuery table has data
-    try:
-        bq_df = spark.read.format("bigquery") \
-            .option("table", bq_table_full_name) \
-            .load()
-        bq_table_has_data = bq_df.count() > 0
-        gcp_logger.log_text(f"BigQuery table {bq_table_full_name} data check completed. Data exists: {bq_table_has_data}", severity=200)
-    except Exception as e:
-        gcp_logger.log_text(f"Error accessing BigQuery table: {str(e)}", severity=500)
-        bq_table_has_data = False
-    
-    # If BigQuery table has no data, write all Delta table records to BigQuery
+
+    # Select the required columns with the BigQuery table types in one projection
+    delta_df = conform_to_schema(delta_df, bq_schema)
+    gcp_logger.log_text("Conformed Delta table to the BigQuery schema.", severity=200)
+
+    current_version = DeltaTable.forPath(spark, delta_table_path).history(1).collect()[0]["version"]
+    checkpoint = read_sync_checkpoint(spark, checkpoint_path) if sync_mode == "cdf" else None
+
+    if sync_mode == "cdf" and checkpoint is not None:
+        synced_version = checkpoint["delta_version"]
+        if synced_version >= current_version:
+            gcp_logger.log_text(f"Gold tables already synced to Delta version {current_version}.", severity=200)
+            return
+
+        # Only the rows changed since the synced version are read
+        try:
+            skipped_versions = rewrite_versions(spark, delta_table_path, synced_version + 1, current_version)
+            if skipped_versions:
+                gcp_logger.log_text(
+                    f"Skipping Delta versions {skipped_versions}, which rewrote the whole table; "
+                    f"run with --sync_mode anti_join if a rewrite changed rows.",
+                    severity=400
+                )
+            changes_df = read_changes(spark, delta_table_path, synced_version + 1, current_version,
+                                      skipped_versions).persist()
+            staging_path = f"{staging_root}/{current_version}"
+            upserts_path, deletes_path = f"{staging_path}/upserts", f"{staging_path}/deletes"
+            new_records_count = stage_records(
+                spark, conform_to_schema(changes_df.where(col("_change_type") != "delete"), bq_schema), upserts_path
+            )
+            deleted_records_count = stage_records(
+                spark,
+                conform_to_schema(changes_df.where(col("_change_type") == "delete"), bq_schema).select(*key_columns),
+                deletes_path
+            )
+            changes_df.unpersist()
+            gcp_logger.log_text(
+                f"Read {new_records_count} inserted or updated and {deleted_records_count} deleted rows "
+                f"from Delta versions {synced_version + 1} to {current_version}.",
+                severity=200
+            )
+            bq_table_has_data = True
+        except Exception as e:
+            gcp_logger.log_text(f"Change feed unavailable, falling back to a full comparison: {str(e)}", severity=400)
+            checkpoint = None
+
+    if sync_mode != "cdf" or checkpoint is None:
+        if sync_mode == "cdf":
+            # Changes committed from here on are captured by the change feed
+            if not ensure_change_data_feed(spark, delta_table_path):
+                current_version = DeltaTable.forPath(spark, delta_table_path).history(1).collect()[0]["version"]
+                gcp_logger.log_text(f"Enabled Delta Change Data Feed at version {current_version}.", severity=200)
+            delta_df = conform_to_schema(
+                spark.read.format("delta").option("versionAsOf", current_version).load(delta_table_path), bq_schema
+            )
+
+        # Check if BigQuery table has data
+        try:
+            bq_table_has_data = main_sink.has_data()
+            gcp_logger.log_text(f"BigQuery table {main_sink.table} data check completed. Data exists: {bq_table_has_data}", severity=200)
+        except Exception as e:
+            gcp_logger.log_text(f"Error accessing BigQuery table: {str(e)}", severity=500)
+            bq_table_has_data = False
+
+        if bq_table_has_data:
+            # Perform anti-join to filter out redundant records
+            new_records_df = anti_join_new_records(delta_df, main_sink.read()).select(*bq_schema.fieldNames())
+            staging_path = f"{staging_root}/{current_version}"
+            new_records_count = stage_records(spark, new_records_df, staging_path)
+
+    # If BigQuery table has no data, write all Delta table records to both tables
     if not bq_table_has_data:
+        staging_path = f"{staging_root}/{current_version}"
         try:
-            delta_df.write.format("bigquery") \
-                .option("table", bq_table_full_name) \
-                .option("temporaryGcsBucket", temp_gcs_bucket_main) \
-                .mode("overwrite") \
-                .save()
-            gcp_logger.log_text("BigQuery table has no data. All records from Delta table written to BigQuery.", severity=200)
+            new_records_count = stage_records(spark, delta_df.select(*bq_schema.fieldNames()), staging_path)
+            main_sink.write(spark.read.parquet(staging_path), "overwrite")
+            gcp_logger.log_text(
+                f"BigQuery table has no data. All {new_records_count} records from Delta table written to BigQuery.",
+                severity=200
+            )
+            incr_sink.load_staged(staging_path, "overwrite")
+            gcp_logger.log_text(f"Incremental data written to table {incr_sink.table} (create or replace).", severity=200)
         except Exception as e:
             gcp_logger.log_text(f"Failed to write to BigQuery: {str(e)}", severity=500)
             raise e
+        remove_staged_records(spark, staging_path)
+        rows_scanned = None
+    elif checkpoint is not None:
+        rows_scanned = new_records_count + deleted_records_count
+        try:
+            # Updated rows replace their key in the main table and deleted keys are removed
+            if rows_scanned > 0:
+                main_sink.merge_staged(upserts_path if new_records_count else None,
+                                       deletes_path if deleted_records_count else None, gold_fields)
+                gcp_logger.log_text(
+                    f"Merged {new_records_count} inserted or updated and {deleted_records_count} deleted records "
+                    f"into BigQuery on the key.",
+                    severity=200
+                )
+            # The incremental table holds the rows inserted or updated in this run
+            if new_records_count > 0:
+                incr_sink.load_staged(upserts_path, "overwrite")
+                gcp_logger.log_text(f"Incremental data written to table {incr_sink.table} (create or replace).", severity=200)
+        except Exception as e:
+            gcp_logger.log_text(f"Failed to apply the Delta changes to BigQuery: {str(e)}", severity=500)
+            raise e
+        remove_staged_records(spark, staging_path)
     else:
-        # Fetch unique combinations from BigQuery
-        bq_unique_df = bq_df.select(
-            col("transit_timestamp").alias("bq_transit_timestamp"),
-            col("station_complex_id").alias("bq_station_complex_id"),
-            col("payment_method").alias("bq_payment_method")
-        ).distinct()
-    
-        # Prepare Delta table with the same unique columns
-        delta_unique_df = delta_df.select(
-            col("transit_timestamp").alias("delta_transit_timestamp"),
-            col("station_complex_id").alias("delta_station_complex_id"),
-            col("payment_method").alias("delta_payment_method"),
-            "*"
-        )
-    
-        # Perform anti-join to filter out redundant records
-        new_records_df = delta_unique_df.join(
-            bq_unique_df,
-            (
-                (delta_unique_df["delta_transit_timestamp"] == bq_unique_df["bq_transit_timestamp"]) &
-                (delta_unique_df["delta_station_complex_id"] == bq_unique_df["bq_station_complex_id"]) &
-                (delta_unique_df["delta_payment_method"] == bq_unique_df["bq_payment_method"])
-            ),
-            "left_anti"  # Select only records that don't exist in BigQuery
-        )
-    
-        new_records_count = new_records_df.count()
+        rows_scanned = None
         gcp_logger.log_text(f"Identified {new_records_count} new records to be written to BigQuery.", severity=200)
-    
-        # Write new records to BigQuery or handle case with no new records
+
+        # Both tables are loaded from the same staged files
         if new_records_count > 0:
             try:
-                # Write the new records to the main table (append mode)
-                new_records_df.select(*required_columns).write.format("bigquery") \
-                    .option("table", bq_table_full_name) \
-                    .option("temporaryGcsBucket", temp_gcs_bucket_main) \
-                    .mode("append") \
-                    .save()
+                # Load the new records into the main table (append mode)
+                main_sink.load_staged(staging_path, "append")
                 gcp_logger.log_text(f"{new_records_count} new required records written to BigQuery.", severity=200)
             except Exception as e:
                 gcp_logger.log_text(f"Failed to write new records to BigQuery: {str(e)}", severity=500)
                 raise e
-            
-            # Write the incremental data to a new table (create or replace)
+
+            # Load the incremental data into a new table (create or replace)
             try:
-                new_records_df.select(*required_columns).write.format("bigquery") \
-                    .option("table", incr_bq_table_full_name) \
-                    .option("temporaryGcsBucket", temp_gcs_bucket_incr) \
-                    .mode("overwrite") \
-                    .save()
-                
-                gcp_logger.log_text(f"Incremental data written to table {incr_bq_table_full_name} (create or replace).", severity=200)
+                incr_sink.load_staged(staging_path, "overwrite")
+
+                gcp_logger.log_text(f"Incremental data written to table {incr_sink.table} (create or replace).", severity=200)
             except Exception as e:
                 gcp_logger.log_text(f"Failed to write incremental data to BigQuery: {str(e)}", severity=500)
                 raise e
         else:
             gcp_logger.log_text("No new records to write to BigQuery. Skipping write operation.", severity=200)
-    
+        remove_staged_records(spark, staging_path)
+
+    if sync_mode == "cdf":
+        write_sync_checkpoint(spark, checkpoint_path, current_version, rows_scanned)
+        gcp_logger.log_text(
+            f"Gold tables synced to Delta version {current_version} "
+            f"({'full comparison' if rows_scanned is None else f'{rows_scanned} changed rows read'}).",
+            severity=200
+        )
+
     gcp_logger.log_text("Delta to BigQuery data transfer process completed.", severity=200)
 
 if __name__ == "__main__":
@@ -138,9 +428,15 @@ if __name__ == "__main__":
     parser.add_argument("--dataset_id", required=True, help="BigQuery dataset ID")
     parser.add_argument("--bq_table_id", required=True, help="BigQuery table ID")
     parser.add_argument("--inc_bq_table_id", required=True, help="BigQuery incremental table ID")
+    parser.add_argument("--sync_mode", choices=["cdf", "anti_join"], default="cdf",
+                        help="Read only the Delta changes since the last synced version, or compare full tables")
+    parser.add_argument("--checkpoint_path", help="Sync checkpoint file (default: next to the Delta table)")
+    parser.add_argument("--write_method", choices=["direct", "indirect"], default="direct",
+                        help="Storage Write API (direct) or staging through the temporary GCS buckets (indirect)")
+    parser.add_argument("--local_sink_path", help="Write Parquet tables under this path instead of BigQuery (local runs)")
 
     args = parser.parse_args()
-    
+
     main(
         delta_table_path=args.delta_table_path,
         temp_gcs_bucket_main=args.temp_gcs_bucket_main,
@@ -148,5 +444,9 @@ if __name__ == "__main__":
         project_id=args.project_id,
         dataset_id=args.dataset_id,
         bq_table_id=args.bq_table_id,
-        inc_bq_table_id=args.inc_bq_table_id
+        inc_bq_table_id=args.inc_bq_table_id,
+        sync_mode=args.sync_mode,
+        checkpoint_path=args.checkpoint_path,
+        local_sink_path=args.local_sink_path,
+        write_method=args.write_method
     )
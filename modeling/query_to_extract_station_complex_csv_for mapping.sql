@@ -1,4 +1,5 @@
-SELECT DISTINCT station_complex, station_complex_index
-FROM `lively-encoder-448916-d5.nyc_subway.original_encoded_cols_data`
+-- Codes of the station complexes as persisted by data_preprocessing/category_codes.py,
+-- exported to station_complex.csv (also: python category_codes.py --export station_complex station_complex.csv)
+SELECT station_complex, station_complex_index
+FROM `lively-encoder-448916-d5.nyc_subway.station_complex_codes`
 ORDER BY station_complex_index
-LIMIT 450
\ No newline at end of file
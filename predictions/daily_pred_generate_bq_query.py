@@ -1,5 +1,12 @@
+import os
+import sys
+
 from google.cloud import bigquery
 
+# The feature definitions are shared with the preprocessing
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data_preprocessing"))
+from features import daily_calendar_mv_columns, moving_average_names, moving_averages_sql, series_columns
+
 def create_tables():
     # Initialize BigQuery client
     client = bigquery.Client()
@@ -52,97 +59,25 @@ def create_tables():
     print("Step 1: Created `daily_pred_lags` table.")
 
     # Step 2: Create `daily_pred_moving_avg` table
-    query_step_2 = """
-    CREATE OR REPLACE TABLE `lively-encoder-448916-d5.nyc_subway.daily_pred_moving_avg`
-    AS
-    WITH ridership_moving_avg AS (
-        SELECT 
-            transit_date,
-            transit_mode_index,
-            station_complex_index,
-            borough_index,
-            payment_method_index,
-            -- 7-day moving average
-            AVG(ridership) OVER (
-                PARTITION BY station_complex_index, transit_mode_index, borough_index, payment_method_index
-                ORDER BY transit_date
-                ROWS BETWEEN 6 PRECEDING AND 0 PRECEDING
-            ) AS ridership_7d_mv,
-            AVG(day_of_week) OVER (
-                PARTITION BY station_complex_index, transit_mode_index, borough_index, payment_method_index
-                ORDER BY transit_date
-                ROWS BETWEEN 6 PRECEDING AND 0 PRECEDING
-            ) AS day_of_week_7d_mv,
-            AVG(week_of_month) OVER (
-                PARTITION BY station_complex_index, transit_mode_index, borough_index, payment_method_index
-                ORDER BY transit_date
-                ROWS BETWEEN 6 PRECEDING AND 0 PRECEDING
-            ) AS week_of_month_7d_mv,
-            AVG(day_of_week_sin) OVER (
-                PARTITION BY station_complex_index, transit_mode_index, borough_index, payment_method_index
-                ORDER BY transit_date
-                ROWS BETWEEN 6 PRECEDING AND 0 PRECEDING
-            ) AS day_of_week_sin_7d_mv,
-            AVG(day_of_week_cos) OVER (
-                PARTITION BY station_complex_index, transit_mode_index, borough_index, payment_method_index
-                ORDER BY transit_date
-                ROWS BETWEEN 6 PRECEDING AND 0 PRECEDING
-            ) AS day_of_week_cos_7d_mv,
-            AVG(week_of_month_sin) OVER (
-                PARTITION BY station_complex_index, transit_mode_index, borough_index, payment_method_index
-                ORDER BY transit_date
-                ROWS BETWEEN 6 PRECEDING AND 0 PRECEDING
-            ) AS week_of_month_sin_7d_mv,
-            AVG(week_of_month_cos) OVER (
-                PARTITION BY station_complex_index, transit_mode_index, borough_index, payment_method_index
-                ORDER BY transit_date
-                ROWS BETWEEN 6 PRECEDING AND 0 PRECEDING
-            ) AS week_of_month_cos_7d_mv,
-            -- 30-day moving average
-            AVG(ridership) OVER (
-                PARTITION BY station_complex_index, transit_mode_index, borough_index, payment_method_index
-                ORDER BY transit_date
-                ROWS BETWEEN 29 PRECEDING AND 0 PRECEDING
-            ) AS ridership_30d_mv,
-            AVG(day_of_week) OVER (
-                PARTITION BY station_complex_index, transit_mode_index, borough_index, payment_method_index
-                ORDER BY transit_date
-                ROWS BETWEEN 29 PRECEDING AND 0 PRECEDING
-            ) AS day_of_week_30d_mv,
-            AVG(week_of_month) OVER (
-                PARTITION BY station_complex_index, transit_mode_index, borough_index, payment_method_index
-                ORDER BY transit_date
-                ROWS BETWEEN 29 PRECEDING AND 0 PRECEDING
-            ) AS week_of_month_30d_mv,
-            AVG(day_of_week_sin) OVER (
-                PARTITION BY station_complex_index, transit_mode_index, borough_index, payment_method_index
-                ORDER BY transit_date
-                ROWS BETWEEN 29 PRECEDING AND 0 PRECEDING
-            ) AS day_of_week_sin_30d_mv,
-            AVG(day_of_week_cos) OVER (
-                PARTITION BY station_complex_index, transit_mode_index, borough_index, payment_method_index
-                ORDER BY transit_date
-                ROWS BETWEEN 29 PRECEDING AND 0 PRECEDING
-            ) AS day_of_week_cos_30d_mv,
-            AVG(week_of_month_sin) OVER (
-                PARTITION BY station_complex_index, transit_mode_index, borough_index, payment_method_index
-                ORDER BY transit_date
-                ROWS BETWEEN 29 PRECEDING AND 0 PRECEDING
-            ) AS week_of_month_sin_30d_mv,
-            AVG(week_of_month_cos) OVER (
-                PARTITION BY station_complex_index, transit_mode_index, borough_index, payment_method_index
-                ORDER BY transit_date
-                ROWS BETWEEN 29 PRECEDING AND 0 PRECEDING
-            ) AS week_of_month_cos_30d_mv
+    # Same moving averages as date_model, with frames ending at the latest date: the
+    # averages the date after it gets
+    recent_dates = f"""(
+        SELECT transit_date, {', '.join(series_columns)}, ridership, {', '.join(daily_calendar_mv_columns)}
         FROM `lively-encoder-448916-d5.nyc_subway.date_model`
         WHERE transit_date BETWEEN 
             (SELECT MAX(transit_date) - 29 FROM `lively-encoder-448916-d5.nyc_subway.date_model`) 
             AND 
             (SELECT MAX(transit_date) FROM `lively-encoder-448916-d5.nyc_subway.date_model`)
+    )"""
+    query_step_2 = f"""
+    CREATE OR REPLACE TABLE `lively-encoder-448916-d5.nyc_subway.daily_pred_moving_avg`
+    AS
+    WITH ridership_moving_avg AS (
+        {moving_averages_sql(recent_dates, "transit_date", columns=daily_calendar_mv_columns, next_row=True)}
     )
     SELECT
         transit_date + 1 AS next_transit_date,
-        *
+        * EXCEPT (ridership, {', '.join(daily_calendar_mv_columns)})
     FROM
         ridership_moving_avg
     WHERE transit_date = (SELECT MAX(transit_date) FROM `lively-encoder-448916-d5.nyc_subway.date_model`)
@@ -153,7 +88,8 @@ def create_tables():
     print("Step 2: Created `daily_pred_moving_avg` table.")
 
     # Step 3: Create `daily_future_pred_input` table
-    query_step_3 = """
+    mv_columns = ", ".join(f"mv.{name}" for name in moving_average_names(columns=daily_calendar_mv_columns))
+    query_step_3 = f"""
     CREATE OR REPLACE TABLE `lively-encoder-448916-d5.nyc_subway.daily_future_pred_input`
     AS (
         SELECT
@@ -173,14 +109,7 @@ def create_tables():
             l.ridership_lag_16, l.ridership_lag_17, l.ridership_lag_18, l.ridership_lag_19, l.ridership_lag_20,
             l.ridership_lag_21, l.ridership_lag_22, l.ridership_lag_23, l.ridership_lag_24, l.ridership_lag_25,
             l.ridership_lag_26, l.ridership_lag_27, l.ridership_lag_28, l.ridership_lag_29, l.ridership_lag_30,
-            mv.ridership_7d_mv,
-            mv.day_of_week_7d_mv, mv.week_of_month_7d_mv,
-            mv.day_of_week_sin_7d_mv, mv.day_of_week_cos_7d_mv,
-            mv.week_of_month_sin_7d_mv, mv.week_of_month_cos_7d_mv,
-            mv.ridership_30d_mv,
-            mv.day_of_week_30d_mv, mv.week_of_month_30d_mv,
-            mv.day_of_week_sin_30d_mv, mv.day_of_week_cos_30d_mv,
-            mv.week_of_month_sin_30d_mv, mv.week_of_month_cos_30d_mv
+            {mv_columns}
         FROM `lively-encoder-448916-d5.nyc_subway.daily_pred_lags` l
         INNER JOIN `lively-encoder-448916-d5.nyc_subway.daily_pred_moving_avg` mv
         ON l.transit_mode_index = mv.transit_mode_index
@@ -1,5 +1,12 @@
+import os
+import sys
+
 from google.cloud import bigquery
 
+# The feature definitions are shared with the preprocessing
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data_preprocessing"))
+from features import hourly_calendar_mv_columns, moving_average_names, moving_averages_sql, series_columns
+
 def create_hourly_tables():
     # Initialize BigQuery client
     client = bigquery.Client()
@@ -47,128 +54,26 @@ def create_hourly_tables():
     print("Step 1: Created `hourly_pred_lags` table.")
 
     # Step 2: Create `hourly_pred_moving_avg` table
-    query_step_2 = """
-    CREATE OR REPLACE TABLE `lively-encoder-448916-d5.nyc_subway.hourly_pred_moving_avg`
-    AS
-    WITH ridership_moving_avg AS (
-        SELECT 
-            transit_timestamp,
-            transit_mode_index,
-            station_complex_index,
-            borough_index,
-            payment_method_index,
-            -- 7-day moving average
-            AVG(ridership) OVER (
-                PARTITION BY station_complex_index, transit_mode_index, borough_index, payment_method_index
-                ORDER BY transit_timestamp
-                ROWS BETWEEN 6 PRECEDING AND 0 PRECEDING
-            ) AS ridership_7d_mv,
-            AVG(hour_of_day) OVER (
-                PARTITION BY station_complex_index, transit_mode_index, borough_index, payment_method_index
-                ORDER BY transit_timestamp
-                ROWS BETWEEN 6 PRECEDING AND 0 PRECEDING
-            ) AS hour_of_day_7d_mv,
-            AVG(day_of_week) OVER (
-                PARTITION BY station_complex_index, transit_mode_index, borough_index, payment_method_index
-                ORDER BY transit_timestamp
-                ROWS BETWEEN 6 PRECEDING AND 0 PRECEDING
-            ) AS day_of_week_7d_mv,
-            AVG(week_of_month) OVER (
-                PARTITION BY station_complex_index, transit_mode_index, borough_index, payment_method_index
-                ORDER BY transit_timestamp
-                ROWS BETWEEN 6 PRECEDING AND 0 PRECEDING
-            ) AS week_of_month_7d_mv,
-            AVG(hour_of_day_sin) OVER (
-                PARTITION BY station_complex_index, transit_mode_index, borough_index, payment_method_index
-                ORDER BY transit_timestamp
-                ROWS BETWEEN 6 PRECEDING AND 0 PRECEDING
-            ) AS hour_of_day_sin_7d_mv,
-             AVG(hour_of_day_cos) OVER (
-                PARTITION BY station_complex_index, transit_mode_index, borough_index, payment_method_index
-                ORDER BY transit_timestamp
-                ROWS BETWEEN 6 PRECEDING AND 0 PRECEDING
-            ) AS hour_of_day_cos_7d_mv,
-            AVG(day_of_week_sin) OVER (
-                PARTITION BY station_complex_index, transit_mode_index, borough_index, payment_method_index
-                ORDER BY transit_timestamp
-                ROWS BETWEEN 6 PRECEDING AND 0 PRECEDING
-            ) AS day_of_week_sin_7d_mv,
-            AVG(day_of_week_cos) OVER (
-                PARTITION BY station_complex_index, transit_mode_index, borough_index, payment_method_index
-                ORDER BY transit_timestamp
-                ROWS BETWEEN 6 PRECEDING AND 0 PRECEDING
-            ) AS day_of_week_cos_7d_mv,
-            AVG(week_of_month_sin) OVER (
-                PARTITION BY station_complex_index, transit_mode_index, borough_index, payment_method_index
-                ORDER BY transit_timestamp
-                ROWS BETWEEN 6 PRECEDING AND 0 PRECEDING
-            ) AS week_of_month_sin_7d_mv,
-            AVG(week_of_month_cos) OVER (
-                PARTITION BY station_complex_index, transit_mode_index, borough_index, payment_method_index
-                ORDER BY transit_timestamp
-                ROWS BETWEEN 6 PRECEDING AND 0 PRECEDING
-            ) AS week_of_month_cos_7d_mv,
-            -- 30-day moving average
-            AVG(ridership) OVER (
-                PARTITION BY station_complex_index, transit_mode_index, borough_index, payment_method_index
-                ORDER BY transit_timestamp
-                ROWS BETWEEN 29 PRECEDING AND 0 PRECEDING
-            ) AS ridership_30d_mv,
-            AVG(hour_of_day) OVER (
-                PARTITION BY station_complex_index, transit_mode_index, borough_index, payment_method_index
-                ORDER BY transit_timestamp
-                ROWS BETWEEN 29 PRECEDING AND 0 PRECEDING
-            ) AS hour_of_day_30d_mv,
-            AVG(day_of_week) OVER (
-                PARTITION BY station_complex_index, transit_mode_index, borough_index, payment_method_index
-                ORDER BY transit_timestamp
-                ROWS BETWEEN 29 PRECEDING AND 0 PRECEDING
-            ) AS day_of_week_30d_mv,
-            AVG(week_of_month) OVER (
-                PARTITION BY station_complex_index, transit_mode_index, borough_index, payment_method_index
-                ORDER BY transit_timestamp
-                ROWS BETWEEN 29 PRECEDING AND 0 PRECEDING
-            ) AS week_of_month_30d_mv,
-            AVG(hour_of_day_sin) OVER (
-                PARTITION BY station_complex_index, transit_mode_index, borough_index, payment_method_index
-                ORDER BY transit_timestamp
-                ROWS BETWEEN 29 PRECEDING AND 0 PRECEDING
-            ) AS hour_of_day_sin_30d_mv,
-            AVG(hour_of_day_cos) OVER (
-                PARTITION BY station_complex_index, transit_mode_index, borough_index, payment_method_index
-                ORDER BY transit_timestamp
-                ROWS BETWEEN 29 PRECEDING AND 0 PRECEDING
-            ) AS hour_of_day_cos_30d_mv,
-            AVG(day_of_week_sin) OVER (
-                PARTITION BY station_complex_index, transit_mode_index, borough_index, payment_method_index
-                ORDER BY transit_timestamp
-                ROWS BETWEEN 29 PRECEDING AND 0 PRECEDING
-            ) AS day_of_week_sin_30d_mv,
-            AVG(day_of_week_cos) OVER (
-                PARTITION BY station_complex_index, transit_mode_index, borough_index, payment_method_index
-                ORDER BY transit_timestamp
-                ROWS BETWEEN 29 PRECEDING AND 0 PRECEDING
-            ) AS day_of_week_cos_30d_mv,
-            AVG(week_of_month_sin) OVER (
-                PARTITION BY station_complex_index, transit_mode_index, borough_index, payment_method_index
-                ORDER BY transit_timestamp
-                ROWS BETWEEN 29 PRECEDING AND 0 PRECEDING
-            ) AS week_of_month_sin_30d_mv,
-            AVG(week_of_month_cos) OVER (
-                PARTITION BY station_complex_index, transit_mode_index, borough_index, payment_method_index
-                ORDER BY transit_timestamp
-                ROWS BETWEEN 29 PRECEDING AND 0 PRECEDING
-            ) AS week_of_month_cos_30d_mv
+    # Same moving averages as hour_model, with frames ending at the latest hour: the
+    # averages the hour after it gets
+    recent_hours = f"""(
+        SELECT transit_timestamp, {', '.join(series_columns)}, ridership, {', '.join(hourly_calendar_mv_columns)}
         FROM `lively-encoder-448916-d5.nyc_subway.hour_model`
         WHERE transit_timestamp >=  (SELECT TIMESTAMP_SUB(MAX(transit_timestamp), INTERVAL 29 HOUR) 
                                      FROM `lively-encoder-448916-d5.nyc_subway.hour_model`) 
           AND transit_timestamp <= (SELECT MAX(transit_timestamp) 
                                     FROM `lively-encoder-448916-d5.nyc_subway.hour_model`)
+    )"""
+    query_step_2 = f"""
+    CREATE OR REPLACE TABLE `lively-encoder-448916-d5.nyc_subway.hourly_pred_moving_avg`
+    AS
+    WITH ridership_moving_avg AS (
+        {moving_averages_sql(recent_hours, "transit_timestamp", columns=hourly_calendar_mv_columns, next_row=True)}
     )
     SELECT
         (SELECT TIMESTAMP_ADD(MAX(transit_timestamp), INTERVAL 1 HOUR)
          FROM `lively-encoder-448916-d5.nyc_subway.hour_model`) AS next_transit_timestamp,
-        *
+        * EXCEPT (ridership, {', '.join(hourly_calendar_mv_columns)})
     FROM
         ridership_moving_avg
     WHERE transit_timestamp = (SELECT MAX(transit_timestamp) FROM `lively-encoder-448916-d5.nyc_subway.hour_model`)
@@ -178,7 +83,8 @@ def create_hourly_tables():
     print("Step 2: Created `hourly_pred_moving_avg` table.")
 
     # Step 3: Create `hourly_future_pred_input` table
-    query_step_3 = """
+    mv_columns = ", ".join(f"mv.{name}" for name in moving_average_names(columns=hourly_calendar_mv_columns))
+    query_step_3 = f"""
     CREATE OR REPLACE TABLE `lively-encoder-448916-d5.nyc_subway.hourly_future_pred_input`
     AS (
       SELECT
@@ -200,16 +106,7 @@ def create_hourly_tables():
         l.ridership_lag_11, l.ridership_lag_12, l.ridership_lag_13, l.ridership_lag_14, l.ridership_lag_15,
         l.ridership_lag_16, l.ridership_lag_17, l.ridership_lag_18, l.ridership_lag_19, l.ridership_lag_20,
         l.ridership_lag_21, l.ridership_lag_22, l.ridership_lag_23, l.ridership_lag_24,
-        mv.ridership_7d_mv,
-        mv.hour_of_day_7d_mv, mv.day_of_week_7d_mv, mv.week_of_month_7d_mv,
-        mv.hour_of_day_sin_7d_mv, mv.hour_of_day_cos_7d_mv,
-        mv.day_of_week_sin_7d_mv, mv.day_of_week_cos_7d_mv,
-        mv.week_of_month_sin_7d_mv, mv.week_of_month_cos_7d_mv,
-        mv.ridership_30d_mv,
-        mv.hour_of_day_30d_mv, mv.day_of_week_30d_mv, mv.week_of_month_30d_mv,
-        mv.hour_of_day_sin_30d_mv, mv.hour_of_day_cos_30d_mv,
-        mv.day_of_week_sin_30d_mv, mv.day_of_week_cos_30d_mv,
-        mv.week_of_month_sin_30d_mv, mv.week_of_month_cos_30d_mv
+        {mv_columns}
         FROM `lively-encoder-448916-d5.nyc_subway.hourly_pred_lags` l
         INNER JOIN `lively-encoder-448916-d5.nyc_subway.hourly_pred_moving_avg` mv
         ON l.transit_mode_index = mv.transit_mode_index
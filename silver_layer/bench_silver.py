@@ -0,0 +1,346 @@
+# Local Spark benchmarks of the silver job. Each step runs the former and the current
+# implementation over generated ridership rows in local[*] mode and prints the wall
+# clock, Spark jobs and stage statistics of both as JSON, e.g.
+#   python bench_silver.py isolation --rows 5000000
+import argparse
+import json
+import shutil
+import tempfile
+import time
+from datetime import timedelta
+
+import great_expectations as gx
+from pyspark.sql import functions as F
+from pyspark.sql.types import DoubleType, FloatType, StructField, StructType, TimestampType
+
+from delta_maintenance import get_spark
+from run_metrics import RunMetrics
+from schema_conformance import conform_to_schema, load_ridership_schema, silver_type_overrides
+from spark_functions import *
+
+
+boroughs = ['Brooklyn', 'Manhattan', 'Bronx', 'Queens', 'Staten Island']
+
+# Rows are generated hourly for each of this many stations
+stations = 428
+
+
+def write_station_reference(spark, workdir):
+    """Write a station reference CSV of the generated stations and load it as the session reference."""
+    csv_path = f"{workdir}/station_data.csv"
+    spark.range(1, stations + 1).select(
+        F.col("id").cast("string").alias("station_complex_id"),
+        F.concat(F.lit("Station "), F.col("id").cast("string")).alias("station_complex"),
+    ).coalesce(1).write.option("header", "true").csv(csv_path)
+    return load_station_reference(spark, csv_path=csv_path, snapshot_root=f"{workdir}/station_reference")
+
+
+def generate_rows(spark, rows, workdir, bad_every=100):
+    """
+    Write rows conformed to the silver schema to Parquet and read them back.
+
+    Every bad_every-th row has ridership 0 and fails validation. The natural key
+    is unique: one row per station and hour from 2020-01-01.
+    """
+    path = f"{workdir}/rows"
+    n = F.col("id")
+    station = (n % stations + 1).cast("string")
+    longitude, latitude = F.lit(-73.98), F.lit(40.75) + (n % 100) / 1000
+    spark.range(rows).select(
+        F.timestamp_seconds(F.lit(1577836800) + (n / stations).cast("long") * 3600).alias("transit_timestamp"),
+        F.lit("subway").alias("transit_mode"),
+        station.alias("station_complex_id"),
+        F.concat(F.lit("Station "), station).alias("station_complex"),
+        F.element_at(F.array(*[F.lit(b) for b in boroughs]), (n % len(boroughs) + 1).cast("int")).alias("borough"),
+        F.when(n % 2 == 0, "omny").otherwise("metrocard").alias("payment_method"),
+        F.element_at(F.array(*[F.lit(c) for c in fare_class_cat]),
+                     (n % len(fare_class_cat) + 1).cast("int")).alias("fare_class_category"),
+        F.when(n % bad_every == 0, 0.0).otherwise(n % 97 + 1).alias("ridership"),
+        (n % 7).cast("double").alias("transfers"),
+        latitude.alias("latitude"),
+        longitude.alias("longitude"),
+        F.struct(F.array(longitude, latitude).alias("coordinates"), F.lit("Point").alias("type")).alias("georeference"),
+    ).transform(
+        lambda df: conform_to_schema(df, load_ridership_schema(type_overrides=silver_type_overrides))
+    ).write.parquet(path)
+    return spark.read.parquet(path)
+
+
+def run_variants(spark, rows, variants):
+    """Run each variant as a RunMetrics phase and return the phases; scans are input records over rows."""
+    metrics = RunMetrics(spark, "bench")
+    results = {}
+    for name, run in variants.items():
+        with metrics.phase(name):
+            results[name] = run()
+    phases = metrics.summary()["phases"]
+    for phase in phases:
+        phase["scans"] = round(phase.get("input_records", 0) / rows, 2)
+        if isinstance(results[phase["phase"]], dict):
+            phase.update(results[phase["phase"]])
+    return phases
+
+
+# data_isolation before the single-pass rules: one filter().count() plus one count()
+# per rule, station membership as isin() lists, then counts for the proportions
+def former_data_isolation(df, station_ids, station_names):
+    rules = validation_rules()
+    rules["station_complex_id"] = F.col("station_complex_id").isin(station_ids)
+    rules["station_complex"] = F.col("station_complex").isin(station_names)
+
+    for condition, result in rules.items():
+        success_count = df.filter(result).count()
+        failure_count = df.count() - success_count
+
+    all_valid = F.lit(True)
+    for result in rules.values():
+        all_valid = all_valid & result
+    bad_records_df = df.filter(~all_valid)
+    good_records_df = df.filter(all_valid)
+    bad_proportion = bad_records_df.count() / df.count()
+    good_proportion = good_records_df.count() / df.count()
+    return good_records_df.count(), bad_records_df.count()
+
+
+def bench_isolation(spark, df, reference, rows, workdir):
+    """data_isolation: per-rule counts (former) against one flagged, cached pass (current)."""
+    station_ids = [row[0] for row in reference.select("station_complex_id").collect()]
+    station_names = [row[0] for row in reference.select("station_complex").collect()]
+
+    def current():
+        good, bad = data_isolation(df)
+        # The callers write both sides, which reads the cached flagged rows
+        return {"good": good.count(), "bad": bad.count()}
+
+    def former():
+        good, bad = former_data_isolation(df, station_ids, station_names)
+        return {"good": good, "bad": bad}
+
+    return run_variants(spark, rows, {"former": former, "current": current})
+
+
+def plan_stats(df):
+    """Length of the optimized plan and time taken to analyze, optimize and plan the query."""
+    start = time.time()
+    query_execution = df._jdf.queryExecution()
+    query_execution.executedPlan()
+    return {"plan_seconds": round(time.time() - start, 3),
+            "optimized_plan_chars": len(query_execution.optimizedPlan().toString())}
+
+
+def bench_station(spark, df, reference, rows, workdir):
+    """Station membership: isin() lists in the plan (former) against broadcast joins (current)."""
+    station_ids = [row[0] for row in reference.select("station_complex_id").collect()]
+    station_names = [row[0] for row in reference.select("station_complex").collect()]
+
+    def failures(flagged, id_condition, name_condition):
+        return flagged.agg(
+            F.sum((~F.coalesce(id_condition, F.lit(False))).cast("long")).alias("station_complex_id"),
+            F.sum((~F.coalesce(name_condition, F.lit(False))).cast("long")).alias("station_complex"),
+        )
+
+    def former():
+        counted = failures(df, F.col("station_complex_id").isin(station_ids),
+                           F.col("station_complex").isin(station_names))
+        stats = plan_stats(counted)
+        return {**stats, **counted.collect()[0].asDict()}
+
+    def current():
+        flagged = add_station_reference_flags(df, load_station_reference(spark))
+        counted = failures(flagged, F.col(station_reference_keys["station_complex_id"]),
+                           F.col(station_reference_keys["station_complex"]))
+        stats = plan_stats(counted)
+        return {**stats, **counted.collect()[0].asDict()}
+
+    return run_variants(spark, rows, {"former": former, "current": current})
+
+
+# Validation before the persisted suite: a fresh context, data source, asset, batch
+# definition and suite for every call, and the whole batch validated
+def former_validation(df, suite_name):
+    setup_start = time.time()
+    context = gx.get_context(mode="ephemeral")
+    data_asset = context.data_sources.add_spark(name="nyc_data").add_dataframe_asset(name="ridership_data")
+    batch = data_asset.add_batch_definition_whole_dataframe("full_data").get_batch(batch_parameters={"dataframe": df})
+    suite = context.suites.add(build_expectation_suite(suite_name))
+    setup_seconds = time.time() - setup_start
+
+    validation_start = time.time()
+    batch.validate(suite)
+    return {"setup_seconds": round(setup_seconds, 3), "validation_seconds": round(time.time() - validation_start, 3)}
+
+
+def bench_gx(spark, df, reference, rows, workdir):
+    """
+    Great Expectations on the full rows and on their last 30 days, as the full and
+    incremental branches: rebuilt per call (former) against the persisted file-backed
+    suite and validation definition, whole and 10% sampled (current).
+    """
+    cutoff = df.agg(F.max("transit_timestamp")).collect()[0][0] - timedelta(days=30)
+    incremental = df.filter(F.col("transit_timestamp") >= F.lit(cutoff))
+
+    def timed(run):
+        start = time.time()
+        run()
+        return round(time.time() - start, 3)
+
+    def former():
+        flagged = add_station_reference_flags(df, reference)
+        return {"full": former_validation(flagged, "basic_validation"),
+                "incremental": former_validation(add_station_reference_flags(incremental, reference),
+                                                 "basic_validation")}
+
+    def current():
+        get_gx_context(project_root=f"{workdir}/gx")
+        return {
+            "full_seconds": timed(lambda: get_validations(
+                'nyc_data', 'ridership_data', 'basic_validation', 'full_data', 'full_batch', df)),
+            "incremental_seconds": timed(lambda: get_validations(
+                'nyc_data', 'ridership_data', 'basic_validation', 'incremental_data', 'incremental_batch',
+                incremental)),
+            "incremental_sampled_seconds": timed(lambda: get_validations(
+                'nyc_data', 'ridership_data', 'basic_validation', 'incremental_data', 'incremental_batch',
+                incremental,
+                sample_fraction=0.1)),
+        }
+
+    return run_variants(spark, rows, {"former": former, "current": current})
+
+
+def merge_metrics(spark, delta_table_path):
+    metrics = DeltaTable.forPath(spark, delta_table_path).history(1).select("operationMetrics").collect()[0][0] or {}
+    return {name: metrics.get(name) for name in ["numTargetRowsInserted", "numTargetRowsUpdated",
+                                                 "numTargetFilesAdded", "numTargetFilesRemoved"]}
+
+
+def bench_merge(spark, df, reference, rows, workdir):
+    """
+    Incremental upsert of the last 30 days plus the 7 days before them restated,
+    into a year-partitioned Delta table of the earlier rows: merge on every column
+    and year (former) against the natural key with partition pruning (current).
+    """
+    expected_columns = df.columns
+    cutoff = df.agg(F.max("transit_timestamp")).collect()[0][0] - timedelta(days=30)
+    restated_from = cutoff - timedelta(days=7)
+    incoming = df.filter(F.col("transit_timestamp") >= F.lit(restated_from)).withColumn(
+        "ridership",
+        F.when(F.col("transit_timestamp") < F.lit(cutoff), F.col("ridership") + 1).otherwise(F.col("ridership"))
+    )
+
+    paths = {}
+    for name in ["former", "current"]:
+        paths[name] = f"{workdir}/delta_{name}"
+        add_partition_columns(df.filter(F.col("transit_timestamp") < F.lit(cutoff)), "year") \
+            .write.format("delta").partitionBy("year").save(paths[name])
+
+    def former():
+        merge_condition = " AND ".join([f"target.{column} = source.{column}" for column in expected_columns])
+        DeltaTable.forPath(spark, paths["former"]).alias("target").merge(
+            add_partition_columns(incoming, "year").alias("source"),
+            merge_condition + " AND target.year=source.year"
+        ).whenNotMatchedInsertAll().execute()
+        return merge_metrics(spark, paths["former"])
+
+    def current():
+        merge_into_delta(spark, paths["current"], incoming, expected_columns, merge_mode="key", update_matched=True)
+        return merge_metrics(spark, paths["current"])
+
+    return run_variants(spark, rows, {"former": former, "current": current})
+
+
+def bench_conform(spark, df, reference, rows, workdir, extra_columns=200):
+    """
+    Conforming a wide bronze-typed frame (epoch nanosecond timestamps, string measures
+    and extra_columns string columns) to its schema: one withColumn per field after
+    the individual measure casts (former) against one select (current).
+    """
+    schema = StructType(
+        load_ridership_schema(type_overrides=silver_type_overrides).fields
+        + [StructField(f"extra_{i}", DoubleType(), True) for i in range(extra_columns)]
+    )
+    bronze = df.select(
+        (F.expr("unix_micros(transit_timestamp)") * 1000).alias("transit_timestamp"),
+        *[F.col(column).cast("string") if column in legacy_string_measures else F.col(column)
+          for column in df.columns if column != "transit_timestamp"],
+        *[(F.col("transfers") + i).cast("string").alias(f"extra_{i}") for i in range(extra_columns)]
+    )
+
+    def former():
+        conformed = bronze.withColumn(
+            "transit_timestamp",
+            F.date_format((F.col("transit_timestamp") / 1000000000).cast(TimestampType()), "yyyy-MM-dd HH:mm:ss")
+        )
+        for column in legacy_string_measures:
+            conformed = conformed.withColumn(column, F.col(column).cast(FloatType()))
+        for field in schema.fields:
+            conformed = conformed.withColumn(field.name, conformed[field.name].cast(field.dataType))
+        stats = plan_stats(conformed)
+        conformed.write.format("noop").mode("overwrite").save()
+        return stats
+
+    def current():
+        conformed = conform_to_schema(bronze, schema)
+        stats = plan_stats(conformed)
+        conformed.write.format("noop").mode("overwrite").save()
+        return stats
+
+    return run_variants(spark, rows, {"former": former, "current": current})
+
+
+def bench_metrics(spark, df, reference, rows, workdir):
+    """
+    Driver-side inspection of a run against a year-partitioned Delta table of the
+    rows: show/printSchema and full MAX(transit_timestamp) collects (former) against
+    non-debug RunMetrics samples, the latest-partition max and the emitted report (current).
+    """
+    delta_table_path = f"{workdir}/delta_metrics"
+    add_partition_columns(df, "year").write.format("delta").partitionBy("year").save(delta_table_path)
+
+    def former():
+        df.show(5)
+        df.printSchema()
+        delta_df = spark.read.format("delta").load(delta_table_path)
+        delta_df.show(5)
+        delta_df.printSchema()
+        latest_date_delta = delta_df.selectExpr("MAX(transit_timestamp)").collect()[0][0]
+        latest_date_source = df.selectExpr("MAX(transit_timestamp)").collect()[0][0]
+        return {"latest_date_delta": latest_date_delta}
+
+    def current():
+        metrics = RunMetrics(spark, "silver")
+        metrics.sample(df, "conformed bronze data")
+        metrics.sample(spark.read.format("delta").load(delta_table_path), "Delta table")
+        # Run outside a phase of its own, so its jobs count towards the benchmark phase
+        latest_date_delta = get_delta_max_timestamp(spark, delta_table_path)
+        metrics.emit()
+        return {"latest_date_delta": latest_date_delta}
+
+    return run_variants(spark, rows, {"former": former, "current": current})
+
+
+benchmarks = {
+    "isolation": bench_isolation,
+    "station": bench_station,
+    "gx": bench_gx,
+    "merge": bench_merge,
+    "conform": bench_conform,
+    "metrics": bench_metrics,
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark silver steps on generated rows in local Spark")
+    parser.add_argument("step", choices=list(benchmarks), help="The step to benchmark")
+    parser.add_argument("--rows", type=int, default=5000000, help="Number of generated rows")
+    args = parser.parse_args()
+
+    spark = get_spark(local=True)
+    workdir = tempfile.mkdtemp(prefix="bench_silver_")
+    try:
+        reference = write_station_reference(spark, workdir)
+        df = generate_rows(spark, args.rows, workdir)
+        phases = benchmarks[args.step](spark, df, reference, args.rows, workdir)
+        print(json.dumps({"step": args.step, "rows": args.rows, "phases": phases}, indent=2, default=str))
+    finally:
+        spark.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
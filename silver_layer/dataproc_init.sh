@@ -34,4 +34,5 @@ PIP_EXEC=$(which pip)
 ${PIP_EXEC} install great-expectations==1.3.0
 ${PIP_EXEC} install delta-spark==2.3.0
 ${PIP_EXEC} install google-cloud-logging==3.7.0
+${PIP_EXEC} install google-cloud-bigquery==3.11.4
 ${PIP_EXEC} install xgboost==1.7.6
@@ -0,0 +1,212 @@
+# Maintenance of the silver Delta table: compaction with Z-ordering, VACUUM,
+# repartitioning, retyping, and a file report before/after.
+import argparse
+import time
+
+from delta import configure_spark_with_delta_pip
+from delta.tables import DeltaTable
+from pyspark.sql import DataFrame, SparkSession
+from pyspark.sql import functions as F
+
+from spark_functions import add_partition_columns, delta_partitionings, get_delta_partition_columns
+from schema_conformance import conform_to_schema, load_ridership_schema, mismatched_columns, silver_type_overrides
+from logging_config_spark import *
+
+
+zorder_columns = ["station_complex_id", "transit_timestamp"]
+
+# Files below this size are counted as small in the report
+small_file_bytes = 32 * 1024 * 1024
+
+
+def get_spark(local=False):
+    """Create a Delta-enabled Spark session; local sessions pull Delta from pip."""
+    builder = SparkSession.builder \
+        .appName("DeltaMaintenance") \
+        .config("spark.sql.extensions", "io.delta.sql.DeltaSparkSessionExtension") \
+        .config("spark.sql.catalog.spark_catalog", "org.apache.spark.sql.delta.catalog.DeltaCatalog")
+    if local:
+        builder = configure_spark_with_delta_pip(builder.master("local[*]"))
+    return builder.getOrCreate()
+
+
+def file_report(spark, delta_table_path):
+    """
+    Count the live data files of the Delta table and their sizes, per partition.
+
+    The files and sizes come from the add actions of the current snapshot, so only
+    the Delta log is read, not the data files.
+
+    Returns:
+    - dict: totals and a per-partition breakdown of files, bytes and small files.
+    """
+    partition_columns = get_delta_partition_columns(spark, delta_table_path)
+    jvm = spark.sparkContext._jvm
+    snapshot = jvm.org.apache.spark.sql.delta.DeltaLog.forTable(spark._jsparkSession, delta_table_path) \
+        .unsafeVolatileSnapshot()
+    add_actions = DataFrame(snapshot.allFiles().toDF(), spark)
+
+    rows = add_actions.groupBy(
+        *[F.col("partitionValues")[column].alias(column) for column in partition_columns]
+    ).agg(
+        F.count(F.lit(1)).alias("files"),
+        F.sum("size").alias("bytes"),
+        F.sum((F.col("size") < small_file_bytes).cast("long")).alias("small_files"),
+    ).collect()
+
+    partitions = {
+        "/".join(f"{column}={row[column]}" for column in partition_columns): {
+            "files": row["files"], "bytes": row["bytes"], "small_files": row["small_files"]
+        }
+        for row in rows
+    }
+
+    return {
+        "files": sum(stats["files"] for stats in partitions.values()),
+        "bytes": sum(stats["bytes"] for stats in partitions.values()),
+        "small_files": sum(stats["small_files"] for stats in partitions.values()),
+        "partitions": partitions,
+    }
+
+
+def log_report(label, report):
+    """Log the totals of a file report and the partitions with the most files."""
+    average = report["bytes"] / report["files"] if report["files"] else 0
+    gcp_logger.log_text(
+        f"{label}: {report['files']} files, {report['bytes'] / 1024 ** 2:.1f} MiB, "
+        f"{report['small_files']} small files, average {average / 1024 ** 2:.1f} MiB "
+        f"across {len(report['partitions'])} partitions",
+        severity=200
+    )
+    busiest = sorted(report["partitions"].items(), key=lambda item: item[1]["files"], reverse=True)[:10]
+    for partition, stats in busiest:
+        gcp_logger.log_text(
+            f"{label} {partition}: {stats['files']} files, {stats['bytes'] / 1024 ** 2:.1f} MiB",
+            severity=200
+        )
+
+
+def optimize_table(spark, delta_table_path, zorder_by=zorder_columns, partition_filter=None):
+    """
+    Compact the Delta table, Z-ordering the rewritten files by the given columns.
+
+    partition_filter restricts the rewrite to matching partitions, e.g. "year >= 2024".
+    """
+    optimizer = DeltaTable.forPath(spark, delta_table_path).optimize()
+    if partition_filter:
+        optimizer = optimizer.where(partition_filter)
+    start = time.time()
+    if zorder_by:
+        result = optimizer.executeZOrderBy(*zorder_by)
+    else:
+        result = optimizer.executeCompaction()
+    metrics = result.select("metrics").collect()[0][0]
+    gcp_logger.log_text(
+        f"OPTIMIZE finished in {time.time() - start:.1f}s: "
+        f"{metrics['numFilesRemoved']} files compacted into {metrics['numFilesAdded']}",
+        severity=200
+    )
+    return metrics
+
+
+def vacuum_table(spark, delta_table_path, retention_hours=168):
+    """Remove files no longer referenced by the Delta table and older than the retention."""
+    if retention_hours < 168:
+        # Delta refuses retentions below 7 days unless the safety check is disabled
+        spark.conf.set("spark.databricks.delta.retentionDurationCheck.enabled", "false")
+    start = time.time()
+    DeltaTable.forPath(spark, delta_table_path).vacuum(retention_hours)
+    gcp_logger.log_text(
+        f"VACUUM with {retention_hours}h retention finished in {time.time() - start:.1f}s",
+        severity=200
+    )
+
+
+def repartition_table(spark, delta_table_path, partitioning):
+    """Rewrite the Delta table with a different partitioning."""
+    current = get_delta_partition_columns(spark, delta_table_path)
+    if current == delta_partitionings[partitioning]:
+        gcp_logger.log_text(f"Delta table already partitioned by {current}", severity=200)
+        return
+
+    df = spark.read.format("delta").load(delta_table_path).drop(*current)
+    df = add_partition_columns(df, partitioning)
+    df.write.format("delta") \
+        .mode("overwrite") \
+        .option("overwriteSchema", "true") \
+        .partitionBy(*delta_partitionings[partitioning]) \
+        .save(delta_table_path)
+    gcp_logger.log_text(
+        f"Repartitioned Delta table from {current} to {delta_partitionings[partitioning]}",
+        severity=200
+    )
+
+
+def retype_table(spark, delta_table_path):
+    """Rewrite the Delta table with the column types of the ridership schema (e.g. string timestamps)."""
+    silver_schema = load_ridership_schema(type_overrides=silver_type_overrides)
+    df = spark.read.format("delta").load(delta_table_path)
+    mismatched = mismatched_columns(df, silver_schema)
+    if not mismatched:
+        gcp_logger.log_text("Delta table already has the schema column types", severity=200)
+        return
+
+    partition_columns = get_delta_partition_columns(spark, delta_table_path)
+    conform_to_schema(df, silver_schema, keep_extra_columns=True).write.format("delta") \
+        .mode("overwrite") \
+        .option("overwriteSchema", "true") \
+        .partitionBy(*partition_columns) \
+        .save(delta_table_path)
+    gcp_logger.log_text(f"Retyped Delta table columns {mismatched}", severity=200)
+
+
+def main(delta_table_path, partitioning=None, optimize=True, zorder_by=zorder_columns, partition_filter=None,
+         vacuum=True, retention_hours=168, local=False, retype=False):
+    spark = get_spark(local)
+
+    before = file_report(spark, delta_table_path)
+    log_report("Before maintenance", before)
+
+    if retype:
+        retype_table(spark, delta_table_path)
+    if partitioning:
+        repartition_table(spark, delta_table_path, partitioning)
+    if optimize:
+        optimize_table(spark, delta_table_path, zorder_by, partition_filter)
+    if vacuum:
+        vacuum_table(spark, delta_table_path, retention_hours)
+
+    after = file_report(spark, delta_table_path)
+    log_report("After maintenance", after)
+    return before, after
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compact, Z-order and vacuum the silver Delta table.")
+    parser.add_argument("--delta_table_path", default="gs://nyc_subway_delta_lake/")
+    parser.add_argument(
+        "--partitioning",
+        choices=list(delta_partitionings),
+        help="Rewrite the table with this partitioning before compacting."
+    )
+    parser.add_argument("--no_optimize", action="store_true", help="Skip the compaction.")
+    parser.add_argument(
+        "--zorder_by",
+        nargs="*",
+        default=zorder_columns,
+        help="Columns to Z-order by; pass no value to compact without Z-ordering."
+    )
+    parser.add_argument("--partition_filter", help="Only compact partitions matching this predicate, e.g. 'year >= 2024'.")
+    parser.add_argument("--no_vacuum", action="store_true", help="Skip the VACUUM.")
+    parser.add_argument("--retention_hours", type=int, default=168, help="VACUUM retention in hours (default: 7 days).")
+    parser.add_argument("--local", action="store_true", help="Run on a local Spark session with Delta from pip.")
+    parser.add_argument(
+        "--retype",
+        action="store_true",
+        help="Rewrite the table with the column types of schemas/ridership_schema.json."
+    )
+
+    args = parser.parse_args()
+
+    main(args.delta_table_path, args.partitioning, not args.no_optimize, args.zorder_by, args.partition_filter,
+         not args.no_vacuum, args.retention_hours, args.local, args.retype)
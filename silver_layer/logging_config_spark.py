@@ -1,5 +1,37 @@
+import logging
+
+from google.auth.exceptions import DefaultCredentialsError
 from google.cloud import logging as gcp_logging
 
+
+# Python levels of the GCP LogSeverity values; NOTICE and above ERROR have no exact match
+gcp_severity_levels = {
+    0: logging.NOTSET,      # DEFAULT
+    100: logging.DEBUG,     # DEBUG
+    200: logging.INFO,      # INFO
+    300: logging.INFO,      # NOTICE
+    400: logging.WARNING,   # WARNING
+    500: logging.ERROR,     # ERROR
+    600: logging.CRITICAL,  # CRITICAL
+    700: logging.CRITICAL,  # ALERT
+    800: logging.CRITICAL,  # EMERGENCY
+}
+
+
+class LocalLogger:
+    """Stand-in for the GCP logger when running without GCP credentials (local Delta)."""
+
+    def __init__(self, name):
+        logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(levelname)s %(message)s")
+        self.logger = logging.getLogger(name)
+
+    def log_text(self, text, severity=200):
+        self.logger.log(gcp_severity_levels.get(severity, logging.INFO), text)
+
+
 # Initialize GCP Logging client and logger
-gcp_client = gcp_logging.Client()
-gcp_logger = gcp_client.logger("silver_logger")
+try:
+    gcp_client = gcp_logging.Client()
+    gcp_logger = gcp_client.logger("silver_logger")
+except DefaultCredentialsError:
+    gcp_logger = LocalLogger("silver_logger")
@@ -0,0 +1,95 @@
+# Re-validate quarantined rows (e.g. after the station reference was fixed)
+# and merge the rows that now pass into the silver Delta table.
+#
+# A batch that fails validation is quarantined as a whole, and the ingestion
+# watermark does not advance past it, so its good rows are only kept in the good
+# quarantine. They are merged into silver as well and removed from it.
+#
+# The quarantine paths are bucket roots; the Delta tables are read from their
+# delta_quarantine/ prefix.
+import argparse
+
+from pyspark.sql import SparkSession
+
+from spark_functions import *
+from schema_conformance import conform_to_schema, load_ridership_schema, silver_type_overrides
+from logging_config_spark import *
+
+
+def main(delta_table_path, quarantine_path_bad, quarantine_path_good=None, partition_filter=None, failed_rules=None,
+         update_matched=False):
+    spark = SparkSession.builder \
+        .appName("ReprocessQuarantine") \
+        .config("spark.sql.extensions", "io.delta.sql.DeltaSparkSessionExtension") \
+        .config("spark.sql.catalog.spark_catalog", "org.apache.spark.sql.delta.catalog.DeltaCatalog") \
+        .getOrCreate()
+
+    silver_schema = load_ridership_schema(type_overrides=silver_type_overrides)
+    quarantine_path_bad = quarantine_table_path(quarantine_path_bad)
+    quarantine_path_good = quarantine_table_path(quarantine_path_good) if quarantine_path_good else None
+
+    if quarantine_path_good and check_delta_existance(spark, quarantine_path_good):
+        reprocess_good_quarantine(spark, delta_table_path, quarantine_path_good, silver_schema, partition_filter,
+                                  update_matched)
+
+    quarantined = conform_to_schema(read_quarantine(spark, quarantine_path_bad, partition_filter, failed_rules), silver_schema)
+
+    # Re-run only the row-level rules on the quarantined rows
+    fixed_df, still_bad_df = data_isolation(quarantined)
+    fixed_count = fixed_df.count()
+    gcp_logger.log_text(f"{fixed_count} quarantined rows now pass validation", severity=200)
+
+    if fixed_count > 0:
+        merge_into_delta(spark, delta_table_path, fixed_df, silver_schema.fieldNames(),
+                         merge_mode="key", update_matched=update_matched)
+
+    # Only after the merge succeeded, so a failed run can simply be repeated
+    resolve_quarantine(spark, quarantine_path_bad, fixed_df, still_bad_df)
+    gcp_logger.log_text(f"Quarantine at {quarantine_path_bad} updated", severity=200)
+
+
+def reprocess_good_quarantine(spark, delta_table_path, quarantine_path_good, silver_schema, partition_filter=None,
+                              update_matched=False):
+    """Merge the rows of the good quarantine into the silver Delta table and remove them from the quarantine."""
+    good_df = conform_to_schema(read_quarantine(spark, quarantine_path_good, partition_filter), silver_schema)
+    good_count = good_df.count()
+    gcp_logger.log_text(f"{good_count} rows in the good quarantine", severity=200)
+    if good_count == 0:
+        return
+
+    merge_into_delta(spark, delta_table_path, good_df, silver_schema.fieldNames(),
+                     merge_mode="key", update_matched=update_matched)
+
+    # Only after the merge succeeded, so a failed run can simply be repeated
+    clear_quarantine(spark, quarantine_path_good, good_df)
+    gcp_logger.log_text(f"Good quarantine at {quarantine_path_good} merged into silver", severity=200)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Re-validate quarantined rows and merge the fixed ones into silver.")
+    parser.add_argument("--delta_table_path", default="gs://nyc_subway_delta_lake/")
+    parser.add_argument("--quarantine_path_bad", default="gs://nyc_bad_data_bucket/")
+    parser.add_argument(
+        "--quarantine_path_good",
+        default="gs://nyc_good_data_bucket/",
+        help="Good quarantine whose rows are merged into silver; pass an empty value to skip it."
+    )
+    parser.add_argument(
+        "--partition_filter",
+        help="Only reprocess quarantine partitions matching this predicate, e.g. 'year = 2024 AND month = 3'."
+    )
+    parser.add_argument(
+        "--failed_rules",
+        nargs="*",
+        help="Only reprocess bad rows that failed one of these rules, e.g. station_complex_id."
+    )
+    parser.add_argument(
+        "--update_matched",
+        action="store_true",
+        help="Overwrite silver rows that match a fixed row on the natural key."
+    )
+
+    args = parser.parse_args()
+
+    main(args.delta_table_path, args.quarantine_path_bad, args.quarantine_path_good, args.partition_filter,
+         args.failed_rules, args.update_matched)
@@ -0,0 +1,107 @@
+# Stage-level run metrics of the silver job, emitted once at the end of a run.
+import json
+import time
+import urllib.request
+from contextlib import contextmanager
+
+from logging_config_spark import *
+
+
+class RunMetrics:
+    """
+    Collect per-phase wall clock, Spark job/stage statistics and row counts of a run.
+
+    Each phase runs under its own Spark job group, so the jobs it triggers are read
+    back from the status tracker and the stage statistics (records, bytes, executor
+    time) from the Spark monitoring REST API at the end of the run, without extra jobs.
+    """
+
+    def __init__(self, spark, run_name, debug=False):
+        self.spark = spark
+        self.run_name = run_name
+        self.debug = debug
+        self.phases = []
+        self.values = {}
+        self.start = time.time()
+
+    @contextmanager
+    def phase(self, name):
+        """Run a block of the job as a named phase."""
+        sc = self.spark.sparkContext
+        group = f"{self.run_name}:{name}"
+        sc.setJobGroup(group, name)
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.phases.append({"phase": name, "group": group, "seconds": round(time.time() - start, 3)})
+            sc.setLocalProperty("spark.jobGroup.id", None)
+
+    def record(self, name, value):
+        """Record a value known without running a Spark job, e.g. a count already collected."""
+        self.values[name] = value
+
+    def sample(self, df, name, rows=5):
+        """Show a few rows and the schema of a DataFrame, only when debugging."""
+        if self.debug:
+            gcp_logger.log_text(f"Sample of {name}:", severity=100)
+            df.show(rows)
+            df.printSchema()
+
+    def _stage_stats(self, stage_ids):
+        """Sum the statistics of the given stages from the Spark monitoring REST API."""
+        sc = self.spark.sparkContext
+        stats = {"stages": 0, "tasks": 0}
+        fields = {"inputRecords": "input_records", "inputBytes": "input_bytes",
+                  "outputRecords": "output_records", "outputBytes": "output_bytes",
+                  "shuffleReadBytes": "shuffle_read_bytes", "shuffleWriteBytes": "shuffle_write_bytes",
+                  "executorRunTime": "executor_run_ms"}
+        for stage_id in stage_ids:
+            info = sc.statusTracker().getStageInfo(stage_id)
+            if info is None:
+                # Skipped stages never ran
+                continue
+            stats["stages"] += 1
+            stats["tasks"] += info.numTasks
+            if not sc.uiWebUrl:
+                continue
+            url = f"{sc.uiWebUrl}/api/v1/applications/{sc.applicationId}/stages/{stage_id}"
+            try:
+                with urllib.request.urlopen(url, timeout=10) as response:
+                    attempts = json.load(response)
+            except Exception:
+                continue
+            for api_field, name in fields.items():
+                stats[name] = stats.get(name, 0) + sum(attempt.get(api_field, 0) for attempt in attempts)
+        return stats
+
+    def summary(self):
+        """Build the metrics of the run as a dict."""
+        tracker = self.spark.sparkContext.statusTracker()
+        phases = []
+        for phase in self.phases:
+            job_ids = tracker.getJobIdsForGroup(phase["group"])
+            stage_ids = []
+            for job_id in job_ids:
+                job = tracker.getJobInfo(job_id)
+                if job is not None:
+                    stage_ids.extend(job.stageIds)
+            phases.append({
+                "phase": phase["phase"],
+                "seconds": phase["seconds"],
+                "jobs": len(job_ids),
+                **self._stage_stats(stage_ids),
+            })
+        return {
+            "run": self.run_name,
+            "seconds": round(time.time() - self.start, 3),
+            "jobs": sum(phase["jobs"] for phase in phases),
+            "phases": phases,
+            "values": self.values,
+        }
+
+    def emit(self):
+        """Log the metrics of the run once, as JSON."""
+        summary = self.summary()
+        gcp_logger.log_text(json.dumps(summary, default=str), severity=200)
+        return summary
@@ -0,0 +1,131 @@
+# Conform Spark DataFrames to the ridership schema in a single projection.
+# Shared by the silver and gold layers; ship it with --py-files and the schema with --files.
+import json
+import os
+import time
+
+from pyspark.sql import functions as F
+from pyspark.sql.types import (ArrayType, BooleanType, DateType, DoubleType, FloatType, LongType, StringType,
+                               StructField, StructType, TimestampType)
+
+from logging_config_spark import *
+
+
+_here = os.path.dirname(os.path.abspath(__file__))
+
+ridership_schema_path = os.environ.get(
+    "RIDERSHIP_SCHEMA_PATH",
+    next(
+        (path for path in [
+            os.path.join(_here, "ridership_schema.json"),
+            os.path.join(_here, "..", "schemas", "ridership_schema.json"),
+            "ridership_schema.json",
+        ] if os.path.exists(path)),
+        os.path.join(_here, "ridership_schema.json")
+    )
+)
+
+# Silver keeps single-precision measures in Delta
+silver_type_overrides = {
+    "ridership": FloatType(),
+    "transfers": FloatType(),
+    "latitude": FloatType(),
+    "longitude": FloatType(),
+}
+
+# String timestamps are stored in this format
+timestamp_format = "yyyy-MM-dd HH:mm:ss"
+
+_bq_to_spark_types = {
+    "STRING": StringType(),
+    "FLOAT": DoubleType(),
+    "FLOAT64": DoubleType(),
+    "INTEGER": LongType(),
+    "INT64": LongType(),
+    "BOOLEAN": BooleanType(),
+    "BOOL": BooleanType(),
+    "TIMESTAMP": TimestampType(),
+    "DATE": DateType(),
+}
+
+
+def bq_field_to_spark_type(field):
+    """Map a BigQuery JSON schema field to a Spark type."""
+    if field["type"] == "RECORD":
+        subfields = field.get("fields", [])
+        # Parquet LIST columns appear in BigQuery as RECORD<list REPEATED RECORD<element>>
+        if len(subfields) == 1 and subfields[0]["name"] == "list" and subfields[0]["mode"] == "REPEATED":
+            return ArrayType(bq_field_to_spark_type(subfields[0]["fields"][0]))
+        return StructType([StructField(sub["name"], bq_field_to_spark_type(sub), True) for sub in subfields])
+
+    spark_type = _bq_to_spark_types[field["type"]]
+    if field.get("mode") == "REPEATED":
+        return ArrayType(spark_type)
+    return spark_type
+
+
+def load_ridership_schema(schema_path=ridership_schema_path, type_overrides=None):
+    """Build the Spark StructType of the ridership schema, with optional per-column type overrides."""
+    with open(schema_path) as f:
+        bq_fields = json.load(f)
+    return fields_to_spark_schema(bq_fields, type_overrides)
+
+
+def fields_to_spark_schema(bq_fields, type_overrides=None):
+    """Build a Spark StructType from BigQuery JSON schema fields."""
+    type_overrides = type_overrides or {}
+    return StructType([
+        StructField(field["name"], type_overrides.get(field["name"]) or bq_field_to_spark_type(field), True)
+        for field in bq_fields
+    ])
+
+
+def mismatched_columns(df, schema):
+    """Names of the schema columns present in the DataFrame with a different type."""
+    return [field.name for field in schema.fields
+            if field.name in df.columns and df.schema[field.name].dataType != field.dataType]
+
+
+def conform_column(name, source_type, target_type):
+    """Return the expression converting one column from its source type to the target type."""
+    column = F.col(name)
+    if source_type == target_type:
+        return column
+
+    # Bronze stores transit_timestamp as epoch nanoseconds
+    if isinstance(source_type, LongType) and isinstance(target_type, (StringType, TimestampType)):
+        column = (column / 1000000000).cast(TimestampType())
+        source_type = TimestampType()
+    if isinstance(source_type, (TimestampType, DateType)) and isinstance(target_type, StringType):
+        return F.date_format(column, timestamp_format)
+    if isinstance(source_type, StringType) and isinstance(target_type, TimestampType):
+        return F.to_timestamp(column, timestamp_format)
+    return column.cast(target_type)
+
+
+def conform_to_schema(df, schema, keep_extra_columns=False):
+    """
+    Apply every cast and timestamp conversion needed to match the schema in one select.
+
+    Columns of the schema are returned in schema order; columns missing from the
+    DataFrame become typed nulls. Other columns are dropped unless keep_extra_columns.
+    """
+    start = time.time()
+    source_types = {field.name: field.dataType for field in df.schema.fields}
+
+    projection = []
+    for field in schema.fields:
+        if field.name in source_types:
+            projection.append(conform_column(field.name, source_types[field.name], field.dataType).alias(field.name))
+        else:
+            projection.append(F.lit(None).cast(field.dataType).alias(field.name))
+    if keep_extra_columns:
+        schema_names = set(schema.fieldNames())
+        projection.extend(F.col(name) for name in df.columns if name not in schema_names)
+
+    conformed = df.select(*projection)
+    gcp_logger.log_text(
+        f"Conformed {len(schema.fields)} columns to schema in one select (plan analysis {time.time() - start:.3f}s)",
+        severity=200
+    )
+    return conformed
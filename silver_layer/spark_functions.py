@@ -1,72 +1,180 @@
 # Perform data validation using Great Expectations
+import json
+import os
+import time
 import great_expectations as gx
 import pandas as pd
+from great_expectations.data_context.types.base import DataContextConfig, GCSStoreBackendDefaults
+from great_expectations.exceptions import DataContextError
 from delta.tables import DeltaTable
 from logging_config_spark import *
 # from pyspark.sql import SparkSession
 # import pyspark.sql.functions as f
 # from pyspark.sql.types import StructType, StructField, StringType, IntegerType, FloatType, TimestampType
 
+from pyspark import StorageLevel
 from pyspark.sql import functions as F
 from pyspark.sql.functions import col, when
-
-
-# Perform data validation using Great Expectations
-
-def get_validations(data_source_name,data_asset_name,suite_name,batch_definition_name,definition_name,df):
-    
-    global df_
-    global fare_class_cat
-    
-    fare_class_cat = ['Metrocard - Fair Fare',
-       'OMNY - Seniors & Disability',
-       'Metrocard - Seniors & Disability',
-       'Metrocard - Full Fare',
-       'OMNY - Other',
-       'OMNY - Full Fare',
-       'Metrocard - Unlimited 7-Day',
-       'Metrocard - Unlimited 30-Day',
-       'Metrocard - Students',
-       'Metrocard - Other',
-       'OMNY - Students',
-       'OMNY - Fair Fare']
-    
-    df_ = pd.read_csv("gs://rakshaka-dataproc-bucket/spark-files/station_data.csv")
-    # print(df_.head())
-    
-    
-    
-    context = gx.get_context()
-    
-    gcp_logger.log_text(f'')
-    
-    # Define the Data Source name
-
-    # Add the Data Source to the Data Context
-    data_source = context.data_sources.add_spark(name=data_source_name)
-    gcp_logger.log_text(f'gx: Data source created successfully {data_source_name}',severity=200)
-
-    # Define the name of your data asset
-
-    data_asset = data_source.add_dataframe_asset(name=data_asset_name)
-    gcp_logger.log_text(f'gx: Data asset created successfully {data_asset_name}',severity=200)
-
-    batch_parameters = {"dataframe": df}
-    batch_definition = data_asset.add_batch_definition_whole_dataframe(
-    batch_definition_name
-    )
-    gcp_logger.log_text(f'gx: Batch created successfully {batch_definition_name}',severity=200)
-
-    batch = batch_definition.get_batch(batch_parameters=batch_parameters)
-
-    # Create an Expectation Suite
-    suite = gx.ExpectationSuite(name=suite_name)
-    
-    gcp_logger.log_text(f'gx: Expectation suite created successfully {suite_name}',severity=200)
-    
-
-    # Add the Expectation Suite to the Data Context
-    suite = context.suites.add(suite)
+from pyspark.sql.types import StructType, StructField, StringType
+
+
+fare_class_cat = ['Metrocard - Fair Fare',
+   'OMNY - Seniors & Disability',
+   'Metrocard - Seniors & Disability',
+   'Metrocard - Full Fare',
+   'OMNY - Other',
+   'OMNY - Full Fare',
+   'Metrocard - Unlimited 7-Day',
+   'Metrocard - Unlimited 30-Day',
+   'Metrocard - Students',
+   'Metrocard - Other',
+   'OMNY - Students',
+   'OMNY - Fair Fare']
+
+station_reference_csv = "gs://rakshaka-dataproc-bucket/spark-files/station_data.csv"
+station_reference_snapshots = "gs://rakshaka-dataproc-bucket/station_reference/"
+
+ingestion_watermark_name = "_ingestion_watermark.json"
+
+# Manifest of the part files of a bronze month, written by the bronze layer
+bronze_manifest_name = "_manifest.json"
+
+# Partition columns of the silver Delta table for each supported partitioning
+delta_partitionings = {
+    "year": ["year"],
+    "year_month": ["year", "month"],
+    "date": ["date"],
+}
+
+# Quarantined rows are partitioned by the month of their transit_timestamp
+quarantine_partitioning = "year_month"
+
+# Quarantine Delta tables live under this prefix of the quarantine buckets, apart from
+# the plain Parquet files quarantined at the bucket root before
+quarantine_table_prefix = "delta_quarantine"
+
+# Measures that bronze files written before the typed bronze schema store as strings
+legacy_string_measures = ["ridership", "transfers", "latitude", "longitude"]
+
+# Natural key of a ridership row, used by the key-based Delta merge
+merge_key_columns = ["transit_timestamp", "station_complex_id", "payment_method", "fare_class_category"]
+
+# Station reference columns checked by membership, and the flag column added for each
+station_reference_keys = {
+    "station_complex_id": "station_complex_id_in_reference",
+    "station_complex": "station_complex_in_reference",
+}
+
+_station_reference = None
+
+
+# Access GCS/HDFS paths through the Hadoop FileSystem of the Spark session
+def hadoop_fs(spark, path):
+    """Return the Hadoop FileSystem and Path objects for a path."""
+    jvm = spark.sparkContext._jvm
+    hadoop_path = jvm.org.apache.hadoop.fs.Path(path)
+    return hadoop_path.getFileSystem(spark.sparkContext._jsc.hadoopConfiguration()), hadoop_path
+
+
+# Load the station reference once per Spark session
+def load_station_reference(spark, csv_path=station_reference_csv, snapshot_root=station_reference_snapshots):
+    """
+    Load the station reference as a cached DataFrame keyed on station_complex_id.
+
+    The CSV is snapshotted to Parquet under a version derived from its
+    modification time, so later runs read the same snapshot until the CSV changes.
+    """
+    global _station_reference
+    if _station_reference is not None:
+        return _station_reference
+
+    fs, csv_hadoop_path = hadoop_fs(spark, csv_path)
+    version = fs.getFileStatus(csv_hadoop_path).getModificationTime()
+    snapshot_path = f"{snapshot_root.rstrip('/')}/version={version}"
+
+    if fs.exists(hadoop_fs(spark, f"{snapshot_path}/_SUCCESS")[1]):
+        reference = spark.read.parquet(snapshot_path)
+        gcp_logger.log_text(f"Loaded station reference snapshot {snapshot_path}", severity=200)
+    else:
+        spark.read.option("header", "true").csv(csv_path) \
+            .select(col("station_complex_id").cast("string"), col("station_complex").cast("string")) \
+            .dropDuplicates() \
+            .write.mode("overwrite").parquet(snapshot_path)
+        reference = spark.read.parquet(snapshot_path)
+        gcp_logger.log_text(f"Created station reference snapshot {snapshot_path}", severity=200)
+
+    _station_reference = reference.persist(StorageLevel.MEMORY_AND_DISK)
+    return _station_reference
+
+
+def add_station_reference_flags(df, reference):
+    """
+    Flag whether station_complex_id and station_complex exist in the station reference.
+
+    Each key is matched with a broadcast left join against the distinct reference
+    values; the flag is null when the key itself is null.
+    """
+    for key, flag_column in station_reference_keys.items():
+        matches = F.broadcast(
+            reference.select(key).where(col(key).isNotNull()).distinct()
+            .withColumn("_matched", F.lit(True))
+        )
+        df = df.join(matches, on=key, how="left") \
+            .withColumn(flag_column, when(col(key).isNotNull(), col("_matched").isNotNull())) \
+            .drop("_matched")
+    return df
+
+
+# Great Expectations suites and validation definitions are stored in GCS, so they are
+# built once and survive the Dataproc cluster that built them
+gx_store_bucket = os.environ.get("GX_STORE_BUCKET", "rakshaka-dataproc-bucket")
+gx_store_prefix = os.environ.get("GX_STORE_PREFIX", "great_expectations")
+
+# A file-backed context on a durable local path can be used instead by setting GX_PROJECT_ROOT
+gx_project_root = os.environ.get("GX_PROJECT_ROOT")
+
+# Bump when the expectations below change, so the persisted suite is rebuilt
+gx_suite_version = 3
+
+_gx_context = None
+
+
+def get_gx_context(project_root=gx_project_root, store_bucket=gx_store_bucket, store_prefix=gx_store_prefix):
+    """
+    Get the Great Expectations context, creating it once per process.
+
+    Without a project_root the suites, validation definitions and results are kept
+    in GCS stores under gs://<store_bucket>/<store_prefix>/.
+    """
+    global _gx_context
+    if _gx_context is None:
+        if project_root:
+            _gx_context = gx.get_context(mode="file", project_root_dir=project_root)
+            gcp_logger.log_text(f'gx: Loaded file context from {project_root}', severity=200)
+        else:
+            _gx_context = gx.get_context(project_config=DataContextConfig(
+                store_backend_defaults=GCSStoreBackendDefaults(
+                    default_bucket_name=store_bucket,
+                    expectations_store_prefix=f"{store_prefix}/expectations",
+                    validation_results_store_prefix=f"{store_prefix}/validations",
+                    checkpoint_store_prefix=f"{store_prefix}/checkpoints",
+                    validation_definition_store_prefix=f"{store_prefix}/validation_definitions",
+                )
+            ))
+            gcp_logger.log_text(f'gx: Loaded context with stores in gs://{store_bucket}/{store_prefix}', severity=200)
+    return _gx_context
+
+
+def _get_or_create(get, create):
+    try:
+        return get()
+    except (LookupError, DataContextError):
+        return create()
+
+
+def build_expectation_suite(suite_name):
+    """Build the ridership Expectation Suite."""
+    suite = gx.ExpectationSuite(name=suite_name, meta={"version": gx_suite_version})
 
     expected_columns = ["transit_timestamp", 
         "transit_mode", 
@@ -80,7 +188,7 @@ def get_validations(data_source_name,data_asset_name,suite_name,batch_definition
         "latitude", 
         "longitude", 
         "georeference"]
-    
+
     for i in expected_columns:
         expectation = gx.expectations.ExpectColumnToExist(
             column=i
@@ -90,11 +198,11 @@ def get_validations(data_source_name,data_asset_name,suite_name,batch_definition
         gcp_logger.log_text(f'gx: Adding {i} to ExpectColumnToExist', severity=200)
 
     # Add Expectations to the Suite
-    suite.add_expectation(gx.expectations.ExpectColumnValuesToMatchRegex(
-        column="transit_timestamp",
-        regex=r"^\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}$"
+    # transit_timestamp is a typed timestamp, null when the source value could not be converted
+    suite.add_expectation(gx.expectations.ExpectColumnValuesToNotBeNull(
+        column="transit_timestamp"
     ))
-    gcp_logger.log_text(f'gx: Adding transit_timestamp to ExpectColumnValuesToMatchRegex', severity=200)
+    gcp_logger.log_text(f'gx: Adding transit_timestamp to ExpectColumnValuesToNotBeNull', severity=200)
 
     suite.add_expectation(gx.expectations.ExpectColumnValuesToBeInSet(
         column='transit_mode',
@@ -103,14 +211,14 @@ def get_validations(data_source_name,data_asset_name,suite_name,batch_definition
     gcp_logger.log_text('gx: Adding transit_mode to ExpectColumnValuesToBeInSet', severity=200)
 
     suite.add_expectation(gx.expectations.ExpectColumnValuesToBeInSet(
-        column='station_complex_id',
-        value_set=list(df_['station_complex_id'])
+        column=station_reference_keys['station_complex_id'],
+        value_set=[True]
     ))
     gcp_logger.log_text('gx: Adding station_complex_id to ExpectColumnValuesToBeInSet', severity=200)
 
     suite.add_expectation(gx.expectations.ExpectColumnValuesToBeInSet(
-        column='station_complex',
-        value_set=list(df_['station_complex'])
+        column=station_reference_keys['station_complex'],
+        value_set=[True]
     ))
     gcp_logger.log_text('gx: Adding station_complex to ExpectColumnValuesToBeInSet', severity=200)
 
@@ -160,19 +268,82 @@ def get_validations(data_source_name,data_asset_name,suite_name,batch_definition
     ))
     gcp_logger.log_text('gx: Adding longitude to ExpectColumnValuesToBeBetween', severity=200)
 
-    # Create Validation Definition
-    validation_definition = gx.ValidationDefinition(
+    return suite
+
+
+def get_expectation_suite(context, suite_name):
+    """Get the persisted Expectation Suite, rebuilding it when its version is outdated."""
+    suite = _get_or_create(lambda: context.suites.get(name=suite_name), lambda: None)
+    if suite is not None and suite.meta.get("version") == gx_suite_version:
+        gcp_logger.log_text(f'gx: Reusing expectation suite {suite_name}', severity=200)
+        return suite
+    if suite is not None:
+        context.suites.delete(name=suite_name)
+
+    suite = context.suites.add(build_expectation_suite(suite_name))
+    gcp_logger.log_text(f'gx: Expectation suite created successfully {suite_name}', severity=200)
+    return suite
+
+
+def get_validation_definition(context, definition_name, batch_definition, suite):
+    """Get the persisted validation definition, recreating it when it refers to an outdated suite."""
+    validation_definition = _get_or_create(lambda: context.validation_definitions.get(definition_name), lambda: None)
+    if validation_definition is not None and validation_definition.suite.id == suite.id:
+        return validation_definition
+    if validation_definition is not None:
+        context.validation_definitions.delete(definition_name)
+
+    return context.validation_definitions.add(gx.ValidationDefinition(
         data=batch_definition, suite=suite, name=definition_name
-    )
-    gcp_logger.log_text('gx: Creating validation definition', severity=200)
+    ))
+
+
+# Perform data validation using Great Expectations
 
-    # Add Validation Definition to the Data Context
-    validation_definition = context.validation_definitions.add(validation_definition)
-    gcp_logger.log_text('gx: Added validation definition to context', severity=200)
+def get_validations(data_source_name,data_asset_name,suite_name,batch_definition_name,definition_name,df,
+                    sample_fraction=None, partition_filter=None):
+    """
+    Validate df against the persisted Expectation Suite.
+
+    The context, data source, asset, batch definition, suite and validation
+    definition are created on first use and reused afterwards, and the batch is
+    validated by running the validation definition. The batch can be
+    scoped with a partition_filter (a Column condition) and/or down-sampled with
+    sample_fraction; by default the whole DataFrame is validated.
+    """
+    setup_start = time.time()
+
+    if partition_filter is not None:
+        df = df.filter(partition_filter)
+    if sample_fraction is not None:
+        df = df.sample(fraction=sample_fraction, seed=42)
+
+    # Station membership is checked through a broadcast join instead of a value set
+    df = add_station_reference_flags(df, load_station_reference(df.sparkSession))
+
+    context = get_gx_context()
+
+    data_sources = context.data_sources.all()
+    if data_source_name in data_sources:
+        data_source = data_sources[data_source_name]
+    else:
+        data_source = context.data_sources.add_spark(name=data_source_name)
+    data_asset = _get_or_create(
+        lambda: data_source.get_asset(data_asset_name),
+        lambda: data_source.add_dataframe_asset(name=data_asset_name)
+    )
+    batch_definition = _get_or_create(
+        lambda: data_asset.get_batch_definition(batch_definition_name),
+        lambda: data_asset.add_batch_definition_whole_dataframe(batch_definition_name)
+    )
+    suite = get_expectation_suite(context, suite_name)
+    validation_definition = get_validation_definition(context, definition_name, batch_definition, suite)
+    gcp_logger.log_text(f'gx: Setup completed in {time.time() - setup_start:.2f}s', severity=200)
 
     # Validate the Batch
-    validation_results = batch.validate(suite)
-    gcp_logger.log_text('gx: Validation executed', severity=200)
+    validation_start = time.time()
+    validation_results = validation_definition.run(batch_parameters={"dataframe": df})
+    gcp_logger.log_text(f'gx: Validation executed in {time.time() - validation_start:.2f}s', severity=200)
 
     # Process Validation Results
     results = [
@@ -196,11 +367,9 @@ def get_validations(data_source_name,data_asset_name,suite_name,batch_definition
 
 
 
-def data_isolation(df):
-    regex_pattern_timestamp = r"^\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}$"
+def validation_rules():
+    """Row-level validation rules, keyed by column. Each condition is true for a valid row."""
     allowed_transit_modes = ['subway', 'tram', 'staten_island_railway']
-    allowed_station_complex_ids = list(df_['station_complex_id'])  # Replace with actual values
-    allowed_station_complexes = list(df_['station_complex'])
     allowed_boroughs = ['Brooklyn', 'Manhattan', 'Bronx', 'Queens', 'Staten Island']
     allowed_payment_methods = ['metrocard', 'omny']
     ridership_min, ridership_max = 1.0, 16217.0
@@ -208,16 +377,12 @@ def data_isolation(df):
     latitude_min, latitude_max = 40.576126, 40.903126
     longitude_min, longitude_max = -74.07484, -73.7554
 
-    print(type(allowed_station_complex_ids[0]))
-    print(type(allowed_station_complexes[0]))
-
-
-    # Initialize a dictionary to store the results of each condition
-    condition_results = {
-        "transit_timestamp": F.col("transit_timestamp").rlike(regex_pattern_timestamp),
+    return {
+        "transit_timestamp": F.col("transit_timestamp").isNotNull(),
         "transit_mode": F.col("transit_mode").isin(allowed_transit_modes),
-        "station_complex_id": F.col("station_complex_id").isin(allowed_station_complex_ids),
-        "station_complex": F.col("station_complex").isin(allowed_station_complexes),
+        # Flags added by add_station_reference_flags
+        "station_complex_id": F.col(station_reference_keys["station_complex_id"]),
+        "station_complex": F.col(station_reference_keys["station_complex"]),
         "borough": F.col("borough").isin(allowed_boroughs),
         "payment_method": F.col("payment_method").isin(allowed_payment_methods),
         "fare_class_category": F.col("fare_class_category").isin(fare_class_cat),
@@ -227,43 +392,407 @@ def data_isolation(df):
         "longitude": (F.col("longitude") >= longitude_min) & (F.col("longitude") <= longitude_max)
     }
 
+
+def flag_validation_failures(df, rules):
+    """
+    Add one boolean failure column per rule plus an overall 'is_bad' column.
+
+    A null rule result counts as a failure, so every row ends up either good or bad.
+    """
+    failure_columns = {name: f"failed_{name}" for name in rules}
+    flagged = df.select(
+        "*",
+        *[(~F.coalesce(condition, F.lit(False))).alias(failure_columns[name]) for name, condition in rules.items()]
+    )
+    is_bad = F.lit(False)
+    for column in failure_columns.values():
+        is_bad = is_bad | F.col(column)
+    return flagged.withColumn("is_bad", is_bad), failure_columns
+
+
+def failed_rules_column(failure_columns):
+    """Array of the names of the rules a flagged row failed."""
+    failed = F.array(*[F.when(F.col(column), F.lit(name)) for name, column in failure_columns.items()])
+    return F.filter(failed, lambda rule: rule.isNotNull())
+
+
+def data_isolation(df, metrics=None):
+    rules = validation_rules()
+    columns = df.columns
+    df = add_station_reference_flags(df, load_station_reference(df.sparkSession))
+
+    # Evaluate every rule in one pass and cache the flagged rows for the good/bad split
+    flagged_df, failure_columns = flag_validation_failures(df, rules)
+    flagged_df = flagged_df.persist(StorageLevel.MEMORY_AND_DISK)
+
+    counts = flagged_df.agg(
+        F.count(F.lit(1)).alias("total"),
+        F.sum(F.col("is_bad").cast("long")).alias("bad"),
+        *[F.sum(F.col(column).cast("long")).alias(column) for column in failure_columns.values()]
+    ).collect()[0]
+
+    total_count = counts["total"]
+    bad_count = counts["bad"] or 0
+    good_count = total_count - bad_count
+
     # Log the results for each condition
-    for condition, result in condition_results.items():
-        success_count = df.filter(result).count()
-        failure_count = df.count() - success_count
+    for condition, column in failure_columns.items():
+        failure_count = counts[column] or 0
+        success_count = total_count - failure_count
         gcp_logger.log_text(f"Condition '{condition}': Success={success_count}, Failure={failure_count}", severity=200)
 
-    # Combine all conditions to identify bad records
-    bad_records_condition = ~(
-        condition_results["transit_timestamp"] &
-        condition_results["transit_mode"] &
-        condition_results["station_complex_id"] &
-        condition_results["station_complex"] &
-        condition_results["borough"] &
-        condition_results["payment_method"] &
-        condition_results["fare_class_category"] &
-        condition_results["ridership"] &
-        condition_results["transfers"] &
-        condition_results["latitude"] &
-        condition_results["longitude"]
+    # Filter bad records, keeping the rules each one failed
+    bad_records_df = flagged_df.filter(F.col("is_bad")).select(
+        *columns, failed_rules_column(failure_columns).alias("failed_rules")
     )
-
-    # Filter bad records
-    bad_records_df = df.filter(bad_records_condition)
-    gcp_logger.log_text(f"Bad records proportion: {bad_records_df.count()/df.count()}", severity=200)
+    gcp_logger.log_text(f"Bad records proportion: {bad_count/total_count if total_count else 0.0}", severity=200)
 
     # Filter good records (optional, if needed)
-    good_records_df = df.filter(~bad_records_condition)
-    gcp_logger.log_text(f"Good records proportion: {good_records_df.count()/df.count()}", severity=200)
+    good_records_df = flagged_df.filter(~F.col("is_bad")).select(*columns)
+    gcp_logger.log_text(f"Good records proportion: {good_count/total_count if total_count else 0.0}", severity=200)
 
-    # Show bad records
-    print(f"Bad Records: {bad_records_df.count()}")
-
-    # Show good records (optional)
-    print(f"Good Records: {good_records_df.count()}")
+    if metrics is not None:
+        metrics.record("isolation", {"total": total_count, "good": good_count, "bad": bad_count,
+                                     **{name: counts[column] or 0 for name, column in failure_columns.items()}})
 
     return good_records_df, bad_records_df
 
+# Quarantine of rows that failed validation
+def quarantine_table_path(bucket_path):
+    """Path of the quarantine Delta table in a quarantine bucket."""
+    return f"{bucket_path.rstrip('/')}/{quarantine_table_prefix}/"
+
+
+def write_quarantine(df, quarantine_path, partitioning=quarantine_partitioning):
+    """
+    Add rows to a quarantine Delta table partitioned by transit month.
+
+    The ingestion watermark does not advance past a quarantined batch, so the next
+    run reads and quarantines the same rows again. Rows are therefore merged on the
+    natural key, plus failed_rules for bad rows, and only inserted when not already
+    quarantined.
+    """
+    key_columns = merge_key_columns + (["failed_rules"] if "failed_rules" in df.columns else [])
+    df = add_partition_columns(
+        df.dropDuplicates(key_columns).withColumn("quarantined_at", F.current_timestamp()), partitioning
+    )
+
+    spark = df.sparkSession
+    if not DeltaTable.isDeltaTable(spark, quarantine_path):
+        df.write.format("delta") \
+            .mode("append") \
+            .option("mergeSchema", "true") \
+            .partitionBy(*delta_partitionings[partitioning]) \
+            .save(quarantine_path)
+        return
+
+    condition = " AND ".join(f"target.{column} <=> source.{column}" for column in key_columns)
+    DeltaTable.forPath(spark, quarantine_path).alias("target").merge(df.alias("source"), condition) \
+        .whenNotMatchedInsertAll() \
+        .execute()
+
+
+def read_quarantine(spark, quarantine_path, partition_filter=None, failed_rules=None):
+    """
+    Read quarantined rows, optionally restricted by a partition predicate
+    (e.g. "year = 2024 AND month = 3") and to rows that failed any of the given rules.
+    """
+    df = spark.read.format("delta").load(quarantine_path)
+    if partition_filter:
+        df = df.where(partition_filter)
+    if failed_rules:
+        df = df.where(F.arrays_overlap("failed_rules", F.array(*[F.lit(rule) for rule in failed_rules])))
+    return df
+
+
+def resolve_quarantine(spark, quarantine_path, fixed_df, still_bad_df):
+    """
+    Remove the fixed rows from the quarantine and record the new failure reasons
+    of the rows that still fail, in a single merge on the natural key.
+    """
+    source = fixed_df.select(*merge_key_columns, F.array().cast("array<string>").alias("failed_rules")) \
+        .unionByName(still_bad_df.select(*merge_key_columns, "failed_rules")) \
+        .dropDuplicates(merge_key_columns)
+    condition = " AND ".join(f"target.{column} <=> source.{column}" for column in merge_key_columns)
+
+    DeltaTable.forPath(spark, quarantine_path).alias("target").merge(source.alias("source"), condition) \
+        .whenMatchedDelete(condition="size(source.failed_rules) = 0") \
+        .whenMatchedUpdate(set={"failed_rules": "source.failed_rules"}) \
+        .execute()
+
+
+def clear_quarantine(spark, quarantine_path, df):
+    """Remove the rows of df from the quarantine, matching on the natural key."""
+    source = df.select(*merge_key_columns).dropDuplicates(merge_key_columns)
+    condition = " AND ".join(f"target.{column} <=> source.{column}" for column in merge_key_columns)
+
+    DeltaTable.forPath(spark, quarantine_path).alias("target").merge(source.alias("source"), condition) \
+        .whenMatchedDelete() \
+        .execute()
+
+
+# Persisted ingestion watermark of the silver job
+def read_ingestion_watermark(spark, delta_table_path):
+    """
+    Read the ingestion watermark stored next to the Delta table.
+
+    Returns:
+    - dict: 'max_transit_timestamp' and 'files' (bronze path -> modification time)
+      of what has been merged so far, or None if no watermark exists.
+    """
+    fs, path = hadoop_fs(spark, f"{delta_table_path.rstrip('/')}/{ingestion_watermark_name}")
+    if not fs.exists(path):
+        return None
+    watermark = read_json_file(spark, fs, path)
+    # Earlier runs stored a missing maximum as the string "None"
+    if watermark.get("max_transit_timestamp") == "None":
+        watermark["max_transit_timestamp"] = None
+    return watermark
+
+
+def read_json_file(spark, fs, path):
+    """Read and parse a JSON file through the Hadoop FileSystem."""
+    stream = fs.open(path)
+    try:
+        text = spark.sparkContext._jvm.org.apache.commons.io.IOUtils.toString(stream, "UTF-8")
+    finally:
+        stream.close()
+    return json.loads(text)
+
+
+def write_ingestion_watermark(spark, delta_table_path, max_transit_timestamp, files):
+    """Store the ingestion watermark next to the Delta table; an unknown maximum is stored as null."""
+    fs, path = hadoop_fs(spark, f"{delta_table_path.rstrip('/')}/{ingestion_watermark_name}")
+    watermark = {
+        "max_transit_timestamp": str(max_transit_timestamp) if max_transit_timestamp is not None else None,
+        "files": files,
+    }
+    stream = fs.create(path, True)
+    try:
+        stream.write(bytearray(json.dumps(watermark).encode("utf-8")))
+    finally:
+        stream.close()
+    gcp_logger.log_text(f"Ingestion watermark advanced to {max_transit_timestamp} ({len(files)} files)", severity=200)
+
+
+def list_new_bronze_files(spark, source_path, watermark=None):
+    """
+    List the bronze Parquet files that are not covered by the ingestion watermark.
+
+    A file is new when its path is not in the watermark or its modification time
+    changed. Every month directory is listed, whatever the layout, so files
+    backfilled or restated in months before the watermark month are read too.
+
+    A month directory with a bronze manifest only contributes the parts the manifest
+    names, so part files left behind by an interrupted upload or compaction are not
+    read. A compacted part whose source parts were all processed is covered without
+    being read again.
+
+    Returns:
+    - tuple: (new, covered), each a dict of bronze path -> modification time. The
+      new files must be read; the covered ones only need recording in the watermark.
+    """
+    fs, root = hadoop_fs(spark, source_path)
+    processed = watermark["files"] if watermark else {}
+
+    files = {}
+    manifests = []
+    iterator = fs.listFiles(root, True)
+    while iterator.hasNext():
+        status = iterator.next()
+        name = status.getPath().getName()
+        if name == bronze_manifest_name:
+            manifests.append(status.getPath())
+        elif name.endswith(".parquet") and not name.startswith(("_", ".")):
+            files[status.getPath().toString()] = status.getModificationTime()
+
+    # Manifest part names are object names relative to the bucket root
+    bucket_root = source_path.rstrip("/")
+    managed_directories = set()
+    registered = {}
+    for manifest_path in manifests:
+        managed_directories.add(manifest_path.getParent().toString())
+        for part in read_json_file(spark, fs, manifest_path)["parts"]:
+            registered[f"{bucket_root}/{part['name']}"] = [
+                f"{bucket_root}/{source}" for source in part.get("compacted_from", [])
+            ]
+
+    new_files, covered_files = {}, {}
+    for path, modification_time in files.items():
+        if path.rsplit("/", 1)[0] in managed_directories and path not in registered:
+            continue
+        if processed.get(path) == modification_time:
+            continue
+        sources = registered.get(path)
+        if sources and all(source in processed for source in sources):
+            covered_files[path] = modification_time
+        else:
+            new_files[path] = modification_time
+
+    gcp_logger.log_text(
+        f"Found {len(new_files)} new and {len(covered_files)} compacted bronze files "
+        f"out of {len(files)} listed",
+        severity=200
+    )
+    return new_files, covered_files
+
+
+def add_partition_columns(df, partitioning="year"):
+    """Add the partition columns of the given partitioning derived from transit_timestamp."""
+    if partitioning not in delta_partitionings:
+        raise ValueError(f"Unknown partitioning '{partitioning}', expected one of {list(delta_partitionings)}")
+    if partitioning == "date":
+        return df.withColumn("date", F.to_date("transit_timestamp"))
+    df = df.withColumn("year", F.year("transit_timestamp"))
+    if partitioning == "year_month":
+        df = df.withColumn("month", F.month("transit_timestamp"))
+    return df
+
+
+def get_delta_partition_columns(spark, delta_table_path):
+    """Read the partition columns of an existing Delta table from its metadata."""
+    return list(DeltaTable.forPath(spark, delta_table_path).detail().collect()[0]["partitionColumns"])
+
+
+def partitioning_of_columns(partition_columns):
+    """Map the partition columns of a Delta table back to the partitioning name."""
+    for partitioning, columns in delta_partitionings.items():
+        if columns == list(partition_columns):
+            return partitioning
+    raise ValueError(f"Unsupported Delta partition columns: {partition_columns}")
+
+
+def get_delta_max_timestamp(spark, delta_table_path):
+    """
+    Get MAX(transit_timestamp) of the Delta table, scanning only its latest partition.
+    """
+    delta_df = spark.read.format("delta").load(delta_table_path)
+    partition_column = get_delta_partition_columns(spark, delta_table_path)[0]
+    max_partition = delta_df.agg(F.max(partition_column)).collect()[0][0]
+    if max_partition is None:
+        return None
+    return delta_df.where(F.col(partition_column) == max_partition).agg(F.max("transit_timestamp")).collect()[0][0]
+
+
+# Read bronze Parquet files
+def read_bronze_files(spark, source_path, schema_struct, files, source_layout="month"):
+    """Read an explicit list of bronze Parquet files with the given schema."""
+    reader = spark.read.option("mergeSchema", "true").schema(schema_struct)
+    if source_layout == "hive":
+        return reader.option("basePath", source_path).parquet(*files).drop("year", "month")
+    return reader.parquet(*files)
+
+
+def is_legacy_bronze_file(spark, path):
+    """Whether a bronze Parquet file still stores the measures as strings, read from its footer."""
+    fs, hadoop_path = hadoop_fs(spark, path)
+    footer = spark.sparkContext._jvm.org.apache.parquet.hadoop.ParquetFileReader.readFooter(
+        spark.sparkContext._jsc.hadoopConfiguration(), hadoop_path
+    )
+    measure = footer.getFileMetaData().getSchema().getType(legacy_string_measures[0])
+    return measure.isPrimitive() and measure.asPrimitiveType().getPrimitiveTypeName().name() == "BINARY"
+
+
+def legacy_bronze_schema(schema_struct):
+    """The bronze schema with the measures read as strings, as in files written before the typed schema."""
+    return StructType([
+        StructField(field.name, StringType(), field.nullable) if field.name in legacy_string_measures else field
+        for field in schema_struct.fields
+    ])
+
+
+def read_bronze_groups(spark, source_path, schema_struct, files, source_layout="month"):
+    """
+    Read bronze files grouped by how they store the measures.
+
+    Files written before the typed bronze schema keep the measures as strings and
+    cannot be read with the typed schema, so they are read with legacy_bronze_schema
+    and left to conform_to_schema to cast. Running migrate_layout.py --convert_schema
+    rewrites them with the typed schema.
+
+    Returns:
+    - list: one DataFrame per non-empty group.
+    """
+    legacy = {path: is_legacy_bronze_file(spark, path) for path in files}
+    legacy_files = [path for path in files if legacy[path]]
+    typed_files = [path for path in files if not legacy[path]]
+    if legacy_files:
+        gcp_logger.log_text(
+            f"{len(legacy_files)} bronze files still store the measures as strings; "
+            f"run migrate_layout.py --convert_schema to convert them",
+            severity=400
+        )
+
+    groups = []
+    if typed_files:
+        groups.append(read_bronze_files(spark, source_path, schema_struct, typed_files, source_layout))
+    if legacy_files:
+        groups.append(read_bronze_files(spark, source_path, legacy_bronze_schema(schema_struct), legacy_files,
+                                        source_layout))
+    return groups
+
+
+def build_merge_condition(df, columns, partition_columns=("year",)):
+    """
+    Build a Delta merge condition on the given columns, pruned to the partitions
+    and transit_timestamp range present in the source DataFrame.
+    """
+    bounds = df.agg(
+        *[F.collect_set(column).alias(column) for column in partition_columns],
+        F.min("transit_timestamp").alias("min_ts"),
+        F.max("transit_timestamp").alias("max_ts"),
+    ).collect()[0]
+
+    conditions = [f"target.{column} <=> source.{column}" for column in columns]
+    for column in partition_columns:
+        if bounds[column]:
+            partitions = ", ".join(f"'{p}'" if column == "date" else str(p) for p in sorted(bounds[column]))
+            conditions.append(f"target.{column} IN ({partitions})")
+        conditions.append(f"target.{column} = source.{column}")
+    if bounds["min_ts"] is not None:
+        conditions.append(
+            f"target.transit_timestamp BETWEEN '{bounds['min_ts']}' AND '{bounds['max_ts']}'"
+        )
+    return " AND ".join(conditions)
+
+
+def merge_into_delta(spark, delta_table_path, df, expected_columns, merge_mode="key", update_matched=False):
+    """
+    Upsert a DataFrame into the Delta table.
+
+    merge_mode 'key' joins on merge_key_columns; 'all_columns' keeps the previous
+    behaviour of matching on every expected column. With update_matched, rows that
+    match on the key are overwritten by the source (restated data).
+    """
+    columns = merge_key_columns if merge_mode == "key" else expected_columns
+    if merge_mode == "key":
+        # A key may match at most one source row
+        df = df.dropDuplicates(merge_key_columns)
+    partition_columns = get_delta_partition_columns(spark, delta_table_path)
+    df = add_partition_columns(df, partitioning_of_columns(partition_columns))
+    merge_condition = build_merge_condition(df, columns, partition_columns)
+    gcp_logger.log_text(f"Merging into Delta table with condition: {merge_condition}", severity=200)
+
+    delta_table = DeltaTable.forPath(spark, delta_table_path)
+    merge = delta_table.alias("target").merge(df.alias("source"), merge_condition)
+    if update_matched and merge_mode == "key":
+        merge = merge.whenMatchedUpdateAll()
+
+    start = time.time()
+    merge.whenNotMatchedInsertAll().execute()
+
+    metrics = delta_table.history(1).select("operationMetrics").collect()[0][0] or {}
+    gcp_logger.log_text(
+        f"Merge ({merge_mode}) finished in {time.time() - start:.1f}s: "
+        f"{metrics.get('numTargetRowsInserted', '?')} inserted, "
+        f"{metrics.get('numTargetRowsUpdated', '?')} updated, "
+        f"{metrics.get('numTargetFilesAdded', '?')} files added, "
+        f"{metrics.get('numTargetFilesRemoved', '?')} files rewritten",
+        severity=200
+    )
+    return metrics
+
+
 # Check delta table presence 
 def check_delta_existance(spark, delta_table_path):
     if DeltaTable.isDeltaTable(spark, delta_table_path):
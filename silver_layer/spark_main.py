@@ -1,245 +1,327 @@
-from datetime import datetime
-from pyspark.sql import SparkSession
-from delta.tables import DeltaTable
-import pyspark.sql.functions as f
-import great_expectations as gx
-import pandas as pd
-from pyspark.sql.types import LongType,StructType, StructField, StringType, IntegerType, FloatType, TimestampType, ArrayType, DoubleType
-from spark_functions import *
-import argparse
-from logging_config_spark import *
-
-
-# Define schema as StructType
-
-def handle_validation_failure(df, schema_struct, quarantine_path_good, quarantine_path_bad, is_incremental=False):
-    """Helper function to handle validation failures"""
-    try:
-        gcp_logger.log_text("Starting data isolation process", severity=200)
-        good_data, bad_data = data_isolation(df)
-        
-        # Process good data
-        for field in schema_struct.fields: 
-            col_name = field.name
-            col_type = field.dataType
-            good_data = good_data.withColumn(col_name, good_data[col_name].cast(col_type))
-        
-        # Write good and bad data
-        good_data.write.format('parquet').mode('append').save(quarantine_path_good)
-        bad_data.write.format('parquet').mode('append').save(quarantine_path_bad)
-        
-        gcp_logger.log_text(
-            f'Data quarantined - Good: {quarantine_path_good}, Bad: {quarantine_path_bad}',
-            severity=200
-        )
-        return False
-    except Exception as e:
-        gcp_logger.log_text(
-            f"Error in validation failure handling: {str(e)}", 
-            severity=500
-        )
-        raise
-
-def main(source_path, delta_table_path,quarantine_path_good,quarantine_path_bad):
-    schema_struct = StructType([
-                        StructField("transit_timestamp",LongType(), True),
-                        StructField("transit_mode", StringType(), True),
-                        StructField("station_complex_id", StringType(), True),
-                        StructField("station_complex", StringType(), True),
-                        StructField("borough", StringType(), True),
-                        StructField("payment_method", StringType(), True),
-                        StructField("fare_class_category", StringType(), True),
-                        StructField("ridership", StringType(), True),
-                        StructField("transfers", StringType(), True),
-                        StructField("latitude", StringType(), True),
-                        StructField("longitude", StringType(), True),
-                        StructField("georeference", StructType([
-                            StructField("coordinates", ArrayType(DoubleType()), True),
-                            StructField("type", StringType(), True)
-                        ]), True)
-                    ])
-
-    expected_columns = ["transit_timestamp", 
-        "transit_mode", 
-        "station_complex_id",
-        "station_complex", 
-        "borough", 
-        "payment_method", 
-        "fare_class_category", 
-        "ridership", 
-        "transfers", 
-        "latitude", 
-        "longitude", 
-        "georeference"]
-
-    spark = SparkSession.builder \
-        .appName("ResourceIssueFix") \
-        .config("spark.sql.extensions", "io.delta.sql.DeltaSparkSessionExtension") \
-        .config("spark.sql.catalog.spark_catalog", "org.apache.spark.sql.delta.catalog.DeltaCatalog") \
-        .getOrCreate()
-
-    df_ = spark.read \
-    .option("mergeSchema", "true") \
-    .schema(schema_struct) \
-    .parquet(source_path)
-
-    df = df_.withColumn(
-    "transit_timestamp",
-    f.date_format(
-        (f.col("transit_timestamp") / 1000000000).cast(TimestampType()),
-        "yyyy-MM-dd HH:mm:ss"
-    )
-    )
-
-    df = df.withColumn("ridership", col("ridership").cast(FloatType()))
-    df = df.withColumn("transfers", col("transfers").cast(FloatType()))
-    df = df.withColumn("latitude", col("latitude").cast(FloatType()))
-    df = df.withColumn("longitude", col("longitude").cast(FloatType()))
-
-    df.show(5)
-    df.printSchema()
-    updated_schema_struct = df.schema
-
-    gcp_logger.log_text(f"Loaded data from source path: {source_path}", severity=200)
-
-    delta_presence = check_delta_existance(spark, delta_table_path)
-
-    if not delta_presence:
-        try:
-            validation_summary = get_validations('nyc_data', 'ridership_data', 'basic_validation', 'full_data', 'full_batch', df)
-            gcp_logger.log_text("Performed full data validation", severity=200)
-            schema_check_results = validation_summary.loc[validation_summary['Expectation Type'] == 'expect_column_to_exist']
-
-            if all(schema_check_results['Success']):
-                gcp_logger.log_text("Schema validation successful", severity=200)
-                if not all(validation_summary['Success']):
-                    gcp_logger.log_text("Data Validation Failed - Processing for quarantine", severity=400)
-                    success = handle_validation_failure(
-                        df, 
-                        # schema_struct, 
-                        updated_schema_struct,
-                        quarantine_path_good, 
-                        quarantine_path_bad
-                    )
-                    if not success:
-                        return
-                else:
-                    # for field in schema_struct.fields:
-                    for field in updated_schema_struct.fields:
-                        col_name = field.name
-                        col_type = field.dataType
-                        df = df.withColumn(col_name, df[col_name].cast(col_type))
-
-                    df = df.withColumn('year', f.year(df['transit_timestamp']))
-
-                    df.write.format("delta") \
-                        .mode("overwrite") \
-                        .partitionBy("year") \
-                        .save(delta_table_path)
-
-                    gcp_logger.log_text("Successfully wrote data to Delta table", severity=200)
-            else:
-                gcp_logger.log_text("Schema validation failed: Schema changed", severity=400)
-                raise ValueError("Schema validation failed - Schema mismatch detected")
-        except Exception as e:
-            gcp_logger.log_text(f"Error in initial data processing: {str(e)}", severity=500)
-            raise
-
-    else:
-        delta_df = spark.read.format("delta").load(delta_table_path)
-        delta_df.show(5)
-        delta_df.printSchema()
-
-        gcp_logger.log_text(f"Read Delta table from path: {delta_table_path}", severity=200)
-
-
-        latest_date_delta = delta_df.selectExpr("MAX(transit_timestamp)").collect()[0][0]
-
-
-        latest_date_source = df.selectExpr("MAX(transit_timestamp)").collect()[0][0]
-        print(latest_date_source)
-        print(type(latest_date_source))
-
-        if latest_date_source >= latest_date_delta:
-            try:
-                gcp_logger.log_text(f"Data discrepancy detected: Source ({latest_date_source}) Delta ({latest_date_delta})", severity=200)
-
-                df_new = df.filter(f.col('transit_timestamp') >= latest_date_delta)
-
-                validation_summary = get_validations('nyc_data', 'ridership_data', 'basic_validation', 'incremental_data', 'full_batch', df_new)
-                schema_check_results = validation_summary.loc[validation_summary['Expectation Type'] == 'expect_column_to_exist']
-
-                if all(schema_check_results['Success']):
-                    gcp_logger.log_text("Schema validation successful",severity=200)
-                    if not all(validation_summary['Success']):
-                        gcp_logger.log_text("Incremental Data Validation Failed - Processing for quarantine", severity=400)
-                        success = handle_validation_failure(
-                            df_new, 
-                            # schema_struct, 
-                            updated_schema_struct,
-                            quarantine_path_good, 
-                            quarantine_path_bad, 
-                            is_incremental=True
-                        )
-                        if not success:
-                            return
-
-                    else:
-                        # for field in schema_struct.fields:
-                        for field in updated_schema_struct.fields:
-                            col_name = field.name
-                            col_type = field.dataType
-                            df_new = df_new.withColumn(col_name, df_new[col_name].cast(col_type))
-
-                        df_new = df_new.withColumn('year', f.year(df_new['transit_timestamp']))
-
-                        delta_table = DeltaTable.forPath(spark, delta_table_path)
-
-                        gcp_logger.log_text(f'successfully loaded delta table',severity=200)
-
-                        # Create the merge condition for all columns
-                        merge_condition = " AND ".join([f"target.{col} = source.{col}" for col in expected_columns])
-
-                        merge_condition_par = merge_condition + ' AND target.year=source.year'
-
-                        delta_table.alias("target").merge(
-                            df_new.alias("source"),
-                            merge_condition_par
-                        ).whenNotMatchedInsertAll().execute()
-
-                        gcp_logger.log_text("Successfully merged new data into Delta table", severity=200)
-            except Exception as e:
-                gcp_logger.log_text(f"Error in incremental data processing: {str(e)}", severity=500)
-                raise
-        else:
-            gcp_logger.log_text("Data is up-to-date", severity=200)
-
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser()
-    parser.add_argument(
-        "source_path",
-        type=str,
-        help="The GCS source bucket link (e.g., gs://source-bucket-name/)."
-    )
-    parser.add_argument(
-        "delta_table_path",
-        type=str,
-        help="The GCS destination bucket link (e.g., gs://destination-bucket-name/)."
-    )
-
-    parser.add_argument(
-        "quarantine_path_good",
-        type=str,
-        help="The GCS destination bucket link (e.g., gs://quarantine-bucket-name/)."
-    )
-
-    parser.add_argument(
-        "quarantine_path_bad",
-        type=str,
-        help="The GCS destination bucket link (e.g., gs://quarantine-bucket-name/)."
-    )
-
-    args = parser.parse_args()
-
-    # main(args.source_path, args.delta_table_path, args.quarantine_path_good, args.quarantine_path_bad)
-    main("gs://nyc_subway_data_1/", "gs://nyc_subway_delta_lake/", "gs://nyc_good_data_bucket/", "gs://nyc_bad_data_bucket/")
+from datetime import datetime
+from pyspark.sql import SparkSession
+from delta.tables import DeltaTable
+import pyspark.sql.functions as f
+import great_expectations as gx
+import pandas as pd
+from pyspark.sql.types import LongType,StructType, StructField, StringType, IntegerType, FloatType, TimestampType, ArrayType, DoubleType
+from spark_functions import *
+from schema_conformance import conform_to_schema, load_ridership_schema, mismatched_columns, silver_type_overrides
+from run_metrics import RunMetrics
+import argparse
+from logging_config_spark import *
+
+
+# Define schema as StructType
+
+def handle_validation_failure(df, schema_struct, quarantine_path_good, quarantine_path_bad, is_incremental=False, metrics=None):
+    """Helper function to handle validation failures"""
+    try:
+        gcp_logger.log_text("Starting data isolation process", severity=200)
+        good_data, bad_data = data_isolation(df, metrics)
+        
+        # Process good data
+        good_data = conform_to_schema(good_data, schema_struct)
+        
+        # Write good and bad data; bad rows keep the rules they failed
+        write_quarantine(good_data, quarantine_path_good)
+        write_quarantine(bad_data, quarantine_path_bad)
+        
+        gcp_logger.log_text(
+            f'Data quarantined - Good: {quarantine_path_good}, Bad: {quarantine_path_bad}',
+            severity=200
+        )
+        return False
+    except Exception as e:
+        gcp_logger.log_text(
+            f"Error in validation failure handling: {str(e)}", 
+            severity=500
+        )
+        raise
+
+def check_delta_column_types(spark, delta_table_path):
+    """
+    Fail when the Delta table still has column types other than the silver schema,
+    e.g. transit_timestamp as a string, since merging typed rows into it would fail or
+    mix types. Only the table metadata is read.
+    """
+    delta_df = spark.read.format("delta").load(delta_table_path)
+    mismatched = mismatched_columns(delta_df, load_ridership_schema(type_overrides=silver_type_overrides))
+    if mismatched:
+        message = (
+            f"Delta table columns {mismatched} do not have the silver schema types; run "
+            f"'python delta_maintenance.py --delta_table_path {delta_table_path} --retype' first"
+        )
+        gcp_logger.log_text(message, severity=500)
+        raise ValueError(message)
+
+
+def main(source_path, delta_table_path,quarantine_path_good,quarantine_path_bad, source_layout="month", validation_sample_fraction=None, incremental=True,
+         merge_mode="key", update_matched=False, partitioning="year", debug=False):
+    schema_struct = StructType([
+                        StructField("transit_timestamp",LongType(), True),
+                        StructField("transit_mode", StringType(), True),
+                        StructField("station_complex_id", StringType(), True),
+                        StructField("station_complex", StringType(), True),
+                        StructField("borough", StringType(), True),
+                        StructField("payment_method", StringType(), True),
+                        StructField("fare_class_category", StringType(), True),
+                        StructField("ridership", DoubleType(), True),
+                        StructField("transfers", DoubleType(), True),
+                        StructField("latitude", DoubleType(), True),
+                        StructField("longitude", DoubleType(), True),
+                        StructField("georeference", StructType([
+                            StructField("coordinates", ArrayType(DoubleType()), True),
+                            StructField("type", StringType(), True)
+                        ]), True)
+                    ])
+
+    expected_columns = ["transit_timestamp", 
+        "transit_mode", 
+        "station_complex_id",
+        "station_complex", 
+        "borough", 
+        "payment_method", 
+        "fare_class_category", 
+        "ridership", 
+        "transfers", 
+        "latitude", 
+        "longitude", 
+        "georeference"]
+
+    spark = SparkSession.builder \
+        .appName("ResourceIssueFix") \
+        .config("spark.sql.extensions", "io.delta.sql.DeltaSparkSessionExtension") \
+        .config("spark.sql.catalog.spark_catalog", "org.apache.spark.sql.delta.catalog.DeltaCatalog") \
+        .getOrCreate()
+
+    # Metrics of the whole run are logged once as JSON, also when the run fails
+    metrics = RunMetrics(spark, "silver", debug=debug)
+    try:
+        process_new_data(spark, metrics, schema_struct, expected_columns, source_path, delta_table_path,
+                         quarantine_table_path(quarantine_path_good), quarantine_table_path(quarantine_path_bad),
+                         source_layout, validation_sample_fraction, incremental, merge_mode, update_matched,
+                         partitioning)
+    finally:
+        metrics.emit()
+
+
+def process_new_data(spark, metrics, schema_struct, expected_columns, source_path, delta_table_path,
+                     quarantine_path_good, quarantine_path_bad, source_layout, validation_sample_fraction,
+                     incremental, merge_mode, update_matched, partitioning):
+    delta_presence = check_delta_existance(spark, delta_table_path)
+    if delta_presence:
+        check_delta_column_types(spark, delta_table_path)
+
+    # The persisted ingestion watermark replaces a full MAX() over the Delta table
+    watermark = None
+    latest_date_delta = None
+    if delta_presence:
+        with metrics.phase("delta_watermark"):
+            watermark = read_ingestion_watermark(spark, delta_table_path)
+            if watermark:
+                latest_date_delta = watermark["max_transit_timestamp"]
+            else:
+                latest_date_delta = get_delta_max_timestamp(spark, delta_table_path)
+
+    # Only list and read the bronze files that are not covered by the watermark
+    with metrics.phase("list_bronze"):
+        new_files, covered_files = list_new_bronze_files(spark, source_path, watermark if incremental else None)
+    metrics.record("new_bronze_files", len(new_files))
+    processed_files = {**(watermark["files"] if watermark else {}), **covered_files, **new_files}
+    if not new_files:
+        gcp_logger.log_text("No new bronze files since the last run", severity=200)
+        if covered_files and delta_presence:
+            # Compacted parts replace parts that were already merged
+            write_ingestion_watermark(spark, delta_table_path, latest_date_delta, processed_files)
+        return
+
+    # Timestamp conversion and all casts in a single projection per group of bronze files,
+    # which also casts the measures of files still stored as strings
+    silver_schema = load_ridership_schema(type_overrides=silver_type_overrides)
+    groups = read_bronze_groups(spark, source_path, schema_struct, list(new_files), source_layout)
+    df = conform_to_schema(groups[0], silver_schema)
+    for group in groups[1:]:
+        df = df.unionByName(conform_to_schema(group, silver_schema))
+
+    metrics.sample(df, "conformed bronze data")
+    updated_schema_struct = df.schema
+
+    gcp_logger.log_text(f"Loaded data from source path: {source_path}", severity=200)
+
+    if not delta_presence:
+        try:
+            with metrics.phase("validation"):
+                validation_summary = get_validations('nyc_data', 'ridership_data', 'basic_validation', 'full_data', 'full_batch', df,
+                                                     sample_fraction=validation_sample_fraction)
+            gcp_logger.log_text("Performed full data validation", severity=200)
+            schema_check_results = validation_summary.loc[validation_summary['Expectation Type'] == 'expect_column_to_exist']
+
+            if all(schema_check_results['Success']):
+                gcp_logger.log_text("Schema validation successful", severity=200)
+                if not all(validation_summary['Success']):
+                    gcp_logger.log_text("Data Validation Failed - Processing for quarantine", severity=400)
+                    with metrics.phase("quarantine"):
+                        success = handle_validation_failure(
+                            df, 
+                            # schema_struct, 
+                            updated_schema_struct,
+                            quarantine_path_good, 
+                            quarantine_path_bad,
+                            metrics=metrics
+                        )
+                    if not success:
+                        return
+                else:
+                    df = add_partition_columns(df, partitioning)
+
+                    with metrics.phase("write_delta"):
+                        df.write.format("delta") \
+                            .mode("overwrite") \
+                            .partitionBy(*delta_partitionings[partitioning]) \
+                            .save(delta_table_path)
+
+                    gcp_logger.log_text("Successfully wrote data to Delta table", severity=200)
+
+                    with metrics.phase("watermark"):
+                        write_ingestion_watermark(
+                            spark, delta_table_path, get_delta_max_timestamp(spark, delta_table_path), processed_files
+                        )
+            else:
+                gcp_logger.log_text("Schema validation failed: Schema changed", severity=400)
+                raise ValueError("Schema validation failed - Schema mismatch detected")
+        except Exception as e:
+            gcp_logger.log_text(f"Error in initial data processing: {str(e)}", severity=500)
+            raise
+
+    else:
+        metrics.sample(spark.read.format("delta").load(delta_table_path), "Delta table")
+
+        # The new bronze files were listed from the watermark, so there is new data to
+        # process. A key merge takes every row of those files, so restated rows older
+        # than the Delta watermark still reach the table; an all-columns merge only
+        # takes the rows from the watermark on.
+        try:
+            if merge_mode == "key" or latest_date_delta is None:
+                gcp_logger.log_text("Processing every row of the new bronze files", severity=200)
+                df_new = df
+            else:
+                gcp_logger.log_text(f"Processing bronze data newer than Delta ({latest_date_delta})", severity=200)
+                df_new = df.filter(f.col('transit_timestamp') >= latest_date_delta)
+
+            with metrics.phase("validation"):
+                validation_summary = get_validations('nyc_data', 'ridership_data', 'basic_validation', 'incremental_data', 'incremental_batch', df_new,
+                                                     sample_fraction=validation_sample_fraction)
+            schema_check_results = validation_summary.loc[validation_summary['Expectation Type'] == 'expect_column_to_exist']
+
+            if all(schema_check_results['Success']):
+                gcp_logger.log_text("Schema validation successful",severity=200)
+                if not all(validation_summary['Success']):
+                    gcp_logger.log_text("Incremental Data Validation Failed - Processing for quarantine", severity=400)
+                    with metrics.phase("quarantine"):
+                        success = handle_validation_failure(
+                            df_new, 
+                            # schema_struct, 
+                            updated_schema_struct,
+                            quarantine_path_good, 
+                            quarantine_path_bad, 
+                            is_incremental=True,
+                            metrics=metrics
+                        )
+                    if not success:
+                        return
+
+                else:
+                    with metrics.phase("merge_delta"):
+                        merge_metrics = merge_into_delta(spark, delta_table_path, df_new, expected_columns,
+                                                         merge_mode=merge_mode, update_matched=update_matched)
+                    metrics.record("merge", merge_metrics)
+
+                    gcp_logger.log_text("Successfully merged new data into Delta table", severity=200)
+
+                    with metrics.phase("watermark"):
+                        write_ingestion_watermark(
+                            spark, delta_table_path, get_delta_max_timestamp(spark, delta_table_path), processed_files
+                        )
+        except Exception as e:
+            gcp_logger.log_text(f"Error in incremental data processing: {str(e)}", severity=500)
+            raise
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "source_path",
+        type=str,
+        help="The GCS source bucket link (e.g., gs://source-bucket-name/)."
+    )
+    parser.add_argument(
+        "delta_table_path",
+        type=str,
+        help="The GCS destination bucket link (e.g., gs://destination-bucket-name/)."
+    )
+
+    parser.add_argument(
+        "quarantine_path_good",
+        type=str,
+        help="The GCS destination bucket link (e.g., gs://quarantine-bucket-name/)."
+    )
+
+    parser.add_argument(
+        "quarantine_path_bad",
+        type=str,
+        help="The GCS destination bucket link (e.g., gs://quarantine-bucket-name/)."
+    )
+
+    parser.add_argument(
+        "--source_layout",
+        type=str,
+        choices=["month", "hive"],
+        default="month",
+        help="Layout of the bronze bucket: 'month' (MM-YYYY/) or 'hive' (year=YYYY/month=MM/)."
+    )
+
+    parser.add_argument(
+        "--validation_sample_fraction",
+        type=float,
+        default=None,
+        help="Validate only this fraction of the rows with Great Expectations (default: all rows)."
+    )
+
+    parser.add_argument(
+        "--full_scan",
+        action="store_true",
+        help="Ignore the ingestion watermark and read every bronze file."
+    )
+
+    parser.add_argument(
+        "--merge_mode",
+        choices=["key", "all_columns"],
+        default="key",
+        help="Match incremental rows on the natural key or on every column."
+    )
+
+    parser.add_argument(
+        "--update_matched",
+        action="store_true",
+        help="Overwrite rows that match on the natural key (restated data)."
+    )
+
+    parser.add_argument(
+        "--partitioning",
+        choices=["year", "year_month", "date"],
+        default="year",
+        help="Partitioning of a newly created Delta table; existing tables keep theirs."
+    )
+
+    parser.add_argument(
+        "--debug",
+        action="store_true",
+        help="Show sample rows and schemas of the intermediate DataFrames."
+    )
+
+    args = parser.parse_args()
+
+    # main(args.source_path, args.delta_table_path, args.quarantine_path_good, args.quarantine_path_bad)
+    main("gs://nyc_subway_data_1/", "gs://nyc_subway_delta_lake/", "gs://nyc_good_data_bucket/", "gs://nyc_bad_data_bucket/", source_layout=args.source_layout, validation_sample_fraction=args.validation_sample_fraction, incremental=not args.full_scan,
+         merge_mode=args.merge_mode, update_matched=args.update_matched,
+         partitioning=args.partitioning, debug=args.debug)